@@ -39,7 +39,7 @@ proj.load_image_info()
 ref = proj.ned_reference_lla
 
 # setup SRTM ground interpolator
-sss = SRTM.NEDGround( ref, 6000, 6000, 30 )
+sss = SRTM.DEMTiles( ref, 30 )
 
 ac3d_steps = 8
 
@@ -37,6 +37,8 @@ parser.add_argument('--orb-max-features', default=2000,
                     help='maximum ORB features')
 parser.add_argument('--grid-detect', default=1,
                     help='run detect on gridded squares for (maybe) better feature distribution, 4 is a good starting value, only affects ORB method')
+parser.add_argument('--grid-threads', type=int, default=1,
+                    help='detect the grid cells in this many threads')
 parser.add_argument('--star-max-size', default=16,
                     help='4, 6, 8, 11, 12, 16, 22, 23, 32, 45, 46, 64, 90, 128')
 parser.add_argument('--star-response-threshold', default=30)
@@ -47,6 +49,8 @@ parser.add_argument('--reject-margin', default=0, help='reject features within t
 
 parser.add_argument('--show', action='store_true',
                     help='show features as we detect them')
+parser.add_argument('--jobs', type=int, default=1,
+                    help='number of worker processes detecting images in parallel')
 
 args = parser.parse_args()
 
@@ -66,6 +70,7 @@ elif args.detector == 'SURF':
     detector_node.setInt('surf_noctaves', args.surf_noctaves)
 elif args.detector == 'ORB':
     detector_node.setInt('grid_detect', args.grid_detect)
+    detector_node.setInt('grid_threads', args.grid_threads)
     detector_node.setInt('orb_max_features', args.orb_max_features)
 elif args.detector == 'Star':
     detector_node.setInt('star_max_size', args.star_max_size)
@@ -79,12 +84,12 @@ elif args.detector == 'Star':
                          args.star_suppress_nonmax_size)
 
 # find features in the full image set
-proj.detect_features(scale=args.scale, show=args.show)
+proj.detect_features(scale=args.scale, show=args.show, jobs=args.jobs)
 
 feature_count = 0
 image_count = 0
 for image in proj.image_list:
-    feature_count += len(image.kp_list)
+    feature_count += image.num_features()
     image_count += 1
 
 print("Average # of features per image found = %.0f" % (feature_count / image_count))
@@ -30,7 +30,11 @@ parser.add_argument('--max-dist', default=75, type=float,
 parser.add_argument('--filter', default='gms',
                     choices=['gms', 'homography', 'fundamental', 'essential', 'none'])
 parser.add_argument('--min-chain-length', type=int, default=3, help='minimum match chain length (3 recommended)')
-#parser.add_argument('--ground', type=float, help='ground elevation in meters')
+parser.add_argument('--jobs', type=int, default=1,
+                    help='number of worker processes for pair matching')
+parser.add_argument('--cache-mb', type=float, default=2048,
+                    help='descriptor cache budget (MB, shared by all jobs)')
+parser.add_argument('--ground', type=float, help='ground elevation in meters (if given, only match pairs with overlapping footprints)')
 
 args = parser.parse_args()
 
@@ -39,6 +43,8 @@ proj.load_images_info()
 proj.load_features(descriptors=False) # descriptors cached on the fly later
 proj.undistort_keypoints()
 proj.load_match_pairs()
+if args.ground is not None:
+    proj.compute_image_footprints(args.ground)
 
 matcher_node = getNode('/config/matcher', True)
 matcher_node.setString('matcher', args.matcher)
@@ -48,6 +54,7 @@ matcher_node.setInt('min_pairs', args.min_pairs)
 matcher_node.setFloat('min_dist', args.min_dist)
 matcher_node.setFloat('max_dist', args.max_dist)
 matcher_node.setInt('min_chain_len', args.min_chain_length)
+matcher_node.setFloat('desc_cache_mb', args.cache_mb)
 
 # save any config changes
 proj.save()
@@ -60,7 +67,8 @@ print("K:", K)
 m = Matcher.Matcher()
 m.configure()
 m.robustGroupMatches(proj.image_list, K,
-                     filter=args.filter, review=False)
+                     filter=args.filter, review=False, jobs=args.jobs,
+                     overlap=(args.ground is not None))
 
 # The following code is deprecated ...
 do_old_match_consolodation = False
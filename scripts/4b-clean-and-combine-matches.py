@@ -10,6 +10,8 @@ from props import getNode
 
 from lib import Matcher
 from lib import ProjectMgr
+from lib import TrackStore
+from lib import UVDedup
 
 # Reset all match point locations to their original direct
 # georeferenced locations based on estimated camera pose and
@@ -37,23 +39,11 @@ proj.compute_kp_usage()
 print("Indexing features by unique uv coordinates...")
 bar = Bar("Working:", max=len(proj.image_list))
 for image in proj.image_list:
-    # pass one, build a tmp structure of unique keypoints (by uv) and
-    # the index of the first instance.
-    image.kp_remap = {}
-    used = 0
-    for i, kp in enumerate(image.kp_list):
-        if image.kp_used[i]:
-            used += 1
-            key = "%.2f-%.2f" % (kp.pt[0], kp.pt[1])
-            if not key in image.kp_remap:
-                image.kp_remap[key] = i
-            else:
-                #print("%d -> %d" % (i, image.kp_remap[key]))
-                #print(" ", image.coord_list[i], image.coord_list[image.kp_remap[key]])
-                pass
-
-    #print(" features used:", used)
-    #print(" unique by uv and used:", len(image.kp_remap))
+    # map each used keypoint to the index of the first used keypoint
+    # with the same uv coordinate
+    image.kp_remap = UVDedup.kp_remap(image.kp_pts(), image.kp_used)
+    #print(" features used:", np.count_nonzero(image.kp_used))
+    #print(" unique by uv and used:", np.count_nonzero(image.kp_remap[image.kp_used] == np.nonzero(image.kp_used)[0]))
     bar.next()
 bar.finish()
 
@@ -70,49 +60,28 @@ bar.finish()
 print("Merging keypoints with duplicate uv coordinates...")
 bar = Bar("Working:", max=len(proj.image_list))
 for i, i1 in enumerate(proj.image_list):
+    pts1 = i1.kp_pts()
     for key in i1.match_list:
         matches = i1.match_list[key]
-        count = 0
         i2 = proj.findImageByName(key)
-        if i2 is None:
+        if i2 is None or not len(matches):
             # ignore pairs outside our area set
             continue
-        for k, pair in enumerate(matches):
-            # print pair
-            idx1 = pair[0]
-            idx2 = pair[1]
-            kp1 = i1.kp_list[idx1]
-            kp2 = i2.kp_list[idx2]
-            key1 = "%.2f-%.2f" % (kp1.pt[0], kp1.pt[1])
-            key2 = "%.2f-%.2f" % (kp2.pt[0], kp2.pt[1])
-            # print key1, key2
-            new_idx1 = i1.kp_remap[key1]
-            new_idx2 = i2.kp_remap[key2]
-            # count the number of match rewrites
-            if idx1 != new_idx1 or idx2 != new_idx2:
-                count += 1
-            if idx1 != new_idx1:
-                # sanity check
-                uv1 = list(i1.kp_list[idx1].pt)
-                new_uv1 = list(i1.kp_list[new_idx1].pt)
-                if not np.allclose(uv1, new_uv1):
-                    print("OOPS!!!")
-                    print("  index 1: %d -> %d" % (idx1, new_idx1))
-                    print("  [%.2f, %.2f] -> [%.2f, %.2f]" % (uv1[0], uv1[1],
-                                                              new_uv1[0],
-                                                              new_uv1[1]))
-            if idx2 != new_idx2:
-                # sanity check
-                uv2 = list(i2.kp_list[idx2].pt)
-                new_uv2 = list(i2.kp_list[new_idx2].pt)
-                if not np.allclose(uv2, new_uv2):
-                    print("OOPS!")
-                    print("  index 2: %d -> %d" % (idx2, new_idx2))
-                    print("  [%.2f, %.2f] -> [%.2f, %.2f]" % (uv2[0], uv2[1],
-                                                              new_uv2[0],
-                                                              new_uv2[1]))
-            # rewrite matches
-            matches[k] = [new_idx1, new_idx2]
+        pairs = np.array(matches, dtype=int).reshape(-1, 2)
+        new_pairs = UVDedup.remap_pairs(pairs, i1.kp_remap, i2.kp_remap)
+        # count the number of match rewrites
+        changed = np.any(pairs != new_pairs, axis=1)
+        count = np.count_nonzero(changed)
+        if count:
+            # sanity check
+            pts2 = i2.kp_pts()
+            bad1 = ~np.all(np.isclose(pts1[pairs[:,0]], pts1[new_pairs[:,0]]), axis=1)
+            bad2 = ~np.all(np.isclose(pts2[pairs[:,1]], pts2[new_pairs[:,1]]), axis=1)
+            for k in np.nonzero(bad1 | bad2)[0]:
+                print("OOPS!!!")
+                print("  index: %s -> %s" % (pairs[k], new_pairs[k]))
+        # rewrite matches
+        i1.match_list[key] = new_pairs.tolist()
         #if count > 0:
         #    print('Match:', i1.name, 'vs', i2.name, '%d/%d' % ( count, len(matches) ), 'rewrites')
     bar.next()
@@ -145,16 +114,9 @@ for i, i1 in enumerate(proj.image_list):
         if i2 is None:
             # ignore pairs not in our area set
             continue
-        count = 0
-        pair_dict = {}
-        new_matches = []
-        for k, pair in enumerate(matches):
-            pair_key = "%d-%d" % (pair[0], pair[1])
-            if not pair_key in pair_dict:
-                pair_dict[pair_key] = True
-                new_matches.append(pair)
-            else:
-                count += 1
+        keep = UVDedup.unique_pairs(matches)
+        new_matches = [ matches[k] for k in keep ]
+        count = len(matches) - len(new_matches)
         if count > 0:
             print('Match:', i, 'vs', j, 'matches:', len(matches), 'dups:', count)
       
@@ -193,9 +155,10 @@ for i, i1 in enumerate(proj.image_list):
                 kp_dict[pair[0]] = pair[1]
             else:
                 print("Warning keypoint idx", pair[0], "already used in another match.")
-                uv2a = list(i2.kp_list[ kp_dict[pair[0]] ].pt)
-                uv2b = list(i2.kp_list[ pair[1] ].pt)
-                if not np.allclose(uv2, new_uv2):
+                kp_pts = i2.kp_pts()
+                uv2a = kp_pts[ kp_dict[pair[0]] ]
+                uv2b = kp_pts[ pair[1] ]
+                if not np.allclose(uv2a, uv2b):
                     print("  [%.2f, %.2f] -> [%.2f, %.2f]" % (uv2a[0], uv2a[1],
                                                               uv2b[0], uv2b[1]))
                 count += 1
@@ -238,81 +201,27 @@ pickle.dump(matches_direct, open(direct_file, "wb"))
 # collect/group match chains that refer to the same keypoint
 
 print("Linking common matches together into chains.")
-count = 0
-done = False
-while not done:
-    print("Iteration:", count)
-    count += 1
-    matches_new = []
-    matches_lookup = {}
-    for i, match in enumerate(matches_direct):
-        # scan if any of these match points have been previously seen
-        # and record the match index
-        index = -1
-        for p in match[2:]:
-            key = "%d-%d" % (p[0], p[1])
-            if key in matches_lookup:
-                index = matches_lookup[key]
-                break
-        if index < 0:
-            # not found, append to the new list
-            for p in match[2:]:
-                key = "%d-%d" % (p[0], p[1])
-                matches_lookup[key] = len(matches_new)
-            matches_new.append(list(match)) # shallow copy
-        else:
-            # found a previous reference, append these match items
-            existing = matches_new[index]
-            for p in match[2:]:
-                key = "%d-%d" % (p[0], p[1])
-                found = False
-                for e in existing[2:]:
-                    if p[0] == e[0]:
-                        found = True
-                        break
-                if not found:
-                    # add
-                    existing.append(list(p)) # shallow copy
-                    matches_lookup[key] = index
-            # no 3d location estimation yet
-            # # attempt to combine location equitably
-            # size1 = len(match[2:])
-            # size2 = len(existing[2:])
-            # ned1 = np.array(match[0])
-            # ned2 = np.array(existing[0])
-            # avg = (ned1 * size1 + ned2 * size2) / (size1 + size2)
-            # existing[0] = avg.tolist()
-            # # print(ned1, ned2, existing[0])
-            # # print "new:", existing
-            # # print
-    if len(matches_new) == len(matches_direct):
-        done = True
-    else:
-        matches_direct = list(matches_new) # shallow copy
+matches_direct = Matcher.group_matches(matches_direct)
 
 # replace the keypoint index in the matches file with the actual kp
 # values.  This will save time later and avoid needing to load the
 # full original feature files which are quite large.  This also will
 # reduce the in-memory footprint for many steps.
 print('Replacing keypoint indices with uv coordinates.')
+pts_list = [ image.kp_pts() for image in proj.image_list ]
 for match in matches_direct:
     for m in match[2:]:
-        kp = proj.image_list[m[0]].kp_list[m[1]].pt
-        m[1] = list(kp)
+        m[1] = pts_list[m[0]][m[1]].tolist()
     # print(match)
 
 # sort by longest match chains first
 print("Sorting matches by longest chain first.")
-matches_direct.sort(key=len, reverse=True)
+tracks = TrackStore.from_list(matches_direct)
+tracks = tracks.select(np.argsort(-tracks.track_len(), kind='stable'))
 
-sum = 0.0
-for i, match in enumerate(matches_direct):
-    refs = len(match[2:])
-    sum += refs
-        
-if count >= 1:
-    print("Total unique features in image set:", len(matches_direct))
-    print("Keypoint average instances:", "%.2f" % (sum / len(matches_direct)))
+if len(tracks):
+    print("Total unique features in image set:", len(tracks))
+    print("Keypoint average instances:", "%.2f" % (tracks.num_obs() / len(tracks)))
 
 print("Writing full group chain matches_grouped file ...")
-pickle.dump(matches_direct, open(os.path.join(proj.analysis_dir, "matches_grouped"), "wb"))
+TrackStore.save(proj.analysis_dir, tracks)
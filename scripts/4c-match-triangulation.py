@@ -1,10 +1,8 @@
 #!/usr/bin/python3
 
 import argparse
-import cv2
 import numpy as np
 import os
-import pickle
 from progress.bar import Bar
 
 from props import getNode
@@ -13,6 +11,7 @@ from lib import Groups
 from lib import LineSolver
 from lib import ProjectMgr
 from lib import SRTM
+from lib import TrackStore
 
 parser = argparse.ArgumentParser(description='Keypoint projection.')
 parser.add_argument('--project', required=True, help='project directory')
@@ -25,7 +24,7 @@ proj.load_images_info()
 
 source = 'matches_grouped'
 print("Loading source matches:", source)
-matches = pickle.load( open( os.path.join(proj.analysis_dir, source), 'rb' ) )
+tracks = TrackStore.load(proj.analysis_dir, source)
 
 # load the group connections within the image set
 groups = Groups.load(proj.analysis_dir)
@@ -36,23 +35,12 @@ print()
 
 if args.method == 'triangulate':
     K = proj.cam.get_K(optimized=True)
-    dist_coeffs = np.array(proj.cam.get_dist_coeffs(optimized=True))
 else:
     K = proj.cam.get_K(optimized=False)
 IK = np.linalg.inv(K)
 
 do_sanity_check = False
 
-# assume global K and distcoeff set earlier
-def undistort(uv_orig):
-    # convert the point into the proper format for opencv
-    uv_raw = np.zeros((1,1,2), dtype=np.float32)
-    uv_raw[0][0] = (uv_orig[0], uv_orig[1])
-    # do the actual undistort
-    uv_new = cv2.undistortPoints(uv_raw, K, dist_coeffs, P=K)
-    # print(uv_orig, type(uv_new), uv_new)
-    return uv_new[0][0]
-    
 if args.method == 'srtm':
     # lookup ned reference
     ref_node = getNode("/config/ned_reference", True)
@@ -61,7 +49,8 @@ if args.method == 'srtm':
             ref_node.getFloat('alt_m') ]
 
     # setup SRTM ground interpolator
-    sss = SRTM.NEDGround( ref, 3000, 3000, 30 )
+    # (dem tiles are built on demand, so any project extent works)
+    sss = SRTM.DEMTiles( ref, 30 )
 
     # for each image lookup the SRTM elevation under the camera
     print("Looking up SRTM base elevation for each image location...")
@@ -71,87 +60,78 @@ if args.method == 'srtm':
         # print(image.name, image.base_elev)
 
     print("Estimating initial projection for each feature...")
-    bad_count = 0
-    bad_indices = []
-    bar = Bar("Working:", max=100)
-    step = int(len(matches) / 100)
-    for i, match in enumerate(matches):
-        sum = np.zeros(3)
-        array = []              # fixme: temp/debug
-        for m in match[2:]:
-            image = proj.image_list[m[0]]
+    # project all the observations of each image at once and
+    # average the projected ground points of each track
+    obs_track = tracks.obs_track()
+    obs_ned = np.zeros((tracks.num_obs(), 3))
+    bar = Bar("Working:", max=len(proj.image_list))
+    for i, image in enumerate(proj.image_list):
+        idx = np.nonzero(tracks.obs_image == i)[0]
+        if len(idx):
             cam2body = image.get_cam2body()
             body2ned = image.get_body2ned()
             ned, ypr, quat = image.get_camera_pose()
-            uv_list = [ m[1] ] # just one uv element
-            vec_list = proj.projectVectors(IK, body2ned, cam2body, uv_list)
-            v = vec_list[0]
-            if v[2] > 0.0:
-                d_proj = -(ned[2] + image.base_elev)
-                factor = d_proj / v[2]
-                n_proj = v[0] * factor
-                e_proj = v[1] * factor
-                p = [ ned[0] + n_proj, ned[1] + e_proj, ned[2] + d_proj ]
-                # print('  ', p)
-                sum += np.array(p)
-                array.append(p)
-            else:
+            vec_list = proj.projectVectors(IK, body2ned, cam2body,
+                                           tracks.obs_uv[idx])
+            v = np.array(vec_list).reshape(-1, 3)
+            down = v[:,2] > 0.0
+            if not np.all(down):
                 print('vector projected above horizon.')
-        match[0] = (sum/len(match[2:])).tolist()
-        # print(match[0])
-        if do_sanity_check:
-            # crude sanity check
-            ok = True
-            for p in array:
-                dist = np.linalg.norm(np.array(match[0]) - np.array(p))
-                if dist > 100:
-                    ok = False
-            if not ok:
-                bad_count += 1
-                bad_indices.append(i)
-                print('match:', i, match[0])
-                for p in array:
-                    dist = np.linalg.norm(np.array(match[0]) - np.array(p))
-                    print(' ', dist, p)
-        if (i+1) % step == 0:
-            bar.next()
+            d_proj = -(ned[2] + image.base_elev)
+            factor = d_proj / v[down,2]
+            obs_ned[idx[down],0] = ned[0] + v[down,0] * factor
+            obs_ned[idx[down],1] = ned[1] + v[down,1] * factor
+            obs_ned[idx[down],2] = ned[2] + d_proj
+        bar.next()
     bar.finish()
+    for j in range(3):
+        tracks.ned[:,j] = np.bincount(obs_track, weights=obs_ned[:,j],
+                                      minlength=len(tracks))
+    tracks.ned /= tracks.track_len()[:,np.newaxis]
     if do_sanity_check:
-        print('bad count:', bad_count)
+        # crude sanity check
+        dist = np.linalg.norm(obs_ned - tracks.ned[obs_track], axis=1)
+        bad = np.zeros(len(tracks), dtype=bool)
+        bad[obs_track[dist > 100]] = True
+        for i in np.nonzero(bad)[0]:
+            print('match:', i, tracks.ned[i])
+        print('bad count:', np.count_nonzero(bad))
         print('deleting bad matches...')
-        bad_indices.reverse()
-        for i in bad_indices:
-            del matches[i]
+        tracks = tracks.select(~bad)
 elif args.method == 'triangulate':
-    for i, match in enumerate(matches):
-        if match[1] == args.group: # used in current group
-            # print(match)
-            points = []
-            vectors = []
-            for m in match[2:]:
-                if proj.image_list[m[0]].name in groups[args.group]:
-                    # print(m)
-                    image = proj.image_list[m[0]]
-                    cam2body = image.get_cam2body()
-                    body2ned = image.get_body2ned()
-                    ned, ypr, quat = image.get_camera_pose(opt=True)
-                    uv_list = [ undistort(m[1]) ] # just one uv element
-                    vec_list = proj.projectVectors(IK, body2ned, cam2body, uv_list)
-                    points.append( ned )
-                    vectors.append( vec_list[0] )
-                    # print(' ', image.name)
-                    # print(' ', uv_list)
-                    # print('  ', vec_list)
-            if len(points) >= 2:
-                # print('points:', points)
-                # print('vectors:', vectors)
-                p = LineSolver.ls_lines_intersection(points, vectors, transpose=True).tolist()
-                # print('result:',  p, p[0])
-                print(i, match[0], '>>>', end=" ")
-                match[0] = [ p[0][0], p[1][0], p[2][0] ]
-                if p[2][0] > 0:
-                    print("WHOA!")
-                print(match[0])
+    group_images = set()
+    for name in groups[args.group]:
+        group_images.add(proj.findIndexByName(name))
+    # undistort all the observations in one batch
+    obs_uv = proj.cam.undistort(tracks.obs_uv, optimized=True)
+    for i in np.nonzero(tracks.group == args.group)[0]:
+        # used in current group
+        points = []
+        vectors = []
+        a = tracks.offsets[i]
+        b = tracks.offsets[i+1]
+        images = tracks.obs_image[a:b]
+        uvs = obs_uv[a:b]
+        for m0, uv in zip(images, uvs):
+            if m0 in group_images:
+                image = proj.image_list[m0]
+                cam2body = image.get_cam2body()
+                body2ned = image.get_body2ned()
+                ned, ypr, quat = image.get_camera_pose(opt=True)
+                uv_list = [ uv ] # just one uv element
+                vec_list = proj.projectVectors(IK, body2ned, cam2body, uv_list)
+                points.append( ned )
+                vectors.append( vec_list[0] )
+        if len(points) >= 2:
+            # print('points:', points)
+            # print('vectors:', vectors)
+            p = LineSolver.ls_lines_intersection(points, vectors, transpose=True).tolist()
+            # print('result:',  p, p[0])
+            print(i, tracks.ned[i], '>>>', end=" ")
+            tracks.ned[i] = [ p[0][0], p[1][0], p[2][0] ]
+            if p[2][0] > 0:
+                print("WHOA!")
+            print(tracks.ned[i])
     
 print("Writing:", source)
-pickle.dump(matches, open(os.path.join(proj.analysis_dir, source), "wb"))
+TrackStore.save(proj.analysis_dir, tracks, source)
@@ -4,11 +4,11 @@
 # connections to each other cannot be correctly placed.
 
 import argparse
-import pickle
-import os.path
+import numpy as np
 
 from lib import Groups
 from lib import ProjectMgr
+from lib import TrackStore
 
 parser = argparse.ArgumentParser(description='Keypoint projection.')
 parser.add_argument('--project', required=True, help='project directory')
@@ -19,12 +19,12 @@ proj.load_images_info()
 
 source = 'matches_grouped'
 print("Loading source matches:", source)
-matches = pickle.load( open( os.path.join(proj.analysis_dir, source), 'rb' ) )
+tracks = TrackStore.load(proj.analysis_dir, source)
 
-print("features:", len(matches))
+print("features:", len(tracks))
 
 # compute the group connections within the image set.
-groups = Groups.compute(proj.image_list, matches)
+groups = Groups.compute(proj.image_list, tracks)
 Groups.save(proj.analysis_dir, groups)
 
 print('Total images:', len(proj.image_list))
@@ -35,14 +35,11 @@ print()
 
 # debug
 print("Counting allocated features...")
-count = 0
-for i, match in enumerate(matches):
-    if match[1] >= 0:
-        count += 1
+count = np.count_nonzero(tracks.group >= 0)
 
 print("Writing:", source, "...")
-print("Features: %d/%d" % (count, len(matches)))
-pickle.dump(matches, open(os.path.join(proj.analysis_dir, source), "wb"))
+print("Features: %d/%d" % (count, len(tracks)))
+TrackStore.save(proj.analysis_dir, tracks, source)
 
 # this is extra (and I'll put it here for now for lack of a better
 # place), but for visualization's sake, create a gnuplot data file
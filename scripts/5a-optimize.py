@@ -5,15 +5,19 @@
 # collective data set.
 
 import argparse
-import pickle
 import cv2
 import math
+import multiprocessing
 import numpy as np
 import os
 
+from props import getNode
+
 from lib import Groups
+from lib import match_culling as cull
 from lib import Optimizer
 from lib import ProjectMgr
+from lib import TrackStore
 from lib import transformations
 
 d2r = math.pi / 180.0
@@ -22,7 +26,18 @@ r2d = 180.0 / math.pi
 parser = argparse.ArgumentParser(description='Keypoint projection.')
 parser.add_argument('--project', required=True, help='project directory')
 parser.add_argument('--group', type=int, default=0, help='group number')
+parser.add_argument('--all-groups', action='store_true', help='optimize every group (each group is solved independently)')
+parser.add_argument('--jobs', type=int, default=1, help='number of worker processes for --all-groups')
+parser.add_argument('--loss', default='linear', choices=['linear', 'huber', 'cauchy'], help='robust loss function')
+parser.add_argument('--f-scale', type=float, default=2.0, help='robust loss inlier scale (pixels)')
+parser.add_argument('--cull-std', type=float, default=0.0, help='after solving, remove observations with error > mre + N*std and resolve (0 = off)')
+parser.add_argument('--cull-passes', type=int, default=3, help='maximum number of cull and resolve passes')
+parser.add_argument('--incremental', action='store_true', help='only optimize the images without an optimized pose (plus their match graph neighbors), holding the rest fixed')
+parser.add_argument('--rings', type=int, default=1, help='match graph neighborhood size for --incremental')
+parser.add_argument('--global-every', type=int, default=0, help='with --incremental, do a full refinement every N runs (0 = never)')
 parser.add_argument('--refine', action='store_true', help='refine a previous optimization.')
+parser.add_argument('--solver', default='trf', choices=['trf', 'schur'], help='trf (scipy least_squares) or schur (Schur complement levenberg-marquardt)')
+parser.add_argument('--schur-solver', default='direct', choices=['direct', 'cg'], help='reduced camera system solver for --solver=schur')
 
 args = parser.parse_args()
 
@@ -67,186 +82,277 @@ def transform_points( A, pts_list ):
 proj = ProjectMgr.ProjectMgr(args.project)
 proj.load_images_info()
 
-source_file = os.path.join(proj.analysis_dir, 'matches_grouped' )
-print('Match file:', source_file)
-matches = pickle.load( open(source_file, "rb") )
-print('Match features:', len(matches))
+source = 'matches_grouped'
+print('Match file:', TrackStore.filename(proj.analysis_dir, source))
+tracks = TrackStore.load(proj.analysis_dir, source)
+print('Match features:', len(tracks))
 
 # load the group connections within the image set
 groups = Groups.load(proj.analysis_dir)
 # sort from smallest to largest: groups.sort(key=len)
 
-opt = Optimizer.Optimizer(args.project)
-opt.setup( proj, groups, args.group, matches, optimized=args.refine )
-cameras, features, cam_index_map, feat_index_map, fx_opt, fy_opt, cu_opt, cv_opt, distCoeffs_opt = opt.run()
-
-# mark all the optimized poses as invalid
-for image in proj.image_list:
-    opt_cam_node = image.node.getChild('camera_pose_opt', True)
-    opt_cam_node.setBool('valid', False)
-
-for i, cam in enumerate(cameras):
-    image_index = cam_index_map[i]
-    image = proj.image_list[image_index]
-    ned_orig, ypr_orig, quat_orig = image.get_camera_pose()
-    print('optimized cam:', cam)
-    rvec = cam[0:3]
-    tvec = cam[3:6]
-    Rned2cam, jac = cv2.Rodrigues(rvec)
-    cam2body = image.get_cam2body()
-    Rned2body = cam2body.dot(Rned2cam)
-    Rbody2ned = np.matrix(Rned2body).T
-    (yaw, pitch, roll) = transformations.euler_from_matrix(Rbody2ned, 'rzyx')
-    #print "orig ypr =", image.camera_pose['ypr']
-    #print "new ypr =", [yaw/d2r, pitch/d2r, roll/d2r]
-    pos = -np.matrix(Rned2cam).T * np.matrix(tvec).T
-    newned = pos.T[0].tolist()[0]
-    print(image.name, ned_orig, '->', newned, 'dist:', np.linalg.norm(np.array(ned_orig) - np.array(newned)))
-    image.set_camera_pose( newned, yaw*r2d, pitch*r2d, roll*r2d, opt=True )
-    image.placed = True
-proj.save_images_info()
-print('Updated the optimized camera poses.')
-
-# update and save the optimized camera calibration
-proj.cam.set_K(fx_opt, fy_opt, cu_opt, cv_opt, optimized=True)
-proj.cam.set_dist_coeffs(distCoeffs_opt.tolist(), optimized=True)
-proj.save()
+# optimize one group and return the results (runs in a worker process
+# when optimizing several groups in parallel, the project, tracks and
+# groups are inherited through fork.)
+def optimize_group(group_index):
+    opt = Optimizer.Optimizer(args.project)
+    opt.solver = args.solver
+    opt.schur_solver = args.schur_solver
+    opt.loss = args.loss
+    opt.f_scale = args.f_scale
+    opt.cull_std = args.cull_std
+    opt.cull_passes = args.cull_passes
+    if incremental:
+        # the new images (no valid optimized pose yet) and their
+        # neighbors are free, everything else stays where it is
+        new_images = set()
+        for name in groups[group_index]:
+            image = proj.findImageByName(name)
+            if not image.node.getChild('camera_pose_opt', True).getBool('valid'):
+                new_images.add(proj.findIndexByName(name))
+        if not new_images:
+            print('Group %d: no new images' % group_index)
+            return None
+        group_images = set( [ proj.findIndexByName(name)
+                              for name in groups[group_index] ] )
+        active = Groups.neighborhood(tracks, len(proj.image_list),
+                                     new_images, args.rings) & group_images
+        print('Group %d: new images: %d window: %d'
+              % (group_index, len(new_images), len(active)))
+        opt.setup( proj, groups, group_index, tracks, optimized=True,
+                   active=active )
+    else:
+        opt.setup( proj, groups, group_index, tracks, optimized=args.refine )
+    return (group_index,) + tuple(opt.run()) + (opt.culled_obs,)
 
-# compare original camera locations with optimized camera locations and
-# derive a transform matrix to 'best fit' the new camera locations
-# over the original ... trusting the original group gps solution as
-# our best absolute truth for positioning the system in world
-# coordinates.
-#
-# each optimized group needs a separate/unique fit
-
-matches_opt = list(matches) # shallow copy
-refit_group_orientations = True
-if refit_group_orientations:
-    group = groups[args.group]
-    print('refitting group size:', len(group))
-    src_list = []
-    dst_list = []
-    # only consider images that are in the current   group
-    for name in group:
-        image = proj.findImageByName(name)
-        ned, ypr, quat = image.get_camera_pose(opt=True)
-        src_list.append(ned)
-        ned, ypr, quat = image.get_camera_pose()
-        dst_list.append(ned)
-    A = get_recenter_affine(src_list, dst_list)
-
-    # extract the rotation matrix (R) from the affine transform
-    scale, shear, angles, trans, persp = transformations.decompose_matrix(A)
-    print('  scale:', scale)
-    print('  shear:', shear)
-    print('  angles:', angles)
-    print('  translate:', trans)
-    print('  perspective:', persp)
-    R = transformations.euler_matrix(*angles)
-    print("R:\n{}".format(R))
-
-    # fixme (just group):
-
-    # update the optimized camera locations based on best fit
-    camera_list = []
-    # load optimized poses
-    for image in proj.image_list:
-        if image.name in group:
+# copy the optimized camera poses of a group back into the image
+# property tree, then refit the group to the original camera locations
+# and copy the (refit) feature locations back to the match structure.
+def update_group(group_index, cameras, features, cam_index_map,
+                 feat_index_map, refit_group_orientations=True):
+    for i, cam in enumerate(cameras):
+        image_index = cam_index_map[i]
+        image = proj.image_list[image_index]
+        ned_orig, ypr_orig, quat_orig = image.get_camera_pose()
+        print('optimized cam:', cam)
+        rvec = cam[0:3]
+        tvec = cam[3:6]
+        Rned2cam, jac = cv2.Rodrigues(rvec)
+        cam2body = image.get_cam2body()
+        Rned2body = cam2body.dot(Rned2cam)
+        Rbody2ned = np.matrix(Rned2body).T
+        (yaw, pitch, roll) = transformations.euler_from_matrix(Rbody2ned, 'rzyx')
+        #print "orig ypr =", image.camera_pose['ypr']
+        #print "new ypr =", [yaw/d2r, pitch/d2r, roll/d2r]
+        pos = -np.matrix(Rned2cam).T * np.matrix(tvec).T
+        newned = pos.T[0].tolist()[0]
+        print(image.name, ned_orig, '->', newned, 'dist:', np.linalg.norm(np.array(ned_orig) - np.array(newned)))
+        image.set_camera_pose( newned, yaw*r2d, pitch*r2d, roll*r2d, opt=True )
+        image.placed = True
+    proj.save_images_info()
+    print('Updated the optimized camera poses.')
+
+    # compare original camera locations with optimized camera locations and
+    # derive a transform matrix to 'best fit' the new camera locations
+    # over the original ... trusting the original group gps solution as
+    # our best absolute truth for positioning the system in world
+    # coordinates.
+    #
+    # each optimized group needs a separate/unique fit (not needed
+    # when the solution is anchored by fixed cameras)
+
+    if refit_group_orientations:
+        group = groups[group_index]
+        print('refitting group size:', len(group))
+        src_list = []
+        dst_list = []
+        # only consider images that are in the current   group
+        for name in group:
+            image = proj.findImageByName(name)
             ned, ypr, quat = image.get_camera_pose(opt=True)
-        else:
-            # this is just fodder to match size/index of the lists
+            src_list.append(ned)
             ned, ypr, quat = image.get_camera_pose()
-        camera_list.append( ned )
+            dst_list.append(ned)
+        A = get_recenter_affine(src_list, dst_list)
 
-    # refit
-    new_cams = transform_points(A, camera_list)
+        # extract the rotation matrix (R) from the affine transform
+        scale, shear, angles, trans, persp = transformations.decompose_matrix(A)
+        print('  scale:', scale)
+        print('  shear:', shear)
+        print('  angles:', angles)
+        print('  translate:', trans)
+        print('  perspective:', persp)
+        R = transformations.euler_matrix(*angles)
+        print("R:\n{}".format(R))
 
-    # update position
-    for i, image in enumerate(proj.image_list):
-        if not image.name in group:
-            continue
-        ned, [y, p, r], quat = image.get_camera_pose(opt=True)
-        image.set_camera_pose(new_cams[i], y, p, r, opt=True)
-    proj.save_images_info()
+        # fixme (just group):
 
-    if True:
-        # update optimized pose orientation.
-        dist_report = []
+        # update the optimized camera locations based on best fit
+        camera_list = []
+        # load optimized poses
+        for image in proj.image_list:
+            if image.name in group:
+                ned, ypr, quat = image.get_camera_pose(opt=True)
+            else:
+                # this is just fodder to match size/index of the lists
+                ned, ypr, quat = image.get_camera_pose()
+            camera_list.append( ned )
+
+        # refit
+        new_cams = transform_points(A, camera_list)
+
+        # update position
         for i, image in enumerate(proj.image_list):
             if not image.name in group:
                 continue
-            ned_orig, ypr_orig, quat_orig = image.get_camera_pose()
-            ned, ypr, quat = image.get_camera_pose(opt=True)
-            Rbody2ned = image.get_body2ned(opt=True)
-            # update the orientation with the same transform to keep
-            # everything in proper consistent alignment
-
-            newRbody2ned = R[:3,:3].dot(Rbody2ned)
-            (yaw, pitch, roll) = transformations.euler_from_matrix(newRbody2ned, 'rzyx')
-            image.set_camera_pose(new_cams[i], yaw*r2d, pitch*r2d, roll*r2d,
-                                  opt=True)
-            dist = np.linalg.norm( np.array(ned_orig) - np.array(new_cams[i]))
-            print('image: {}'.format(image.name))
-            print('  orig pos: {}'.format(ned_orig))
-            print('  fit pos: {}'.format(new_cams[i]))
-            print('  dist moved: {}'.format(dist))
-            dist_report.append( (dist, image.name) )
+            ned, [y, p, r], quat = image.get_camera_pose(opt=True)
+            image.set_camera_pose(new_cams[i], y, p, r, opt=True)
         proj.save_images_info()
 
-        dist_report = sorted(dist_report,
-                             key=lambda fields: fields[0],
-                             reverse=False)
-        print('Image movement sorted lowest to highest:')
-        for report in dist_report:
-            print('{} dist: {}'.format(report[1], report[0]))
-
-    # tranform the optimized point locations using the same best
-    # fit transform for the camera locations.
-    new_feats = transform_points(A, features)
-
-    # update any of the transformed feature locations that have
-    # membership in the currently processing group back to the
-    # master match structure.  Note we process groups in order of
-    # little to big so if a match is in more than one group it
-    # follows the larger group.
-    for i, feat in enumerate(new_feats):
-        match_index = feat_index_map[i]
-        match = matches_opt[match_index]
-        in_group = False
-        for m in match[2:]:
-            if proj.image_list[m[0]].name in group:
-                in_group = True
-                break
-        if in_group:
-            #print(' before:', match)
-            match[0] = feat
-            #print(' after:', match)
+        if True:
+            # update optimized pose orientation.
+            dist_report = []
+            for i, image in enumerate(proj.image_list):
+                if not image.name in group:
+                    continue
+                ned_orig, ypr_orig, quat_orig = image.get_camera_pose()
+                ned, ypr, quat = image.get_camera_pose(opt=True)
+                Rbody2ned = image.get_body2ned(opt=True)
+                # update the orientation with the same transform to keep
+                # everything in proper consistent alignment
+
+                newRbody2ned = R[:3,:3].dot(Rbody2ned)
+                (yaw, pitch, roll) = transformations.euler_from_matrix(newRbody2ned, 'rzyx')
+                image.set_camera_pose(new_cams[i], yaw*r2d, pitch*r2d, roll*r2d,
+                                      opt=True)
+                dist = np.linalg.norm( np.array(ned_orig) - np.array(new_cams[i]))
+                print('image: {}'.format(image.name))
+                print('  orig pos: {}'.format(ned_orig))
+                print('  fit pos: {}'.format(new_cams[i]))
+                print('  dist moved: {}'.format(dist))
+                dist_report.append( (dist, image.name) )
+            proj.save_images_info()
+
+            dist_report = sorted(dist_report,
+                                 key=lambda fields: fields[0],
+                                 reverse=False)
+            print('Image movement sorted lowest to highest:')
+            for report in dist_report:
+                print('{} dist: {}'.format(report[1], report[0]))
+
+        # tranform the optimized point locations using the same best
+        # fit transform for the camera locations.
+        new_feats = transform_points(A, features)
+
+        # update any of the transformed feature locations that have
+        # membership in the currently processing group back to the
+        # master match structure.  Note we process groups in order of
+        # little to big so if a match is in more than one group it
+        # follows the larger group.
+        in_group = np.zeros(len(proj.image_list), dtype=bool)
+        for name in group:
+            in_group[proj.findIndexByName(name)] = True
+        track_in_group = np.bincount(tracks.obs_track(),
+                                     weights=in_group[tracks.obs_image],
+                                     minlength=len(tracks)) > 0
+        update = track_in_group[feat_index_map]
+        tracks.ned[feat_index_map[update]] = np.asarray(new_feats)[update]
+    else:
+        # not refitting group orientations, just copy over optimized
+        # coordinates
+        tracks.ned[feat_index_map] = features
+
+if args.all_groups:
+    group_list = list(range(len(groups)))
+else:
+    group_list = [ args.group ]
+
+# incremental runs do a full (refine) solve every --global-every runs
+incremental = args.incremental
+if incremental:
+    optimizer_node = getNode('/config/optimizer', True)
+    runs = optimizer_node.getInt('incremental_runs') + 1
+    if args.global_every > 0 and runs >= args.global_every:
+        print('Periodic global refinement')
+        incremental = False
+        args.refine = True
+        runs = 0
+    optimizer_node.setInt('incremental_runs', runs)
+
+if args.all_groups and args.jobs > 1:
+    print('Optimizing %d groups with %d worker processes'
+          % (len(group_list), args.jobs))
+    # the groups are independent so the whole solve takes about as
+    # long as the largest group
+    ctx = multiprocessing.get_context('fork')
+    pool = ctx.Pool(args.jobs)
+    try:
+        # start the biggest groups first
+        order = sorted(group_list, key=lambda g: len(groups[g]), reverse=True)
+        results = list(pool.imap_unordered(optimize_group, order))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
 else:
-    # not refitting group orientations, just copy over optimized
-    # coordinates
-    for i, feat in enumerate(features):
-        match_index = feat_index_map[i]
-        match = matches_opt[match_index]
-        match[0] = feat
+    results = [ optimize_group(g) for g in group_list ]
+
+results = [ r for r in results if r is not None ]
+
+# mark all the optimized poses as invalid (an incremental solve keeps
+# the previous poses)
+if not incremental:
+    for image in proj.image_list:
+        opt_cam_node = image.node.getChild('camera_pose_opt', True)
+        opt_cam_node.setBool('valid', False)
+
+# apply the results from the smallest to the largest group
+results.sort(key=lambda r: len(groups[r[0]]))
+for group_index, cameras, features, cam_index_map, feat_index_map, \
+    fx, fy, cu, cv, distCoeffs, culled_obs in results:
+    update_group(group_index, cameras, features, cam_index_map,
+                 feat_index_map, refit_group_orientations=not incremental)
+
+# remove the observations culled by the optimizer from the match set
+if args.cull_std > 0:
+    mark = np.zeros(tracks.num_obs(), dtype=bool)
+    for r in results:
+        mark[r[-1]] = True
+    print('Removing %d culled observations' % np.count_nonzero(mark))
+    matcher_node = getNode('/config/matcher', True)
+    min_chain_len = matcher_node.getInt("min_chain_len")
+    if min_chain_len == 0:
+        min_chain_len = 3
+    tracks = cull.delete_marked_obs(tracks, mark, min_chain_len)
+
+# the camera calibration comes from the largest group
+if len(results):
+    group_index, cameras, features, cam_index_map, feat_index_map, \
+        fx_opt, fy_opt, cu_opt, cv_opt, distCoeffs_opt, culled_obs = results[-1]
+    # update and save the optimized camera calibration
+    proj.cam.set_K(fx_opt, fy_opt, cu_opt, cv_opt, optimized=True)
+    proj.cam.set_dist_coeffs(distCoeffs_opt.tolist(), optimized=True)
+proj.save()
 
 # write out the updated match_dict
-print('Updating matches file:', len(matches_opt), 'features')
-pickle.dump(matches_opt, open(source_file, 'wb'))
+print('Updating matches file:', len(tracks), 'features')
+TrackStore.save(proj.analysis_dir, tracks, source)
 
 #proj.cam.set_K(fx_opt/scale[0], fy_opt/scale[0], cu_opt/scale[0], cv_opt/scale[0], optimized=True)
 #proj.save()
 
 # temp write out just the points so we can plot them with gnuplot
 f = open(os.path.join(proj.analysis_dir, 'opt-plot.txt'), 'w')
-for m in matches_opt:
-    f.write('%.2f %.2f %.2f\n' % (m[0][0], m[0][1], m[0][2]))
+for ned in tracks.ned:
+    f.write('%.2f %.2f %.2f\n' % (ned[0], ned[1], ned[2]))
 f.close()
 
 # temp write out direct and optimized camera positions
 f1 = open(os.path.join(proj.analysis_dir, 'cams-direct.txt'), 'w')
 f2 = open(os.path.join(proj.analysis_dir, 'cams-opt.txt'), 'w')
-for name in groups[args.group]:
+for name in [ name for g in group_list for name in groups[g] ]:
     image = proj.findImageByName(name)
     ned1, ypr1, quat1 = image.get_camera_pose()
     ned2, ypr2, quat2 = image.get_camera_pose(opt=True)
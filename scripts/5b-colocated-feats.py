@@ -5,12 +5,12 @@ import math
 import numpy as np
 import os.path
 from progress.bar import Bar
-import pickle
 
 from props import getNode
 
 from lib import Groups
 from lib import ProjectMgr
+from lib import TrackStore
 from lib import match_culling as cull
 
 r2d = 180.0 / math.pi
@@ -34,8 +34,8 @@ print("Notice: min_chain_len is:", min_chain_len)
 #source = 'matches_direct'
 source = 'matches_grouped'
 print("Loading matches:", source)
-matches = pickle.load( open( os.path.join(proj.analysis_dir, source), "rb" ) )
-print('Number of original features:', len(matches))
+tracks = TrackStore.load(proj.analysis_dir, source)
+print('Number of original features:', len(tracks))
 
 # load the group connections within the image set
 groups = Groups.load(proj.analysis_dir)
@@ -63,16 +63,17 @@ def compute_angle(ned1, ned2, ned3):
         return 0
 
 bar = Bar('Scanning match pair angles:', max=100)
-step = int(len(matches) / 100)
+step = int(len(tracks) / 100)
 #print("Scanning match pair angles...")
 mark_list = []
-for k, match in enumerate(matches):
-    if match[1] == args.group:  # used by current group
-        for i, m1 in enumerate(match[2:]):
-            for j, m2 in enumerate(match[2:]):
+for k in range(len(tracks)):
+    if tracks.group[k] == args.group:  # used by current group
+        images, uvs = tracks.obs(k)
+        for i, m1 in enumerate(images):
+            for j, m2 in enumerate(images):
                 if i < j:
-                    i1 = proj.image_list[m1[0]]
-                    i2 = proj.image_list[m2[0]]
+                    i1 = proj.image_list[m1]
+                    i2 = proj.image_list[m2]
                     if i1.name in groups[args.group] and i2.name in groups[args.group]:
                         ned1, ypr1, q1 = i1.get_camera_pose(opt=True)
                         ned2, ypr2, q2 = i2.get_camera_pose(opt=True)
@@ -81,10 +82,10 @@ for k, match in enumerate(matches):
                             # quick hack angle approximation
                             avg = (np.array(ned1) + np.array(ned2)) * 0.5
                             y = np.linalg.norm(np.array(ned2) - np.array(ned1))
-                            x = np.linalg.norm(avg - np.array(match[0]))
+                            x = np.linalg.norm(avg - tracks.ned[k])
                             angle_deg = math.atan2(y, x) * r2d
                         else:
-                            angle_deg = compute_angle(ned1, ned2, match[0]) * r2d
+                            angle_deg = compute_angle(ned1, ned2, tracks.ned[k]) * r2d
                         if angle_deg < args.min_angle:
                             mark_list.append( [k, i] )
     if (k+1) % step == 0:
@@ -97,7 +98,8 @@ bar.finish()
 # large changes in feature location.
 
 # mark selection
-cull.mark_using_list(mark_list, matches)
+mark = np.zeros(tracks.num_obs(), dtype=bool)
+cull.mark_obs_using_list(mark_list, tracks, mark)
 mark_sum = len(mark_list)
 
 mark_sum = len(mark_list)
@@ -105,8 +107,8 @@ if mark_sum > 0:
     print('Outliers to remove from match lists:', mark_sum)
     result = input('Save these changes? (y/n):')
     if result == 'y' or result == 'Y':
-        cull.delete_marked_features(matches, min_chain_len)
+        tracks = cull.delete_marked_obs(tracks, mark, min_chain_len)
         # write out the updated match dictionaries
         print("Writing original matches:", source)
-        pickle.dump(matches, open(os.path.join(proj.analysis_dir, source), "wb"))
+        TrackStore.save(proj.analysis_dir, tracks, source)
 
@@ -4,7 +4,6 @@
 # reprojection error
 
 import argparse
-import pickle
 import math
 import numpy as np
 import os
@@ -14,6 +13,7 @@ from props import getNode
 from lib import Groups
 from lib import Optimizer
 from lib import ProjectMgr
+from lib import TrackStore
 from lib import match_culling as cull
 
 parser = argparse.ArgumentParser(description='Keypoint projection.')
@@ -38,8 +38,8 @@ print("Notice: min_chain_len is:", min_chain_len)
 
 source = 'matches_grouped'
 print("Loading matches:", source)
-matches = pickle.load( open( os.path.join(proj.analysis_dir, source), "rb" ) )
-print('Number of original features:', len(matches))
+tracks = TrackStore.load(proj.analysis_dir, source)
+print('Number of original features:', len(tracks))
 
 # load the group connections within the image set
 groups = Groups.load(proj.analysis_dir)
@@ -50,13 +50,13 @@ print()
 
 opt = Optimizer.Optimizer(args.project)
 if args.initial_pose:
-    opt.setup( proj, groups, args.group, matches, optimized=False )
+    opt.setup( proj, groups, args.group, tracks, optimized=False )
 else:
-    opt.setup( proj, groups, args.group, matches, optimized=True )
+    opt.setup( proj, groups, args.group, tracks, optimized=True )
 x0 = np.hstack((opt.camera_params.ravel(), opt.points_3d.ravel(),
                 opt.K[0,0], opt.K[0,2], opt.K[1,2],
                 opt.distCoeffs))
-error = opt.fun(x0, opt.n_cameras, opt.n_points, opt.by_camera_point_indices, opt.by_camera_points_2d)
+error = opt.fun(x0, opt.n_cameras, opt.n_points, opt.camera_indices, opt.point_indices, opt.points_2d)
 
 print('cameras:', opt.n_cameras)
 
@@ -76,13 +76,13 @@ for i, cam in enumerate(opt.camera_params.reshape((opt.n_cameras, opt.ncp))):
     cam_errors = []
     # print(count, opt.by_camera_point_indices[i])
     for j in opt.by_camera_point_indices[i]:
-        match = matches[opt.feat_map_rev[j]]
+        images, uvs = tracks.obs(opt.feat_map_rev[j])
         match_index = 0
-        #print(orig_cam_index, match)
-        for k, p in enumerate(match[2:]):
-            if p[0] == orig_cam_index:
+        #print(orig_cam_index, images)
+        for k, m0 in enumerate(images):
+            if m0 == orig_cam_index:
                 match_index = k
-        # print(match[0], opt.points_3d[j*3:j*3+3])
+        # print(tracks.ned[opt.feat_map_rev[j]], opt.points_3d[j*3:j*3+3])
         e = error[count*2:count*2+2]
         #print(count, e, np.linalg.norm(e))
         #if abs(e[0]) > 5*std or abs(e[1]) > 5*std:
@@ -140,17 +140,18 @@ def mark_outliers(error_list, trim_stddev):
     for line in error_list:
         # print "line:", line
         if line[0] > mre + stddev * trim_stddev:
-            cull.mark_feature(matches, line[1], line[2], line[0])
+            cull.mark_obs(tracks, mark, line[1], line[2], line[0])
             mark_count += 1
             
     return mark_count
 
+mark = np.zeros(tracks.num_obs(), dtype=bool)
 if args.interactive:
     # interactively pick outliers
-    mark_list = cull.show_outliers(error_list, matches, proj.image_list)
+    mark_list = cull.show_outliers(error_list, tracks, proj.image_list)
 
     # mark selection
-    cull.mark_using_list(mark_list, matches)
+    cull.mark_obs_using_list(mark_list, tracks, mark)
     mark_sum = len(mark_list)
 else:
     # trim outliers by some # of standard deviations high
@@ -158,13 +159,10 @@ else:
 
 # after marking the bad matches, now count how many remaining features
 # show up in each image
-for i in proj.image_list:
-    i.feature_count = 0
-for i, match in enumerate(matches):
-    for j, p in enumerate(match[2:]):
-        if p[1] != [-1, -1]:
-            image = proj.image_list[ p[0] ]
-            image.feature_count += 1
+feature_count = np.bincount(tracks.obs_image[~mark],
+                            minlength=len(proj.image_list))
+for i, image in enumerate(proj.image_list):
+    image.feature_count = feature_count[i]
 
 purge_weak_images = False
 if purge_weak_images:
@@ -177,19 +175,16 @@ if purge_weak_images:
     print('weak images:', weak_dict)
 
     # mark any features in the weak images list
-    for i, match in enumerate(matches):
-        #print 'before:', match
-        for j, p in enumerate(match[2:]):
-            if p[0] in weak_dict:
-                 match[j+1] = [-1, -1]
-                 mark_sum += 1
+    weak = np.isin(tracks.obs_image, list(weak_dict)) & ~mark
+    mark |= weak
+    mark_sum += np.count_nonzero(weak)
 
 if mark_sum > 0:
     print('Outliers removed from match lists:', mark_sum)
     result = input('Save these changes? (y/n):')
     if result == 'y' or result == 'Y':
-        cull.delete_marked_features(matches, min_chain_len, strong=args.strong)
+        tracks = cull.delete_marked_obs(tracks, mark, min_chain_len, strong=args.strong)
         # write out the updated match dictionaries
         print("Writing:", source)
-        pickle.dump(matches, open(os.path.join(proj.analysis_dir, source), "wb"))
+        TrackStore.save(proj.analysis_dir, tracks, source)
 
@@ -4,13 +4,13 @@
 # blunt hammer when something is going wrong with that image
 
 import argparse
-import pickle
-import os
+import numpy as np
 
 from props import getNode
 
 from lib import Groups
 from lib import ProjectMgr
+from lib import TrackStore
 from lib import match_culling as cull
 
 parser = argparse.ArgumentParser(description='Remove all matches referencing the specific image.')
@@ -24,8 +24,8 @@ proj = ProjectMgr.ProjectMgr(args.project)
 proj.load_images_info()
 
 print("Loading matches_grouped...")
-matches = pickle.load( open( os.path.join(proj.analysis_dir, "matches_grouped"), "rb" ) )
-print("  features:", len(matches))
+tracks = TrackStore.load(proj.analysis_dir, "matches_grouped")
+print("  features:", len(tracks))
 
 # load the group connections within the image set
 groups = Groups.load(proj.analysis_dir)
@@ -37,18 +37,14 @@ if min_chain_len == 0:
     min_chain_len = 3
 print("Notice: min_chain_len is:", min_chain_len)
 
-def mark_image_features(index, matches):
-    # iterate through the match dictionary and mark any matches for
-    # the specified image for deletion
+def mark_image_features(index, tracks, mark):
+    # mark any observations of the specified image for deletion
     print("Marking feature matches for image:", index)
-    count = 0
-    new_matches = []
-    for i, match in enumerate(matches):
-        for j, p in enumerate(match[2:]):
-            if p[0] == index:
-                cull.mark_feature(matches, i, j, 0)
-                count += 1
-    return count
+    image_obs = tracks.obs_image == index
+    mark |= image_obs
+    return np.count_nonzero(image_obs)
+
+mark = np.zeros(tracks.num_obs(), dtype=bool)
 
 index = None
 count_split = 0
@@ -61,22 +57,22 @@ if not args.images is None:
         elif not name in groups[args.group]:
             print(name, "not in selected group.")
         else:
-            count = mark_image_features(index, matches)
+            count = mark_image_features(index, tracks, mark)
             groups[args.group].remove(name)
 elif not args.indices is None:
     for index in args.indices:
         if index >= len(proj.image_list):
             print("Index greater than image list size:", index)
         else:
-            count = mark_image_features(index, matches)
+            count = mark_image_features(index, tracks, mark)
             groups[args.group].remove(proj.image_list[index].name)
     
 if count > 0:
     print('Image removed from %d features.' % count)
     result = input('Save these changes? (y/n):')
     if result == 'y' or result == 'Y':
-        cull.delete_marked_features(matches, min_chain_len)
+        tracks = cull.delete_marked_obs(tracks, mark, min_chain_len)
         print("Updating groups file")
         Groups.save(proj.analysis_dir, groups)
         print("Writing: matches_grouped")
-        pickle.dump(matches, open(os.path.join(proj.analysis_dir, "matches_grouped"), "wb"))
+        TrackStore.save(proj.analysis_dir, tracks, "matches_grouped")
@@ -25,6 +25,7 @@ from lib import Panda3d
 from lib import Pose
 from lib import ProjectMgr
 from lib import SRTM
+from lib import TrackStore
 from lib import transformations
 
 ac3d_steps = 8
@@ -50,43 +51,42 @@ ref = [ ref_node.getFloat('lat_deg'),
         ref_node.getFloat('alt_m') ]
   
 # setup SRTM ground interpolator
-sss = SRTM.NEDGround( ref, 6000, 6000, 30 )
+sss = SRTM.DEMTiles( ref, 30 )
 
 print("Loading optimized match points ...")
-matches = pickle.load( open( os.path.join(proj.analysis_dir, "matches_grouped"), "rb" ) )
+tracks = TrackStore.load(proj.analysis_dir, "matches_grouped")
 
 # load the group connections within the image set
 groups = Groups.load(proj.analysis_dir)
 
-# initialize temporary structures for vanity stats
-for image in proj.image_list:
-    image.sum_values = 0.0
-    image.sum_count = 0.0
-    image.max_z = -9999.0
-    image.min_z = 9999.0
-
 # sort through points
 print('Reading feature locations from optimized match points ...')
-raw_points = []
-raw_values = []
-for match in matches:
-    if match[1] == args.group:  # used by current group
-        ned = match[0]
-        # print("ned:", ned)
-        raw_points.append( [ned[1], ned[0]] )
-        raw_values.append( ned[2] )
-        for m in match[2:]:
-            if proj.image_list[m[0]].name in groups[args.group]:
-                image = proj.image_list[ m[0] ]
-                z = -ned[2]
-                image.sum_values += z
-                image.sum_count += 1
-                if z < image.min_z:
-                    image.min_z = z
-                    #print(min_z, match)
-                if z > image.max_z:
-                    image.max_z = z
-                    #print(max_z, match)
+in_group = tracks.group == args.group # used by current group
+group_ned = tracks.ned[in_group]
+raw_points = group_ned[:,[1,0]].tolist()
+raw_values = group_ned[:,2].tolist()
+
+# per image feature elevation stats (observations of the current
+# group features in the current group images)
+group_images = np.zeros(len(proj.image_list), dtype=bool)
+for name in groups[args.group]:
+    group_images[proj.findIndexByName(name)] = True
+obs_track = tracks.obs_track()
+sel = np.nonzero(in_group[obs_track] & group_images[tracks.obs_image])[0]
+obs_z = -tracks.ned[obs_track[sel],2]
+obs_img = tracks.obs_image[sel]
+n = len(proj.image_list)
+sum_values = np.bincount(obs_img, weights=obs_z, minlength=n)
+sum_count = np.bincount(obs_img, minlength=n)
+max_z = np.full(n, -9999.0)
+np.maximum.at(max_z, obs_img, obs_z)
+min_z = np.full(n, 9999.0)
+np.minimum.at(min_z, obs_img, obs_z)
+for i, image in enumerate(proj.image_list):
+    image.sum_values = sum_values[i]
+    image.sum_count = float(sum_count[i])
+    image.max_z = max_z[i]
+    image.min_z = min_z[i]
 # save the surface definition as a separate file
 models_dir = os.path.join(proj.analysis_dir, 'models')
 if not os.path.exists(models_dir):
@@ -1,7 +1,6 @@
 #!/usr/bin/python3
 
 import argparse
-import pickle
 import cv2
 import fnmatch
 import itertools
@@ -17,6 +16,7 @@ from lib import Matcher
 from lib import Pose
 from lib import ProjectMgr
 from lib import SRTM
+from lib import TrackStore
 from lib import transformations
 
 parser = argparse.ArgumentParser(description='Compute Delauney triangulation of matches.')
@@ -57,7 +57,7 @@ proj = ProjectMgr.ProjectMgr(args.project)
 proj.load_images_info()
 
 print("Loading optimized points ...")
-matches = pickle.load( open( os.path.join(proj.analysis_dir, "matches_grouped"), "rb" ) )
+tracks = TrackStore.load(proj.analysis_dir, "matches_grouped")
 
 # load the group connections within the image set
 groups = Groups.load(proj.analysis_dir)
@@ -77,13 +77,9 @@ for image in proj.image_list:
 
 # sort through points
 print('Reading feature locations from optimized match points ...')
-global_raw_points = []
-global_raw_values = []
-for match in matches:
-    if match[1] == args.group:  # used by current group
-        ned = match[0]
-        global_raw_points.append( [ned[1], ned[0]] )
-        global_raw_values.append( -ned[2] )
+group_ned = tracks.ned[tracks.group == args.group] # used by current group
+global_raw_points = group_ned[:,[1,0]].tolist()
+global_raw_values = (-group_ned[:,2]).tolist()
 
 print('Generating Delaunay meshes ...')
 global_tri_list = scipy.spatial.Delaunay(np.array(global_raw_points))
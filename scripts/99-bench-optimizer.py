@@ -0,0 +1,169 @@
+#!/usr/bin/python3
+
+# Benchmark the optimizer residual function on a synthetic bundle (no
+# project needed.)  Compares the batched numpy projection in
+# Optimizer.fun() against the original per camera cv2.projectPoints()
+# loop and reports the time per evaluation.  With --solve, also runs
+# the least squares solver on a perturbed copy of the bundle with the
+# analytic jacobian and with the finite difference jacobian, and the
+# Schur complement solver (direct and conjugate gradient.)
+
+import argparse
+import cv2
+import numpy as np
+from scipy.optimize import least_squares
+import time
+
+from lib import Optimizer
+
+parser = argparse.ArgumentParser(description='Optimizer residual benchmark.')
+parser.add_argument('--cameras', type=int, default=200, help='number of cameras')
+parser.add_argument('--points', type=int, default=50000, help='number of 3d points')
+parser.add_argument('--obs-per-point', type=int, default=4, help='observations per point')
+parser.add_argument('--evals', type=int, default=20, help='number of evaluations to time')
+parser.add_argument('--calib', default='none', choices=['none', 'global'])
+parser.add_argument('--solve', action='store_true', help='also time a full solve')
+args = parser.parse_args()
+
+# build a synthetic survey: a grid of nadir cameras at 100m over a
+# slightly bumpy surface, each point seen by a few nearby cameras.
+def synthetic_bundle(n_cameras, n_points, obs_per_point):
+    rng = np.random.default_rng(0)
+    K = np.array( [[1200.0, 0, 960.0],
+                   [0, 1200.0, 540.0],
+                   [0, 0, 1]] )
+    distCoeffs = np.array([-0.12, 0.05, 0.001, -0.0005, 0.0])
+    side = int(np.ceil(np.sqrt(n_cameras)))
+    cam_ned = np.zeros((n_cameras, 3))
+    cam_ned[:,0] = (np.arange(n_cameras) // side) * 30.0
+    cam_ned[:,1] = (np.arange(n_cameras) % side) * 30.0
+    cam_ned[:,2] = -100.0
+    camera_params = np.zeros((n_cameras, 6))
+    for i in range(n_cameras):
+        # camera z axis points down, small random attitude error
+        R = np.array( [[0, 1, 0],
+                       [-1, 0, 0],
+                       [0, 0, 1]], dtype=float )
+        rvec, jac = cv2.Rodrigues(R)
+        rvec = rvec.ravel() + rng.normal(0, 0.02, 3)
+        R, jac = cv2.Rodrigues(rvec)
+        camera_params[i,0:3] = rvec
+        camera_params[i,3:6] = -R.dot(cam_ned[i])
+    home = rng.integers(0, n_cameras, n_points)
+    points_3d = cam_ned[home] + rng.normal(0, 15.0, (n_points, 3))
+    points_3d[:,2] = rng.normal(0, 2.0, n_points)
+    # pick the observing cameras near each point's home camera
+    near = home[:,np.newaxis] + rng.integers(-2, 3, (n_points, obs_per_point))
+    near = np.clip(near, 0, n_cameras - 1)
+    camera_indices = near.ravel()
+    point_indices = np.repeat(np.arange(n_points), obs_per_point)
+    order = np.argsort(camera_indices, kind='stable')
+    return K, distCoeffs, camera_params, points_3d, \
+        camera_indices[order], point_indices[order]
+
+# the original per camera residual loop (including the per call
+# diagnostics, minus the printing)
+def legacy_fun(opt, params, n_cameras, n_points, by_camera_point_indices,
+               by_camera_points_2d):
+    camera_params, points_3d, K, distCoeffs = \
+        opt.unpack_params(params, n_cameras, n_points)
+    error = None
+    by_cam = []
+    for i, cam in enumerate(camera_params):
+        if len(by_camera_point_indices[i]) == 0:
+            continue
+        proj_points, jac = cv2.projectPoints(points_3d[by_camera_point_indices[i]], cam[:3], cam[3:6], K, distCoeffs)
+        cam_error = (by_camera_points_2d[i] - proj_points).ravel()
+        by_cam.append( [np.mean(np.abs(cam_error)),
+                        np.amax(np.abs(cam_error)), i] )
+        if error is None:
+            error = cam_error
+        else:
+            error = np.append(error, cam_error)
+    mre = np.mean(np.abs(error))
+    std = np.std(error)
+    count_std = 0
+    for e in error.tolist():
+        if e > mre + 3 * std:
+            count_std += 1
+    by_cam = sorted(by_cam, key=lambda fields: fields[0], reverse=True)
+    return error
+
+K, distCoeffs, camera_params, points_3d, camera_indices, point_indices = \
+    synthetic_bundle(args.cameras, args.points, args.obs_per_point)
+print('cameras: %d points: %d observations: %d'
+      % (args.cameras, args.points, len(camera_indices)))
+
+opt = Optimizer.Optimizer('.')
+opt.optimize_calib = args.calib
+opt.K = K
+opt.distCoeffs = distCoeffs
+opt.camera_map_fwd = { i: i for i in range(args.cameras) }
+n_cameras = args.cameras
+n_points = args.points
+if opt.optimize_calib == 'global':
+    x0 = np.hstack((camera_params.ravel(), points_3d.ravel(),
+                    K[0,0], K[0,2], K[1,2], distCoeffs))
+else:
+    x0 = np.hstack((camera_params.ravel(), points_3d.ravel()))
+
+# noisy observations
+uv = opt.project(camera_params, points_3d, K, distCoeffs,
+                 camera_indices, point_indices)
+points_2d = uv + np.random.default_rng(1).normal(0, 0.5, uv.shape)
+by_camera_point_indices = []
+by_camera_points_2d = []
+for i in range(n_cameras):
+    idx = camera_indices == i
+    by_camera_point_indices.append(point_indices[idx])
+    by_camera_points_2d.append(points_2d[idx].reshape(-1, 1, 2))
+
+e1 = legacy_fun(opt, x0, n_cameras, n_points, by_camera_point_indices,
+                by_camera_points_2d)
+e2 = opt.fun(x0, n_cameras, n_points, camera_indices, point_indices, points_2d)
+print('max residual difference vs cv2.projectPoints(): %.2e' % np.amax(np.abs(e1 - e2)))
+
+t0 = time.time()
+for i in range(args.evals):
+    legacy_fun(opt, x0, n_cameras, n_points, by_camera_point_indices,
+               by_camera_points_2d)
+t1 = time.time()
+opt.last_mre = 1e-9             # suppress the progress reports
+for i in range(args.evals):
+    opt.fun(x0, n_cameras, n_points, camera_indices, point_indices, points_2d)
+t2 = time.time()
+legacy = (t1 - t0) / args.evals
+batched = (t2 - t1) / args.evals
+print('per camera loop: %.1f msec/eval' % (1000 * legacy))
+print('batched numpy:   %.1f msec/eval (%.1fx)' % (1000 * batched, legacy / batched))
+
+if args.solve:
+    rng = np.random.default_rng(2)
+    cams = camera_params + np.hstack( (rng.normal(0, 0.002, (n_cameras, 3)),
+                                       rng.normal(0, 0.5, (n_cameras, 3))) )
+    pts = points_3d + rng.normal(0, 0.5, points_3d.shape)
+    if opt.optimize_calib == 'global':
+        x1 = np.hstack((cams.ravel(), pts.ravel(),
+                        K[0,0], K[0,2], K[1,2], distCoeffs))
+    else:
+        x1 = np.hstack((cams.ravel(), pts.ravel()))
+    A = opt.bundle_adjustment_sparsity(n_cameras, n_points,
+                                       camera_indices, point_indices)
+    fun_args = (n_cameras, n_points, camera_indices, point_indices, points_2d)
+    for name, jac in ( ('analytic', opt.jac), ('finite difference', '2-point') ):
+        opt.last_mre = 1e-9
+        t0 = time.time()
+        res = least_squares(opt.fun, x1, jac=jac, jac_sparsity=A,
+                            method='trf', ftol=opt.ftol, x_scale='jac',
+                            args=fun_args)
+        print('%s jacobian: %.1f sec, %d evals, %d jacobians, final mre: %.3f'
+              % (name, time.time() - t0, res.nfev, res.njev,
+                 np.mean(np.abs(res.fun))))
+    for schur_solver in ('direct', 'cg'):
+        opt.last_mre = 1e-9
+        opt.schur_solver = schur_solver
+        t0 = time.time()
+        res = opt.solve_schur(x1, *fun_args)
+        print('schur (%s): %.1f sec, %d evals, %d jacobians, final mre: %.3f'
+              % (schur_solver, time.time() - t0, res.nfev, res.njev,
+                 np.mean(np.abs(res.fun))))
@@ -0,0 +1,62 @@
+#!/usr/bin/python3
+
+# Benchmark the ray / terrain intersection on a synthetic surface (no
+# project or srtm tiles needed.)  Compares the batch intersector
+# (NEDGround.intersect_vectors()) against the original one vector at a
+# time interpolate_vector() loop and reports the largest difference.
+
+import argparse
+import numpy as np
+import scipy.interpolate
+import time
+
+from lib import SRTM
+
+parser = argparse.ArgumentParser(description='Ray intersection benchmark.')
+parser.add_argument('--rays', type=int, default=10000, help='number of rays')
+parser.add_argument('--cameras', type=int, default=10, help='number of camera poses')
+args = parser.parse_args()
+
+# rolling hills on a 6000m x 6000m, 30m grid
+step = 30
+n_list = np.arange(-3000, 3000 + step, step, dtype=float)
+e_list = np.arange(-3000, 3000 + step, step, dtype=float)
+nn, ee = np.meshgrid(n_list, e_list, indexing='ij')
+elev = 300 + 20 * np.sin(nn / 400.0) * np.cos(ee / 250.0) + 0.01 * nn
+
+# the ground model without loading any dem tiles
+sss = SRTM.NEDGround.__new__(SRTM.NEDGround)
+sss.tile_dict = {}
+sss.interp = scipy.interpolate.RegularGridInterpolator((n_list, e_list), elev, bounds_error=False, fill_value=-32768)
+
+# cameras 100m above the terrain looking roughly down
+rng = np.random.default_rng(0)
+cams = np.zeros((args.cameras, 3))
+cams[:,0:2] = rng.uniform(-2000, 2000, (args.cameras, 2))
+cams[:,2] = -(sss.interp(cams[:,0:2]) + 100)
+cam_index = rng.integers(0, args.cameras, args.rays)
+v = np.zeros((args.rays, 3))
+v[:,0:2] = rng.normal(0, 0.4, (args.rays, 2))
+v[:,2] = 1.0
+v /= np.linalg.norm(v, axis=1)[:,np.newaxis]
+
+t0 = time.time()
+ref = np.array( [ sss.interpolate_vector(cams[c].tolist(), v[i])
+                  for i, c in enumerate(cam_index) ] )
+t1 = time.time()
+# one batch per camera (the usual per image call)
+batch = np.zeros((args.rays, 3))
+for c in range(args.cameras):
+    idx = np.nonzero(cam_index == c)[0]
+    batch[idx] = sss.intersect_vectors(cams[c], v[idx])
+t2 = time.time()
+# all the rays of all the cameras at once
+together = sss.intersect_vectors(cams[cam_index], v)
+t3 = time.time()
+
+print('rays: %d cameras: %d' % (args.rays, args.cameras))
+print('max difference: per camera batch: %.2e all rays: %.2e'
+      % (np.amax(np.abs(batch - ref)), np.amax(np.abs(together - ref))))
+print('one vector at a time: %.3f sec' % (t1 - t0))
+print('batch per camera:     %.3f sec (%.0fx)' % (t2 - t1, (t1 - t0) / (t2 - t1)))
+print('batch all rays:       %.3f sec (%.0fx)' % (t3 - t2, (t1 - t0) / (t3 - t2)))
@@ -0,0 +1,95 @@
+#!/usr/bin/python3
+
+# Convert the legacy gzip compressed meta/*.desc descriptor files to
+# uncompressed (memory mappable) meta/*.desc.npy files.  Reports the
+# time to load each format so the difference can be compared on the
+# actual project data.
+#
+# Also converts legacy pickled meta/*.feat keypoint files to the
+# columnar meta/*.feat.npy format.
+
+import argparse
+import numpy as np
+import os
+import time
+from progress.bar import Bar
+
+from lib import Image
+from lib import ProjectMgr
+
+parser = argparse.ArgumentParser(description='Migrate descriptor files to the memory mapped format.')
+parser.add_argument('--project', required=True, help='project directory')
+parser.add_argument('--remove', action='store_true',
+                    help='remove the legacy .desc/.feat files after conversion')
+args = parser.parse_args()
+
+proj = ProjectMgr.ProjectMgr(args.project)
+proj.load_images_info()
+
+feat_count = 0
+bar = Bar('Migrating keypoints:', max=len(proj.image_list))
+for image in proj.image_list:
+    if os.path.exists(image.features_file):
+        if not os.path.exists(image.features_npy_file):
+            image.load_features()
+            if image.num_features() > 0:
+                image.save_features()
+                feat_count += 1
+            # release the keypoints (only one image in memory at a time)
+            image.kp_array = np.zeros(0, dtype=Image.kp_dtype)
+        if args.remove and os.path.exists(image.features_npy_file):
+            os.remove(image.features_file)
+    bar.next()
+bar.finish()
+print('Converted keypoint files:', feat_count)
+
+count = 0
+gzip_time = 0.0
+mmap_time = 0.0
+total_bytes = 0
+bar = Bar('Migrating descriptors:', max=len(proj.image_list))
+for image in proj.image_list:
+    if not os.path.exists(image.des_file):
+        bar.next()
+        continue
+
+    # legacy path (full decompression)
+    image.des_list = None
+    t0 = time.time()
+    image.load_descriptors_gzip()
+    gzip_time += time.time() - t0
+    if image.des_list is None:
+        bar.next()
+        continue
+    des = image.des_list
+
+    image.save_descriptors()
+
+    # memory mapped path (touch every page so this is a fair
+    # comparison and not just the time to map the file.)
+    image.des_list = None
+    t0 = time.time()
+    image.load_descriptors()
+    np.sum(image.des_list)
+    mmap_time += time.time() - t0
+
+    if not np.array_equal(des, image.des_list):
+        print('Error: converted descriptors differ for:', image.name)
+        os.remove(image.des_npy_file)
+        image.des_list = None
+        bar.next()
+        continue
+    total_bytes += des.nbytes
+    image.des_list = None
+    count += 1
+    if args.remove:
+        os.remove(image.des_file)
+    bar.next()
+bar.finish()
+
+print('Converted descriptor files:', count)
+if count:
+    print('Total descriptor data: %.1f MB' % (total_bytes / (1024.0*1024.0)))
+    print('gzip load time: %.3f sec (%.1f msec/image)' % (gzip_time, 1000.0 * gzip_time / count))
+    print('mmap load time: %.3f sec (%.1f msec/image)' % (mmap_time, 1000.0 * mmap_time / count))
+    print('Note: mmap times include reading through the os page cache, so a second run will be faster still.')
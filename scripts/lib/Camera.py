@@ -1,9 +1,95 @@
 #!/usr/bin/python
 
+from collections import OrderedDict
+import cv2
 import numpy as np
 
 from props import getNode
 
+# vectorized camera model.  All of these work on (n x 2) pixel arrays
+# (or (n x 3) camera frame rays) with an explicit K and dist_coeffs
+# (k1, k2, p1, p2, k3), the Camera class below wraps them with the
+# project calibration.
+
+# apply the lens distortion to undistorted pixel coordinates (the
+# forward opencv distortion model)
+def distort_points(uv, K, dist_coeffs):
+    uv = np.asarray(uv, dtype=np.float64).reshape(-1, 2)
+    fx = K[0,0]
+    fy = K[1,1]
+    cx = K[0,2]
+    cy = K[1,2]
+    k1, k2, p1, p2, k3 = dist_coeffs
+    x = (uv[:,0] - cx) / fx
+    y = (uv[:,1] - cy) / fy
+    r2 = x*x + y*y
+    # radial factor and tangential distortion
+    Lr = 1.0 + r2*(k1 + r2*(k2 + r2*k3))
+    dx = 2*p1*x*y + p2*(r2 + 2*x*x)
+    dy = p1*(r2 + 2*y*y) + 2*p2*x*y
+    return np.vstack( ((Lr*x + dx) * fx + cx, (Lr*y + dy) * fy + cy) ).T
+
+# remove the lens distortion from (original) pixel coordinates.
+# float32 input stays float32 (keypoint coordinates), anything else is
+# computed in float64.
+def undistort_points(uv, K, dist_coeffs):
+    uv = np.asarray(uv)
+    if uv.dtype != np.float32:
+        uv = uv.astype(np.float64)
+    if len(uv) == 0:
+        return uv.reshape(0, 2)
+    uv_new = cv2.undistortPoints(uv.reshape(-1, 1, 2), K,
+                                 np.asarray(dist_coeffs, dtype=np.float64),
+                                 P=K)
+    return uv_new.reshape(-1, 2)
+
+# unit length camera frame rays (x right, y down, z forward) through
+# the given pixels (undistorted first if dist_coeffs are given)
+def pixels_to_rays(uv, K, dist_coeffs=None):
+    if dist_coeffs is not None:
+        uv = undistort_points(uv, K, dist_coeffs)
+    uv = np.asarray(uv, dtype=np.float64).reshape(-1, 2)
+    uvh = np.hstack( (uv, np.ones((len(uv), 1))) )
+    rays = uvh.dot(np.linalg.inv(K).T)
+    return rays / np.linalg.norm(rays, axis=1)[:,np.newaxis]
+
+# pixel coordinates of camera frame rays (distorted if dist_coeffs are
+# given.)  Rays at or behind the camera plane come back as nan.
+def rays_to_pixels(rays, K, dist_coeffs=None):
+    rays = np.asarray(rays, dtype=np.float64).reshape(-1, 3)
+    z = np.where(rays[:,2] > 0, rays[:,2], np.nan)
+    uvh = np.vstack( (rays[:,0] / z, rays[:,1] / z, np.ones(len(rays))) ).T
+    uv = uvh.dot(K.T)[:,0:2]
+    if dist_coeffs is not None:
+        uv = distort_points(uv, K, dist_coeffs)
+    return uv
+
+# undistortion remap tables, cached by calibration and image size
+# (least recently used first)
+map_cache = OrderedDict()
+max_maps = 4
+
+def undistort_maps(K, dist_coeffs, width, height):
+    K = np.asarray(K, dtype=np.float64)
+    dist_coeffs = np.asarray(dist_coeffs, dtype=np.float64)
+    key = (K.tobytes(), dist_coeffs.tobytes(), width, height)
+    if key in map_cache:
+        map_cache.move_to_end(key)
+        return map_cache[key]
+    maps = cv2.initUndistortRectifyMap(K, dist_coeffs, None, K,
+                                       (width, height), cv2.CV_16SC2)
+    map_cache[key] = maps
+    while len(map_cache) > max_maps:
+        map_cache.popitem(last=False)
+    return maps
+
+# same result as cv2.undistort() but the remap tables are only built
+# once per calibration/size
+def undistort_image(img, K, dist_coeffs):
+    h, w = img.shape[:2]
+    map1, map2 = undistort_maps(K, dist_coeffs, w, h)
+    return cv2.remap(img, map1, map2, cv2.INTER_LINEAR)
+
 # camera parameters are stored in the global property tree, but this
 # class provides convenient getter/setter functions
 
@@ -100,6 +186,28 @@ class Camera():
                 tmp.append( self.camera_node.getFloatEnum('dist_coeffs', i) )
         return np.array(tmp)
     
+    # vectorized projection with the project calibration (see the
+    # module functions above)
+    def distort(self, uv, optimized=False):
+        return distort_points(uv, self.get_K(optimized),
+                              self.get_dist_coeffs(optimized))
+
+    def undistort(self, uv, optimized=False):
+        return undistort_points(uv, self.get_K(optimized),
+                                self.get_dist_coeffs(optimized))
+
+    def pixel_to_ray(self, uv, optimized=False):
+        return pixels_to_rays(uv, self.get_K(optimized),
+                              self.get_dist_coeffs(optimized))
+
+    def ray_to_pixel(self, rays, optimized=False):
+        return rays_to_pixels(rays, self.get_K(optimized),
+                              self.get_dist_coeffs(optimized))
+
+    def undistort_image(self, img, optimized=False):
+        return undistort_image(img, self.get_K(optimized),
+                               self.get_dist_coeffs(optimized))
+
     def set_dist_coeffs(self, dist_coeffs, optimized=False):
         if optimized:
             self.camera_node.setLen('dist_coeffs_opt', 5)
@@ -0,0 +1,53 @@
+# DescriptorCache.py - keep a bounded (in bytes) set of image
+# descriptors loaded in memory, evicting the least recently used
+# images first.
+
+from collections import OrderedDict
+
+class DescriptorCache():
+    def __init__(self, max_bytes=2048*1024*1024):
+        self.max_bytes = max_bytes
+        self.lru = OrderedDict() # image name -> [image, nbytes]
+        self.total_bytes = 0
+        self.loads = 0
+        self.evictions = 0
+
+    # make sure the descriptors are loaded for all the requested
+    # images, then evict older images until we are back within the
+    # byte budget.  Images in the current request are never evicted
+    # (even if they alone exceed the budget.)
+    def load(self, *images):
+        for image in images:
+            if image.name in self.lru:
+                self.lru.move_to_end(image.name)
+                if not image.des_list is None:
+                    continue
+                # descriptors were cleared behind our back
+                self.total_bytes -= self.lru[image.name][1]
+            image.load_descriptors()
+            self.loads += 1
+            if image.des_list is None:
+                nbytes = 0
+            else:
+                nbytes = image.des_list.nbytes
+            self.lru[image.name] = [image, nbytes]
+            self.total_bytes += nbytes
+        keep = len(images)
+        while self.total_bytes > self.max_bytes and len(self.lru) > keep:
+            name, (image, nbytes) = self.lru.popitem(last=False)
+            image.des_list = None
+            self.total_bytes -= nbytes
+            self.evictions += 1
+
+    # release all cached descriptors
+    def clear(self):
+        for name in self.lru:
+            self.lru[name][0].des_list = None
+        self.lru = OrderedDict()
+        self.total_bytes = 0
+
+    def report(self):
+        print('descriptor cache: %d images, %.1f/%.1f MB, %d loads, %d evictions'
+              % (len(self.lru), self.total_bytes / (1024.0*1024.0),
+                 self.max_bytes / (1024.0*1024.0),
+                 self.loads, self.evictions))
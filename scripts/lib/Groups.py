@@ -14,16 +14,16 @@ min_group = 10
 min_connections = 25
 max_wanted = 250                # possibly overridden later
 
-def my_add(placed_matches, matches, group_level, i):
+def my_add(placed_matches, tracks, track_images, group_level, i):
     # print("adding feature:", i)
-    for m in matches[i][2:]:
-        placed_matches[m[0]] += 1
-    matches[i][1] = group_level
+    for m0 in track_images[i]:
+        placed_matches[m0] += 1
+    tracks.group[i] = group_level
         
 # NEW GROUPING TEST
-def compute(image_list, matches):
-    # notice: we assume that matches have been previously sorted by
-    # longest chain first!
+def compute(image_list, tracks):
+    # notice: we assume that matches (tracks) have been previously
+    # sorted by longest chain first!
     
     print("Start of new test grouping algorithm...")
 
@@ -34,6 +34,15 @@ def compute(image_list, matches):
     print("/config/matcher/min_chain_len:", min_chain_len)
     use_single_pairs = (min_chain_len == 2)
 
+    # image indices referenced by each track (sliced out once, the
+    # loops below revisit every track many times.)
+    obs_image = tracks.obs_image.tolist()
+    offsets = tracks.offsets.tolist()
+    track_images = [ obs_image[offsets[i]:offsets[i+1]]
+                     for i in range(len(tracks)) ]
+    obs_track = tracks.obs_track()
+    track_len = tracks.track_len()
+
     max_wanted = int(10000 / math.sqrt(len(image_list)))
     if max_wanted < 100:
         max_wanted = 100
@@ -41,8 +50,7 @@ def compute(image_list, matches):
     print("Notice: I should really work on this formula ...")
     
     # mark all features as unaffiliated
-    for match in matches:
-        match[1] = -1
+    tracks.group[:] = -1
         
     # start with no placed images or features
     placed_images = set()
@@ -57,28 +65,24 @@ def compute(image_list, matches):
         
         # find the unused feature with the most connections to
         # unplaced images
+        placed = np.zeros(len(image_list), dtype=bool)
+        placed[list(placed_images)] = True
+        num_placed = np.bincount(obs_track, weights=placed[tracks.obs_image],
+                                 minlength=len(tracks))
+        count = track_len - num_placed
+        count[(tracks.group >= 0) | (num_placed > 0)] = 0
         max_connections = 2
         seed_index = -1
-        for i, match in enumerate(matches):
-            if match[1] < 0:
-                count = 0
-                connected = False
-                for m in match[2:]:
-                    if m[0] in placed_images:
-                        connected = True
-                    else:
-                        count += 1
-                if not connected and count > max_connections:
-                    max_connections = count
-                    seed_index = i
+        if len(count) and np.amax(count) > max_connections:
+            seed_index = int(np.argmax(count))
+            max_connections = int(count[seed_index])
         if seed_index == -1:
             break
         print("Seed index:", seed_index, "connections:", max_connections)
-        match = matches[seed_index]
-        m = match[3]            # first image referenced by match
-        # group_images.add(m[0])
-        my_add(placed_matches, matches, group_level, seed_index)
-        seed_image = m[0]
+        # first image referenced by match
+        seed_image = track_images[seed_index][1]
+        # group_images.add(seed_image)
+        my_add(placed_matches, tracks, track_images, group_level, seed_index)
         print('Seeding group with:', image_list[seed_image].name)
 
         still_working = True
@@ -86,32 +90,33 @@ def compute(image_list, matches):
         while still_working:
             print("Iteration:", iteration)
             still_working = False
-            for i, match in enumerate(matches):
-                if match[1] < 0 and (use_single_pairs or len(match[2:]) > 2):
+            group = tracks.group
+            for i, images in enumerate(track_images):
+                if group[i] < 0 and (use_single_pairs or len(images) > 2):
                     # determine if we should add this feature
                     placed_count = 0
                     placed_need_count = 0
                     unplaced_count = 0
                     seed_connection = False
-                    for m in match[2:]:
-                        if m[0] in placed_images:
+                    for m0 in images:
+                        if m0 in placed_images:
                             # placed in a previous grouping, skip
                             continue
-                        if m[0] == seed_image:
+                        if m0 == seed_image:
                             seed_connection = True
-                        if placed_matches[m[0]] >= max_wanted:
+                        if placed_matches[m0] >= max_wanted:
                             placed_count += 1
-                        elif placed_matches[m[0]] >= min_connections:
+                        elif placed_matches[m0] >= min_connections:
                             placed_count += 1
                             placed_need_count += 1
-                        elif placed_matches[m[0]] > 0:
+                        elif placed_matches[m0] > 0:
                             placed_need_count += 1
                         else:
                             unplaced_count += 1
                     # print("Match:", i, placed_count, seed_connection, placed_need_count, unplaced_count)
                     if placed_count > 1 or seed_connection:
                         if placed_need_count > 0 or unplaced_count > 0:
-                            my_add(placed_matches, matches, group_level, i)
+                            my_add(placed_matches, tracks, track_images, group_level, i)
                             still_working = True
             iteration += 1
             
@@ -131,6 +136,26 @@ def compute(image_list, matches):
             done = True
     return groups
 
+# grow a set of image indices through the match graph: each ring adds
+# the images that share at least min_shared tracks with the current
+# set.  Returns the expanded set.
+def neighborhood(tracks, num_images, images, rings=1,
+                 min_shared=min_connections):
+    result = set(images)
+    obs_track = tracks.obs_track()
+    for r in range(rings):
+        in_set = np.zeros(num_images, dtype=bool)
+        in_set[list(result)] = True
+        touches = np.bincount(obs_track, weights=in_set[tracks.obs_image],
+                              minlength=len(tracks)) > 0
+        shared = np.bincount(tracks.obs_image[touches[obs_track]],
+                             minlength=num_images)
+        grow = set(np.nonzero(shared >= min_shared)[0].tolist()) - result
+        if not grow:
+            break
+        result |= grow
+    return result
+
 def save(path, groups):
     file = os.path.join(path, 'groups.json')
     try:
@@ -7,11 +7,14 @@ import cv2
 import gzip
 import json
 import math
+from multiprocessing.pool import ThreadPool
 #from matplotlib import pyplot as plt
 import navpy
 import numpy as np
 import os.path
+import struct
 import sys
+import threading
 
 from props import getNode
 
@@ -19,6 +22,79 @@ from . import transformations
 
 
 d2r = math.pi / 180.0           # a helpful constant
+
+# columnar (structured array) layout of the keypoint attributes we
+# save for each feature
+kp_dtype = np.dtype([ ('x', np.float32), ('y', np.float32),
+                      ('size', np.float32), ('angle', np.float32),
+                      ('response', np.float32), ('octave', np.int32),
+                      ('class_id', np.int32) ])
+
+# convert a list of opencv keypoints to a kp_dtype structured array
+def keypoints_to_array(kp_list):
+    kp_array = np.empty(len(kp_list), dtype=kp_dtype)
+    for i, kp in enumerate(kp_list):
+        kp_array[i] = (kp.pt[0], kp.pt[1], kp.size, kp.angle,
+                       kp.response, kp.octave, kp.class_id)
+    return kp_array
+
+# convert a kp_dtype structured array to a list of opencv keypoints
+def array_to_keypoints(kp_array):
+    kp_list = []
+    for (x, y, size, angle, response, octave, class_id) in kp_array.tolist():
+        kp_list.append( cv2.KeyPoint(x, y, size, angle, response, octave,
+                                     class_id) )
+    return kp_list
+
+# adaptive histogram equalization of the value channel (essentially
+# the gray scale level) of a bgr image
+def equalize_rgb(img_rgb):
+    clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8,8))
+    hsv = cv2.cvtColor(img_rgb, cv2.COLOR_BGR2HSV)
+    hue, sat, val = cv2.split(hsv)
+    aeq = clahe.apply(val)
+    # recombine
+    hsv = cv2.merge((hue,sat,aeq))
+    # convert back to rgb
+    return cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)
+
+# reduced resolution (dct domain) jpeg decode flags by reduction factor
+reduced_flags = { 1: cv2.IMREAD_COLOR,
+                  2: cv2.IMREAD_REDUCED_COLOR_2,
+                  4: cv2.IMREAD_REDUCED_COLOR_4,
+                  8: cv2.IMREAD_REDUCED_COLOR_8 }
+
+# return the (width, height) of a jpeg file from its frame header
+# without decoding it (None if this isn't a readable jpeg.)
+def jpeg_size(path):
+    try:
+        with open(path, 'rb') as f:
+            if f.read(2) != b'\xff\xd8':
+                return None
+            while True:
+                # find the next marker (skipping any fill bytes)
+                b = f.read(1)
+                while b and b != b'\xff':
+                    b = f.read(1)
+                while b == b'\xff':
+                    b = f.read(1)
+                if not b:
+                    return None
+                marker = b[0]
+                if marker == 0x01 or 0xd0 <= marker <= 0xd8:
+                    continue    # no segment data
+                if marker == 0xd9 or marker == 0xda:
+                    return None # end of image / start of scan
+                length = struct.unpack('>H', f.read(2))[0]
+                if 0xc0 <= marker <= 0xcf \
+                   and marker not in (0xc4, 0xc8, 0xcc):
+                    # start of frame: precision, height, width
+                    f.read(1)
+                    h, w = struct.unpack('>HH', f.read(4))
+                    return w, h
+                f.seek(length - 2, 1)
+    except (IOError, struct.error):
+        return None
     
 class Image():
     def __init__(self, meta_dir=None, image_base=None):
@@ -29,12 +105,16 @@ class Image():
             self.name = None
         #self.img = None
         #self.img_rgb = None
-        self.kp_list = []       # opencv keypoint list
+        self.kp_array = np.zeros(0, dtype=kp_dtype) # keypoint attributes
+        self._kp_list = None    # opencv keypoint list (built on demand)
+        self._kp_list_src = None
         self.kp_usage = []
+        self.kp_used = np.zeros(0, np.bool_)
         self.des_list = None      # opencv descriptor list
         self.match_list = {}
 
-        self.uv_list = []       # the 'undistorted' uv coordinates of all kp's
+        # the 'undistorted' uv coordinates of all kp's (n x 2 array)
+        self.uv_list = np.zeros((0, 2), dtype=np.float32)
         
         # cam2body/body2cam are transforms to map between the standard
         # lens coordinate system (at zero roll/pitch/yaw and the
@@ -86,25 +166,44 @@ class Image():
                 print('Warning: no image source file found:', image_base)
                 self.image_file = None
             file_root = os.path.join(meta_dir, image_base)
-            self.features_file = file_root + ".feat"
-            self.des_file = file_root + ".desc"
+            self.features_file = file_root + ".feat"     # legacy pickle format
+            self.features_npy_file = file_root + ".feat.npy"
+            self.des_file = file_root + ".desc"     # legacy gzip format
+            self.des_npy_file = file_root + ".desc.npy"
             self.match_file = file_root + ".match"
             
-    def load_rgb(self, equalize=False):
+    # With scale < 1.0 the jpeg is decoded directly at a reduced
+    # resolution (libjpeg scales by 1/2, 1/4 or 1/8 in the dct domain,
+    # much cheaper than decoding the full image and resizing) and then
+    # resized the rest of the way, so the returned image is already at
+    # the requested scale.  The recorded width/height are always the
+    # full image size (read from the jpeg header.)
+    def load_rgb(self, equalize=False, scale=1.0):
         # print("Loading:", self.image_file)
         try:
-            img_rgb = cv2.imread(self.image_file, flags=cv2.IMREAD_ANYCOLOR|cv2.IMREAD_ANYDEPTH|cv2.IMREAD_IGNORE_ORIENTATION)
+            size = None
+            if scale < 1.0:
+                size = jpeg_size(self.image_file)
+            if size:
+                w, h = size
+                reduce = 1
+                while reduce < 8 and reduce * 2 * scale <= 1.0:
+                    reduce *= 2
+                flags = reduced_flags[reduce] | cv2.IMREAD_IGNORE_ORIENTATION
+                img_rgb = cv2.imread(self.image_file, flags=flags)
+                dsize = ( int(round(w * scale)), int(round(h * scale)) )
+                if (img_rgb.shape[1], img_rgb.shape[0]) != dsize:
+                    img_rgb = cv2.resize(img_rgb, dsize)
+            else:
+                img_rgb = cv2.imread(self.image_file, flags=cv2.IMREAD_ANYCOLOR|cv2.IMREAD_ANYDEPTH|cv2.IMREAD_IGNORE_ORIENTATION)
+                if scale < 1.0:
+                    # not a jpeg (or unreadable header)
+                    h, w = img_rgb.shape[:2]
+                    img_rgb = cv2.resize(img_rgb, (0,0), fx=scale, fy=scale)
             if equalize:
-                # equalize val (essentially gray scale level)
-                clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8,8))
-                hsv = cv2.cvtColor(img_rgb, cv2.COLOR_BGR2HSV)
-                hue, sat, val = cv2.split(hsv)
-                aeq = clahe.apply(val)
-                # recombine
-                hsv = cv2.merge((hue,sat,aeq))
-                # convert back to rgb
-                img_rgb = cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)
-            h, w = img_rgb.shape[:2]
+                img_rgb = equalize_rgb(img_rgb)
+            if scale >= 1.0:
+                h, w = img_rgb.shape[:2]
             self.node.setInt('height', h)
             self.node.setInt('width', w)
             return img_rgb
@@ -131,43 +230,93 @@ class Image():
     def get_size(self):
         return self.node.getInt('width'), self.node.getInt('height')
     
+    # opencv keypoint objects are only created when something asks for
+    # them (i.e. gms matching or drawing.)  Everything else should
+    # work with kp_array (or kp_pts()) directly.  The keypoints are a
+    # read only tuple view of kp_array (which is what gets saved): to
+    # change the keypoints, edit kp_array or assign a new kp_list.
+    @property
+    def kp_list(self):
+        if self._kp_list is None or self._kp_list_src is not self.kp_array:
+            self._kp_list = tuple(array_to_keypoints(self.kp_array))
+            self._kp_list_src = self.kp_array
+        return self._kp_list
+
+    @kp_list.setter
+    def kp_list(self, kp_list):
+        self.kp_array = keypoints_to_array(kp_list)
+        self._kp_list = tuple(kp_list)
+        self._kp_list_src = self.kp_array
+
+    # return the (x, y) keypoint coordinates as an n x 2 array
+    def kp_pts(self):
+        return np.vstack( (self.kp_array['x'], self.kp_array['y']) ).T
+
+    def num_features(self):
+        return len(self.kp_array)
+
+    # keep only the selected features (bool mask or index array.)  The
+    # keypoints, uv list and descriptors are aligned arrays so they
+    # are all filtered together in one pass.
+    def filter_features(self, keep):
+        self.kp_array = self.kp_array[keep]
+        if len(self.uv_list) > 0:
+            self.uv_list = self.uv_list[keep]
+        if self.des_list is not None:
+            self.des_list = self.des_list[keep]
+
     def load_features(self):
-        if len(self.kp_list) == 0 and os.path.exists(self.features_file):
+        if len(self.kp_array) > 0:
+            return
+        if os.path.exists(self.features_npy_file):
+            try:
+                self.kp_array = np.load(self.features_npy_file)
+            except:
+                print(self.features_npy_file + ":\n" + "  feature load error: " \
+                      + str(sys.exc_info()[0]) + ": " + str(sys.exc_info()[1]))
+        elif os.path.exists(self.features_file):
             #print "Loading " + self.features_file
             try:
                 fp = gzip.open(self.features_file, "rb")
                 feature_list = pickle.load(fp)
                 fp.close()
-                for point in feature_list:
-                    kp = cv2.KeyPoint(x=point[0][0], y=point[0][1],
-                                      _size=point[1], _angle=point[2],
-                                      _response=point[3], _octave=point[4],
-                                      _class_id=point[5])
-                    self.kp_list.append(kp)
+                self.kp_array = np.array( [ (p[0][0], p[0][1], p[1], p[2],
+                                             p[3], p[4], p[5])
+                                            for p in feature_list ],
+                                          dtype=kp_dtype )
             except:
                 print(self.features_file + ":\n" + "  feature load error: " \
                       + str(sys.exc_info()[0]) + ": " + str(sys.exc_info()[1]))
                 return
 
+    # descriptors are stored as an uncompressed .npy file and memory
+    # mapped (read only) so the os page cache does the caching and
+    # the matcher can read them without a copy.  Fall back to the
+    # legacy gzip'd .desc file for projects that haven't been migrated
+    # (see 99-migrate-descriptors.py)
     def load_descriptors(self):
-        if os.path.exists(self.des_file):
-            if self.des_list is None:
-                #print "Loading " + self.des_file
-                try:
-                    fp = gzip.open(self.des_file, 'rb')
-                    self.des_list = np.load(fp)
-                    fp.close()
-                    #print np.any(self.des_list)
-                    #val = "%s" % self.des_list
-                    #print
-                    #print "des_list.size =", self.des_list.size
-                    #print val
-                    #print
-                except:
-                    print(self.des_file + ":\n" + "  desc load error: " \
-                        + str(sys.exc_info()[1]))
+        if self.des_list is not None:
+            return
+        if os.path.exists(self.des_npy_file):
+            try:
+                self.des_list = np.load(self.des_npy_file, mmap_mode='r')
+            except:
+                print(self.des_npy_file + ":\n" + "  desc load error: " \
+                    + str(sys.exc_info()[1]))
+        elif os.path.exists(self.des_file):
+            self.load_descriptors_gzip()
         else:
-            print("no file:", self.des_file)
+            print("no file:", self.des_npy_file)
+
+    def load_descriptors_gzip(self):
+        #print "Loading " + self.des_file
+        try:
+            fp = gzip.open(self.des_file, 'rb')
+            self.des_list = np.load(fp)
+            fp.close()
+        except:
+            print(self.des_file + ":\n" + "  desc load error: " \
+                + str(sys.exc_info()[1]))
             
     def load_matches(self):
         try:
@@ -179,16 +328,8 @@ class Image():
             return
 
     def save_features(self):
-        # convert from native opencv kp class to a python list
-        feature_list = []
-        for kp in self.kp_list:
-            point = (kp.pt, kp.size, kp.angle, kp.response, kp.octave,
-                     kp.class_id)
-            feature_list.append(point)
         try:
-            fp = gzip.open(self.features_file, 'wb', compresslevel=6)
-            pickle.dump(feature_list, fp)
-            fp.close()
+            np.save(self.features_npy_file, self.kp_array)
         except IOError as e:
             print("save_features(): I/O error({0}): {1}".format(e.errno, e.strerror))
             return
@@ -196,13 +337,12 @@ class Image():
             raise
 
     def save_descriptors(self):
-        # write descriptors as 'ppm image' format
+        # write descriptors as an uncompressed (memory mappable) npy
+        # file
         try:
-            fp = gzip.open(self.des_file, 'wb', compresslevel=6)
-            result = np.save(fp, self.des_list)
-            fp.close()
+            np.save(self.des_npy_file, np.ascontiguousarray(self.des_list))
         except:
-            print(self.des_file + ": error saving file: " \
+            print(self.des_npy_file + ": error saving file: " \
                 + str(sys.exc_info()[1]))
 
     def save_matches(self):
@@ -243,24 +383,52 @@ class Image():
                                         suppressNonmaxSize)
         return detector
 
-    def orb_grid_detect(self, detector, image, grid_size):
-        steps = grid_size
-        kp_list = []
+    # detect features separately in each cell of a grid_size x
+    # grid_size grid for a more even feature distribution (the
+    # detector was created with a per cell feature budget.)  Each cell
+    # runs the detector on a view of just that cell, padded by the
+    # detector's edge threshold so features near the cell borders are
+    # still found, and keeps the keypoints that fall inside the cell
+    # (shifted back to full image coordinates.)  With threads > 1 the
+    # cells are detected in a thread pool (opencv releases the gil
+    # while it works) each with its own detector.
+    def orb_grid_detect(self, detector, image, grid_size, threads=1):
+        if len(image.shape) == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
         h, w = image.shape
-        dx = 1.0 / float(steps)
-        dy = 1.0 / float(steps)
-        x = 0.0
-        for i in xrange(steps):
-            y = 0.0
-            for j in xrange(steps):
-                #print "create mask (%dx%d) %d %d" % (w, h, i, j)
-                #print "  roi = %.2f,%.2f %.2f,%2f" % (y*h,(y+dy)*h-1, x*w,(x+dx)*w-1)
-                mask = np.zeros((h,w,1), np.uint8)
-                mask[y*h:(y+dy)*h-1,x*w:(x+dx)*w-1] = 255
-                kps = detector.detect(image, mask)
-                kp_list.extend( kps )
-                y += dy
-            x += dx
+        pad = detector.getEdgeThreshold()
+        xs = np.linspace(0, w, grid_size + 1).round().astype(int)
+        ys = np.linspace(0, h, grid_size + 1).round().astype(int)
+        cells = [ (xs[i], xs[i+1], ys[j], ys[j+1])
+                  for i in range(grid_size) for j in range(grid_size) ]
+
+        def detect_cell(cell, detector):
+            x0, x1, y0, y1 = cell
+            ax = max(0, x0 - pad)
+            ay = max(0, y0 - pad)
+            roi = image[ay:min(h, y1 + pad), ax:min(w, x1 + pad)]
+            kp_list = []
+            for kp in detector.detect(roi):
+                x = kp.pt[0] + ax
+                y = kp.pt[1] + ay
+                if x0 <= x < x1 and y0 <= y < y1:
+                    kp_list.append( cv2.KeyPoint(x, y, kp.size, kp.angle,
+                                                 kp.response, kp.octave,
+                                                 kp.class_id) )
+            return kp_list
+
+        if threads > 1:
+            # one detector per worker thread
+            local = threading.local()
+            def init_thread():
+                local.detector = self.make_detector()
+            with ThreadPool(threads, initializer=init_thread) as pool:
+                results = pool.map(lambda cell: detect_cell(cell, local.detector), cells)
+        else:
+            results = [ detect_cell(cell, detector) for cell in cells ]
+        kp_list = []
+        for kps in results:
+            kp_list.extend( kps )
         return kp_list
 
     def detect_features(self, img, scale):
@@ -270,13 +438,25 @@ class Image():
         # With outdoor natural images at full detail, oftenthe
         # detector/matcher gets lots in the microscopic details and
         # sees more noise than valid features.
-        scaled = cv2.resize(img, (0,0), fx=scale, fy=scale)
+        #
+        # load_rgb(scale=scale) returns an image already at the scaled
+        # size, otherwise resize it here.
+        w, h = self.get_size()
+        dsize = ( int(round(w * scale)), int(round(h * scale)) )
+        if w > 0 and (img.shape[1], img.shape[0]) == dsize:
+            scaled = img
+        else:
+            scaled = cv2.resize(img, (0,0), fx=scale, fy=scale)
         
         detector_node = getNode('/config/detector', True)
         detector = self.make_detector()
         grid_size = detector_node.getInt('grid_detect')
         if detector_node.getString('detector') == 'ORB' and grid_size > 1:
-            kp_list = self.orb_grid_detect(detector, scaled, grid_size)
+            threads = 1
+            if detector_node.hasChild('grid_threads'):
+                threads = detector_node.getInt('grid_threads')
+            kp_list = self.orb_grid_detect(detector, scaled, grid_size,
+                                           threads)
         else:
             kp_list = detector.detect(scaled)
 
@@ -290,13 +470,13 @@ class Image():
             extractor = cv2.DescriptorExtractor_create('ORB')
         else:
             extractor = detector
-        self.kp_list, self.des_list = extractor.compute(scaled, kp_list)
+        kp_list, self.des_list = extractor.compute(scaled, kp_list)
 
         # scale the keypoint coordinates back to the original image size
-        for kp in self.kp_list:
-            #print('scaled:', kp.pt, ' ', end='')
-            kp.pt = (kp.pt[0]/scale, kp.pt[1]/scale)
-            #print('full:', kp.pt)
+        kp_array = keypoints_to_array(kp_list)
+        kp_array['x'] /= scale
+        kp_array['y'] /= scale
+        self.kp_array = kp_array
             
         # wipe matches because we've touched the keypoints
         self.match_list = {}
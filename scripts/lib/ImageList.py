@@ -2,6 +2,7 @@
 # of images
 
 import math
+import numpy as np
 
 from . import Image
 
@@ -10,7 +11,7 @@ from . import Image
 def coverage(image_list):
     xmin = None; xmax = None; ymin = None; ymax = None
     for image in image_list:
-        (x0, y0, x1, y1) = image.coverage()
+        (x0, y0, x1, y1) = image.coverage_xy()
         if xmin == None or x0 < xmin:
             xmin = x0
         if ymin == None or y0 < ymin:
@@ -32,12 +33,16 @@ def rectanglesOverlap(r1, r2):
     else:
         return False
 
-# return a list of images that intersect the given rectangle
-def getImagesCoveringRectangle(image_list, r2, only_placed=False):
+# return a list of images that intersect the given rectangle.  If a
+# SpatialIndex of the image list is provided it is used instead of
+# testing every image.
+def getImagesCoveringRectangle(image_list, r2, only_placed=False, index=None):
+    if not index is None:
+        return index.images_covering_rectangle(r2, only_placed)
     # build list of images covering target point
     coverage_list = []
     for image in image_list:
-        r1 = image.coverage()
+        r1 = image.coverage_xy()
         if only_placed and not image.placed:
             continue
         if rectanglesOverlap(r1, r2):
@@ -46,7 +51,7 @@ def getImagesCoveringRectangle(image_list, r2, only_placed=False):
 
 # return a list of images that cover the given point within 'pad'
 # or are within 'pad' distance of touching the point.
-def getImagesCoveringPoint(image_list, x=0.0, y=0.0, pad=20.0, only_placed=False):
+def getImagesCoveringPoint(image_list, x=0.0, y=0.0, pad=20.0, only_placed=False, index=None):
     # build list of images covering target point
     coverage_list = []
     bx0 = x-pad
@@ -54,7 +59,8 @@ def getImagesCoveringPoint(image_list, x=0.0, y=0.0, pad=20.0, only_placed=False
     bx1 = x+pad
     by1 = y+pad
     r2 = (bx0, by0, bx1, by1)
-    coverage_list = getImagesCoveringRectangle(image_list, r2, only_placed)
+    coverage_list = getImagesCoveringRectangle(image_list, r2, only_placed,
+                                               index)
 
     name_list = []
     for image in coverage_list:
@@ -64,6 +70,51 @@ def getImagesCoveringPoint(image_list, x=0.0, y=0.0, pad=20.0, only_placed=False
 
     return coverage_list
 
+# return the distance along a hilbert curve of order 'order' for
+# integer x, y arrays in the range [0, 2**order)
+def hilbert_index(x, y, order=16):
+    x = np.array(x, dtype=np.int64)
+    y = np.array(y, dtype=np.int64)
+    d = np.zeros(x.shape, dtype=np.int64)
+    n = 1 << order
+    s = n >> 1
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        d += s * s * ((3 * rx) ^ ry)
+        # rotate the quadrant
+        flip = ~ry & rx
+        x[flip] = n - 1 - x[flip]
+        y[flip] = n - 1 - y[flip]
+        swap = ~ry
+        tmp = x[swap]
+        x[swap] = y[swap]
+        y[swap] = tmp
+        s >>= 1
+    return d
+
+# return the rank of each image when the camera (n, e) positions are
+# visited in hilbert curve order.  Images that are near each other
+# spatially end up near each other in rank.
+def hilbertRank(image_list, order=16):
+    if not len(image_list):
+        return np.zeros(0, dtype=int)
+    ne = []
+    for image in image_list:
+        ned, ypr, quat = image.get_camera_pose()
+        ne.append( ned[:2] )
+    ne = np.array(ne)
+    lo = np.amin(ne, axis=0)
+    span = np.amax(ne - lo)
+    if span <= 0.0:
+        span = 1.0
+    cells = (1 << order) - 1
+    grid = np.round((ne - lo) * (cells / span)).astype(np.int64)
+    d = hilbert_index(grid[:,0], grid[:,1], order)
+    rank = np.empty(len(image_list), dtype=int)
+    rank[np.argsort(d, kind='stable')] = np.arange(len(image_list))
+    return rank
+
 def x2lon(self, x):
     nm2m = 1852.0
     x_nm = x / nm2m
@@ -9,13 +9,17 @@ import copy
 import cv2
 import math
 from matplotlib import pyplot as plt
+import multiprocessing
 import numpy as np
 import time
 
 from props import getNode
 
 from .find_obj import filter_matches,explore_match
+from . import DescriptorCache
 from . import ImageList
+from . import SpatialIndex
+from . import UVDedup
 from . import transformations
 
 class Matcher():
@@ -26,6 +30,7 @@ class Matcher():
         self.matcher = None
         self.match_ratio = 0.70
         self.min_pairs = 25
+        self.desc_cache = DescriptorCache.DescriptorCache()
 
     def configure(self):
         detector_str = self.detector_node.getString('detector')
@@ -67,32 +72,35 @@ class Matcher():
             self.matcher = cv2.BFMatcher(norm)
         self.match_ratio = self.matcher_node.getFloat('match_ratio')
         self.min_pairs = self.matcher_node.getFloat('min_pairs')
+        cache_mb = self.matcher_node.getFloat('desc_cache_mb')
+        if cache_mb > 0:
+            self.desc_cache.max_bytes = int(cache_mb * 1024 * 1024)
+
+    # extract the k=2 knnMatch() results into numpy arrays: an n x 2
+    # array of the best/second best distances, and the query/train
+    # indices of the best match.  Results without two neighbors are
+    # dropped.  Also returns the list of best DMatch objects (for
+    # functions like matchGMS() that want them.)
+    def knn_arrays(self, matches):
+        best = [ m[0] for m in matches if len(m) == 2 ]
+        dist = np.array([ (m[0].distance, m[1].distance)
+                          for m in matches if len(m) == 2 ],
+                        dtype=np.float32).reshape(-1, 2)
+        query = np.array([ m.queryIdx for m in best ], dtype=int)
+        train = np.array([ m.trainIdx for m in best ], dtype=int)
+        return dist, query, train, best
 
     def filter_by_feature(self, i1, i2, matches):
-        kp1 = i1.kp_list
-        kp2 = i2.kp_list
-        mkp1, mkp2 = [], []
-        idx_pairs = []
-        used = np.zeros(len(kp2), np.bool_)
-        for m in matches:
-            if len(m) != 2:
-                # we asked for the two best matches
-                continue
-            #print "dist = %.2f %.2f (%.2f)" % (m[0].distance, m[1].distance, m[0].distance/m[1].distance)
-            if m[0].distance > m[1].distance * self.match_ratio:
-                # must pass the feature vector distance ratio test
-                continue
-
-            m = m[0]
-            if not used[m.trainIdx]:
-                used[m.trainIdx] = True
-                mkp1.append( kp1[m.queryIdx] )
-                mkp2.append( kp2[m.trainIdx] )
-                idx_pairs.append( [m.queryIdx, m.trainIdx] )
-        p1 = np.float32([kp.pt for kp in mkp1])
-        p2 = np.float32([kp.pt for kp in mkp2])
-        kp_pairs = zip(mkp1, mkp2)
-        return p1, p2, kp_pairs, idx_pairs
+        dist, query, train, best = self.knn_arrays(matches)
+        # must pass the feature vector distance ratio test
+        good = np.nonzero(dist[:,0] <= dist[:,1] * self.match_ratio)[0]
+        # only use each train keypoint once (first come first served)
+        unique_train, first = np.unique(train[good], return_index=True)
+        keep = good[np.sort(first)]
+        idx_pairs = np.vstack( (query[keep], train[keep]) ).T.tolist()
+        p1 = i1.kp_pts()[query[keep]].astype(np.float32)
+        p2 = i2.kp_pts()[train[keep]].astype(np.float32)
+        return p1, p2, idx_pairs
 
     def filter_by_location(self, i1, i2, idx_pairs, dist):
         result = []
@@ -111,31 +119,15 @@ class Matcher():
     # feature in image1 matching two or more features in images2.
     # Find and filter these out of the set.
     def filter_duplicates(self, i1, i2, idx_pairs):
-        count = 0
-        result = []
-        kp1_dict = {}
-        kp2_dict = {}
-        for pair in idx_pairs:
-            kp1 = i1.kp_list[pair[0]]
-            kp2 = i2.kp_list[pair[1]]
-            key1 = "%.2f-%.2f" % (kp1.pt[0], kp1.pt[1])
-            key2 = "%.2f-%.2f" % (kp2.pt[0], kp2.pt[1])
-            if key1 in kp1_dict and key2 in kp2_dict:
-                # print("image1 and image2 key point already used:", key1, key2)
-                count += 1
-            elif key1 in kp1_dict:
-                # print("image1 key point already used:", key1)
-                count += 1
-            elif key2 in kp2_dict:
-                # print( "image2 key point already used:", key2)
-                count += 1
-            else:
-                kp1_dict[key1] = True
-                kp2_dict[key2] = True
-                result.append(pair)
+        if not len(idx_pairs):
+            return []
+        pairs = np.asarray(idx_pairs, dtype=int).reshape(-1, 2)
+        keep = UVDedup.filter_pairs(i1.kp_pts()[pairs[:,0]],
+                                    i2.kp_pts()[pairs[:,1]])
+        count = len(pairs) - len(keep)
         if count > 0:
             print("  removed %d duplicate features" % count)
-        return result
+        return pairs[keep].tolist()
 
     # Iterate through all the matches for the specified image and
     # delete keypoints that don't satisfy the homography (or
@@ -157,18 +149,16 @@ class Matcher():
         if len(matches) < self.min_pairs:
             i1.match_list[i2.name] = []
             return True
-        p1 = []
-        p2 = []
-        for k, pair in enumerate(matches):
-            use_raw_uv = False
-            if use_raw_uv:
-                p1.append( i1.kp_list[pair[0]].pt )
-                p2.append( i2.kp_list[pair[1]].pt )
-            else:
-                # undistorted uv points should be better if the camera
-                # calibration is known, right?
-                p1.append( i1.uv_list[pair[0]] )
-                p2.append( i2.uv_list[pair[1]] )
+        pairs = np.asarray(matches, dtype=int).reshape(-1, 2)
+        use_raw_uv = False
+        if use_raw_uv:
+            p1 = i1.kp_pts()[pairs[:,0]]
+            p2 = i2.kp_pts()[pairs[:,1]]
+        else:
+            # undistorted uv points should be better if the camera
+            # calibration is known, right?
+            p1 = np.asarray(i1.uv_list)[pairs[:,0]]
+            p2 = np.asarray(i2.uv_list)[pairs[:,1]]
 
         p1 = np.float32(p1)
         p2 = np.float32(p2)
@@ -269,36 +259,34 @@ class Matcher():
         if len(i2.des_list.shape) == 0 or i2.des_list.shape[0] <= 1:
             return []
 
-        matches = self.matcher.knnMatch(np.array(i1.des_list),
-                                        trainDescriptors=np.array(i2.des_list),
+        # note: asarray() so memory mapped descriptors aren't copied
+        t_start = time.time()
+        matches = self.matcher.knnMatch(np.asarray(i1.des_list),
+                                        trainDescriptors=np.asarray(i2.des_list),
                                         k=2)
+        t_knn = time.time()
         print('  raw matches:', len(matches))
+        dist, query, train, best = self.knn_arrays(matches)
+        t_extract = time.time()
+        if not len(dist):
+            return []
 
-        sum = 0.0
-        max_good = 0
-        sum_good = 0.0
-        count_good = 0
-        for m in matches:
-            sum += m[0].distance
-            if m[0].distance <= m[1].distance * self.match_ratio:
-                sum_good += m[0].distance
-                count_good += 1
-                if m[0].distance > max_good:
-                    max_good = m[0].distance
-        print('  avg dist:', sum / len(matches))
-        if count_good:
-            print('  avg good dist:', sum_good / count_good, '(%d)' % count_good)
-        print('  max good dist:', max_good)
+        d0 = dist[:,0]
+        d1 = dist[:,1]
+        good = d0 <= d1 * self.match_ratio
+        print('  avg dist:', np.mean(d0))
+        if np.any(good):
+            print('  avg good dist:', np.mean(d0[good]), '(%d)' % np.count_nonzero(good))
+            print('  max good dist:', np.amax(d0[good]))
+        else:
+            print('  max good dist:', 0)
 
         if False:
             # filter by absolute distance (for ORB, statistically all real
             # matches will have a distance < 64, for SIFT I don't know,
             # but I'm guessing anything more than 270.0 is a bad match.
-            matches_thresh = []
-            for m in matches:
-                if m[0].distance < self.max_distance and m[0].distance <= m[1].distance * self.match_ratio:
-                    matches_thresh.append(m[0])
-            print('  quality matches:', len(matches_thresh))
+            keep = np.nonzero((d0 < self.max_distance) & good)[0]
+            print('  quality matches:', len(keep))
 
         if True:
             # generate a quality metric for each match, sort and only
@@ -306,27 +294,25 @@ class Matcher():
             # ratio test.  (Testing the idea that 2000 matches aren't
             # better than 20 if they are good matches with respect to
             # optimizing the fit.)
-            by_metric = []
-            for m in matches:
-                ratio = m[0].distance / m[1].distance # smaller is better
-                metric = m[0].distance * ratio
-                by_metric.append( [metric, m[0]] )
-            by_metric = sorted(by_metric, key=lambda fields: fields[0])
-            matches_thresh = []
-            for line in by_metric:
-                if line[0] < self.max_distance * self.match_ratio:
-                    matches_thresh.append(line[1])
-            print('  quality matches:', len(matches_thresh))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                ratio = d0 / d1 # smaller is better
+                metric = d0 * ratio
+            metric[np.isnan(metric)] = np.inf
+            keep = np.nonzero(metric < self.max_distance * self.match_ratio)[0]
+            keep = keep[np.argsort(metric[keep], kind='stable')]
+            print('  quality matches:', len(keep))
             # fixme, make this a command line option or parameter?
             mymax = 2000
-            if len(matches_thresh) > mymax:
+            if len(keep) > mymax:
                 # clip list to n best rated matches
-                matches_thresh = matches_thresh[:mymax]
+                keep = keep[:mymax]
                 print('  clipping to:', mymax)
+        t_rank = time.time()
 
-        if len(matches_thresh) < self.min_pairs:
+        if len(keep) < self.min_pairs:
             # just quit now
             return []
+        matches_thresh = [ best[k] for k in keep ]
 
         size1 = i1.get_size()
         size2 = i2.get_size()
@@ -346,47 +332,37 @@ class Matcher():
         idx_pairs = []
         for i, m in enumerate(matchesGMS):
             idx_pairs.append( [m.queryIdx, m.trainIdx] )
+        t_gms = time.time()
             
         if False:
             # run the classic feature distance ratio test (already
             # handled above in a slightly more strategic way by
             # passing the best matches, not just all the matches.)
-            p1, p2, kp_pairs, idx_pairs = self.filter_by_feature(i1, i2, matches)
+            p1, p2, idx_pairs = self.filter_by_feature(i1, i2, matches)
             print("  dist ratio matches =", len(idx_pairs))
 
         # check for duplicate matches (based on different scales or attributes)
         idx_pairs = self.filter_duplicates(i1, i2, idx_pairs)
+        t_dups = time.time()
+        print('  timing (sec): knn: %.3f extract: %.3f rank: %.3f gms: %.3f dups: %.3f' % (t_knn - t_start, t_extract - t_knn, t_rank - t_extract, t_gms - t_rank, t_dups - t_gms))
 
         # look for common feature angle difference (should we
         # depricate this step?)
         if False and len(idx_pairs):
             # do a quick test of relative feature angles
-            offsets = []
-            for pair in idx_pairs:
-                p1 = i1.kp_list[pair[0]]
-                p2 = i2.kp_list[pair[1]]
-                offset = p2.angle - p1.angle
-                if offset < -180: offset += 360
-                if offset > 180: offset -= 360
-                offsets.append(offset)
-                #print('angles:', p1.angle, p2.angle, offset)
-            offsets = np.array(offsets)
+            pairs = np.asarray(idx_pairs, dtype=int).reshape(-1, 2)
+            offsets = i2.kp_array['angle'][pairs[:,1]] \
+                - i1.kp_array['angle'][pairs[:,0]]
+            offsets[offsets < -180] += 360
+            offsets[offsets > 180] -= 360
             offset_avg = np.mean(offsets)
             offset_std = np.std(offsets)
             print('gms inlier offset.  avg: %.1f std: %.1f' % (offset_avg, offset_std))
             # carry forward the aligned pairs
-            aligned_pairs = []
-            for pair in idx_pairs:
-                p1 = i1.kp_list[pair[0]]
-                p2 = i2.kp_list[pair[1]]
-                offset = p2.angle - p1.angle
-                if offset < -180: offset += 360
-                if offset > 180: offset -= 360
-                diff = offset - offset_avg
-                if diff < -180: diff += 360
-                if diff > 180: diff -= 360
-                if abs(diff) <= 10:
-                    aligned_pairs.append(pair)
+            diff = offsets - offset_avg
+            diff[diff < -180] += 360
+            diff[diff > 180] -= 360
+            aligned_pairs = pairs[np.abs(diff) <= 10].tolist()
             if len(idx_pairs) > len(aligned_pairs):
                 print('  feature alignment:', len(idx_pairs), '->', len(aligned_pairs))
                 idx_pairs = aligned_pairs
@@ -473,8 +449,66 @@ class Matcher():
         # a = raw_input("Press Enter to continue...")
 
 
+    # order the work list so pairs are visited by sweeping along a
+    # hilbert curve through the camera locations.  Each image's
+    # neighbors are matched close together in time, so with a bounded
+    # descriptor cache each descriptor set is loaded about once.
+    def scheduleWorkList(self, image_list, work_list):
+        rank = ImageList.hilbertRank(image_list)
+        def key(line):
+            a = rank[line[1]]
+            b = rank[line[2]]
+            return (min(a, b), max(a, b))
+        return sorted(work_list, key=key)
+
+    # match the work list pairs one at a time in this process,
+    # yielding each result as it is computed.
+    def serialPairMatches(self, image_list, work_list, review=False):
+        for line in work_list:
+            dist = line[0]
+            i = line[1]
+            j = line[2]
+            i1 = image_list[i]
+            i2 = image_list[j]
+
+            # make sure descriptors are loaded (evicting the least
+            # recently used if we are over budget)
+            self.desc_cache.load(i1, i2)
+
+            idx_pairs1, idx_pairs2 \
+                = self.bidirectional_matches(image_list, i, j, review)
+            yield dist, i, j, idx_pairs1, idx_pairs2
+        self.desc_cache.report()
+
+    # shard the work list pairs across a pool of worker processes.
+    # Each worker builds its own matcher and descriptor cache (sharing
+    # the total cache budget), results are yielded as they come back
+    # in completion order (not work list order.)
+    def parallelPairMatches(self, image_list, work_list, jobs):
+        print('Matching with %d worker processes' % jobs)
+        # hand out contiguous runs of the (spatially scheduled) work
+        # list so each worker keeps revisiting the same neighborhood
+        chunksize = max(1, min(32, int(len(work_list) / (jobs * 4))))
+        cache_bytes = int(self.desc_cache.max_bytes / jobs)
+        # fork so the workers inherit the property tree and the
+        # loaded keypoints without pickling them
+        ctx = multiprocessing.get_context('fork')
+        pool = ctx.Pool(jobs, initializer=_init_match_worker,
+                        initargs=(image_list, cache_bytes))
+        try:
+            for result in pool.imap_unordered(_match_worker, work_list,
+                                              chunksize):
+                yield result
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
     def robustGroupMatches(self, image_list, K,
-                           filter="fundamental", review=False):
+                           filter="fundamental", review=False, jobs=1,
+                           overlap=False):
         min_dist = self.matcher_node.getFloat('min_dist')
         max_dist = self.matcher_node.getFloat('max_dist')
         print('Generating work list for range:', min_dist, '-', max_dist)
@@ -487,24 +521,12 @@ class Matcher():
         dist_stats = []
 
         # pass 1, make a list of all the match pairs with their
-        # physical camera separation, then sort by distance and matche
-        # closest first
-        work_list = []
-        for i, i1 in enumerate(image_list):
-            #shouldn't need to allocate space now that it's a dict
-            #if len(i1.match_list) == 0:
-            #    i1.match_list = {}
-
-            for j, i2 in enumerate(image_list):
-                if j <= i:
-                    continue
-                
-                # camera pose distance check
-                ned1, ypr1, q1 = i1.get_camera_pose()
-                ned2, ypr2, q2 = i2.get_camera_pose()
-                dist = np.linalg.norm(np.array(ned2) - np.array(ned1))
-                if dist >= min_dist and dist <= max_dist:
-                    work_list.append( [dist, i, j] )
+        # physical camera separation (found with a kd-tree of the
+        # camera locations rather than testing every pair.)  If
+        # requested, also require the image footprints to overlap.
+        index = SpatialIndex.SpatialIndex(image_list)
+        work_list = index.pairs_in_range(min_dist, max_dist, overlap)
+        print('Candidate pairs in range:', len(work_list))
 
         # (optional) sort worklist from closest pairs to furthest pairs
         #
@@ -517,38 +539,43 @@ class Matcher():
         
         # work_list = sorted(work_list, key=lambda fields: fields[0])
 
-        # note: image.desc_timestamp is used to unload not recently
-        # used descriptors ... these burn a ton of memory so unloading
-        # things not recently used should help our memory foot print
-        # at hopefully not too much of a performance expense.
-        
+        # default: sweep the pairs in spatial (hilbert curve) order to
+        # keep the active set of descriptors small.
+        work_list = self.scheduleWorkList(image_list, work_list)
+
+        # skip if match has already been computed (this is what makes
+        # the matching step resumable.)
+        todo_list = []
+        for line in work_list:
+            i1 = image_list[line[1]]
+            i2 = image_list[line[2]]
+            if i2.name in i1.match_list and i1.name in i2.match_list:
+                print('Skipping: ', i1.name, 'vs', i2.name, 'already done.')
+                continue
+            todo_list.append(line)
+        print('Pairs to match: %d (of %d)' % (len(todo_list), len(work_list)))
+
+        if jobs > 1 and not review:
+            results = self.parallelPairMatches(image_list, todo_list, jobs)
+        else:
+            results = self.serialPairMatches(image_list, todo_list, review)
+
         # proces the work list
         n_count = 0
         save_time = time.time()
         save_interval = 120     # seconds
-        for line in work_list:
-            dist = line[0]
-            i = line[1]
-            j = line[2]
+        for (dist, i, j, idx_pairs1, idx_pairs2) in results:
             i1 = image_list[i]
             i2 = image_list[j]
 
             # eta estimation
-            percent = n_count / float(len(work_list))
             n_count += 1
+            percent = n_count / float(len(todo_list))
             t_elapsed = time.time() - t_start
-            if percent > 0:
-                t_end = t_elapsed / percent
-            else:
-                t_end = t_start
+            t_end = t_elapsed / percent
             t_remain = t_end - t_elapsed
 
-            # skip if match has already been computed
-            if i2.name in i1.match_list and i1.name in i2.match_list:
-                print('Skipping: ', i1.name, 'vs', i2.name, 'already done.')
-                continue
-            
-            print('Matching %s vs %s - ' % (i1.name, i2.name), end='')
+            print('Matched %s vs %s - ' % (i1.name, i2.name), end='')
             print('%.1f%% done: ' % (percent * 100.0), end='')
             if t_remain < 3600:
                 print('%.1f (min)' % (t_remain / 60.0))
@@ -556,18 +583,12 @@ class Matcher():
                 print('%.1f (hr)' % (t_remain / 3600.0))
             print("  separation = %.1f (m)" % dist)
 
-            # update cache timers and make sure features are loaded
-            i1.desc_timestamp = time.time()
-            i2.desc_timestamp = time.time()
-            i1.load_descriptors()
-            i2.load_descriptors()
-
             #shouldn't need to do this
             #if len(i2.match_list) == 0:
             #    # create if needed
             #    i2.match_list = [[]] * len(image_list)
-            i1.match_list[i2.name], i2.match_list[i1.name] \
-                = self.bidirectional_matches(image_list, i, j, review)
+            i1.match_list[i2.name] = idx_pairs1
+            i2.match_list[i1.name] = idx_pairs2
 
             scheme = 'none'
             # scheme = 'one_step'
@@ -597,33 +618,20 @@ class Matcher():
                 self.filter_non_reciprocal_pair(image_list, j, i)
             dist_stats.append( [ dist, len(i1.match_list[i2.name]) ] )
 
-            # save our work so far, and flush descriptor cache
+            # save our work so far
             if time.time() >= save_time + save_interval:
                 print('saving matches ...')
                 self.saveMatches(image_list)
                 save_time = time.time()
-
-                time_list = []
-                for i3 in image_list:
-                    if not i3.des_list is None:
-                        time_list.append( [i3.desc_timestamp, i3] )
-                time_list = sorted(time_list, key=lambda fields: fields[0],
-                                   reverse=True)
-                # may wish to monitor and update cache_size formula
-                cache_size = 20 + 3 * (int(math.sqrt(len(image_list))) + 1)
-                flush_list = time_list[cache_size:]
-                print('flushing descriptor cache - size: %d (over by: %d)' % (cache_size, len(flush_list)) )
-                for line in flush_list:
-                    print('  clearing descriptors for:', line[1].name)
-                    line[1].des_list = None
                     
         # and save
         self.saveMatches(image_list)
         print('Pair-wise matches successfully saved.')
 
-        dist_stats = np.array(dist_stats)
-        plt.plot(dist_stats[:,0], dist_stats[:,1], 'ro')
-        plt.show()
+        if len(dist_stats):
+            dist_stats = np.array(dist_stats)
+            plt.plot(dist_stats[:,0], dist_stats[:,1], 'ro')
+            plt.show()
 
     # remove any match sets shorter than self.min_pairs (this shouldn't
     # probably ever happen now?)
@@ -739,11 +747,9 @@ class Matcher():
         # and possibly estimate outliers if no status array is
         # provided.
         
-        src = []
-        dst = []
-        for pair in idx_pairs:
-            src.append( i1.kp_list[pair[0]].pt )
-            dst.append( i2.kp_list[pair[1]].pt )
+        pairs = np.asarray(idx_pairs, dtype=int).reshape(-1, 2)
+        src = i1.kp_pts()[pairs[:,0]]
+        dst = i2.kp_pts()[pairs[:,1]]
         affine, status = \
             cv2.estimateAffinePartial2D(np.array([src]).astype(np.float32),
                                         np.array([dst]).astype(np.float32))
@@ -1112,11 +1118,9 @@ class Matcher():
                 if len(matches) < self.min_pairs:
                     i1.match_list[i2.name] = []
                     continue
-                p1 = []
-                p2 = []
-                for k, pair in enumerate(matches):
-                    p1.append( i1.kp_list[pair[0]].pt )
-                    p2.append( i2.kp_list[pair[1]].pt )
+                pairs = np.asarray(matches, dtype=int).reshape(-1, 2)
+                p1 = i1.kp_pts()[pairs[:,0]]
+                p2 = i2.kp_pts()[pairs[:,1]]
 
                 p1 = np.float32(p1)
                 p2 = np.float32(p2)
@@ -1172,11 +1176,9 @@ class Matcher():
                 if len(matches) < self.min_pairs:
                     i1.match_list[i2.name] = []
                     continue
-                pts = []
-                status = []
-                for k, pair in enumerate(matches):
-                    pts.append( i1.kp_list[pair[0]].pt )
-                    status.append(False)
+                pairs = np.asarray(matches, dtype=int).reshape(-1, 2)
+                pts = i1.kp_pts()[pairs[:,0]]
+                status = [ False ] * len(matches)
 
                 # check for degenerate case of all matches being
                 # pretty close to a straight line
@@ -1292,76 +1294,113 @@ class Matcher():
     def reviewPoint(self, lon_deg, lat_deg, ref_lon, ref_lat):
         (x, y) = ImageList.wgs842cart(lon_deg, lat_deg, ref_lon, ref_lat)
         print("Review images touching %.2f %.2f" % (x, y))
-        review_list = ImageList.getImagesCoveringPoint(self.image_list, x, y, pad=25.0, only_placed=False)
+        index = SpatialIndex.SpatialIndex(self.image_list)
+        review_list = ImageList.getImagesCoveringPoint(self.image_list, x, y, pad=25.0, only_placed=False, index=index)
         #print "  Images = %s" % str(review_list)
         for image in review_list:
             print("    %s -> " % image.name,)
             for key in image.match_list:
                 matches = image.match_list[key]
                 if len(matches):
-                    print("%s (%d) " % (self.image_list[j].name, len(matches)),)
+                    print("%s (%d) " % (key, len(matches)),)
             print
-            r2 = image.coverage()
-            p = ImageList.getImagesCoveringRectangle(self.image_list, r2)
+            r2 = image.coverage_xy()
+            p = ImageList.getImagesCoveringRectangle(self.image_list, r2,
+                                                     index=index)
             p_names = []
             for i in p:
                 p_names.append(i.name)
             print("      possible matches: %d" % len(p_names))
 
             
-# collect and group match chains that refer to the same keypoint
+# process pool workers for Matcher.parallelPairMatches().  Each worker
+# process holds its own matcher and (forked) copy of the image list so
+# descriptors are loaded directly by the worker that needs them.
+_worker_matcher = None
+_worker_image_list = None
+
+def _init_match_worker(image_list, cache_bytes):
+    global _worker_matcher, _worker_image_list
+    _worker_matcher = Matcher()
+    _worker_matcher.configure()
+    _worker_matcher.desc_cache.max_bytes = cache_bytes
+    _worker_image_list = image_list
+
+def _match_worker(line):
+    dist = line[0]
+    i = line[1]
+    j = line[2]
+    i1 = _worker_image_list[i]
+    i2 = _worker_image_list[j]
+    _worker_matcher.desc_cache.load(i1, i2)
+    idx_pairs1, idx_pairs2 \
+        = _worker_matcher.bidirectional_matches(_worker_image_list, i, j)
+    return dist, i, j, idx_pairs1, idx_pairs2
+
+# link pair-wise matches that share a common (image, keypoint)
+# reference into match chains (tracks) using a disjoint set
+# (union-find) structure.  A chain may only reference one keypoint
+# per image: if joining two chains would put two different keypoints
+# from the same image in one chain, the link is skipped.  Input and
+# output entries have the matches_direct/matches_grouped layout:
+# [ned, in-use flag, [image_idx, kp_idx], [image_idx, kp_idx], ...]
 def group_matches(matches_direct):
-    # this match grouping function appears to product more entries
-    # rather than reduce the entries.  I don't understand how that
-    # could be, but it needs to be fixed bore the function is used for
-    # anything.
-    print('WARNING: this function does not seem to work correctly, need to debug it before using!!!!')
     print('Number of pair-wise matches:', len(matches_direct))
-    matches_group = list(matches_direct) # shallow copy
-    count = 0
-    done = False
-    while not done:
-        print("Iteration:", count, len(matches_group))
-        count += 1
-        matches_new = []
-        matches_lookup = {}
-        for i, match in enumerate(matches_group):
-            # scan if any of these match points have been previously seen
-            # and record the match index
-            index = -1
-            for p in match[1:]:
-                key = "%d-%d" % (p[0], p[1])
-                if key in matches_lookup:
-                    index = matches_lookup[key]
-                    break
-            if index < 0:
-                # not found, append to the new list
-                for p in match[1:]:
-                    key = "%d-%d" % (p[0], p[1])
-                    matches_lookup[key] = len(matches_new)
-                    matches_new.append(list(match)) # shallow copy
-            else:
-                # found a previous reference, append these match items
-                existing = matches_new[index]
-                # only append items that don't already exist in the early
-                # match, and only one match per image (!)
-                for p in match[1:]:
-                    key = "%d-%d" % (p[0], p[1])
-                    found = False
-                    for e in existing[1:]:
-                        if p[0] == e[0]:
-                            found = True
-                            break
-                    if not found:
-                        # add
-                        existing.append(list(p)) # shallow copy
-                        matches_lookup[key] = index
-                        # print "new:", existing
-                        # print 
-        if len(matches_new) == len(matches_group):
-            done = True
-        else:
-            matches_group = list(matches_new) # shallow copy
+    refs = [ p for match in matches_direct for p in match[2:] ]
+    if not len(refs):
+        return []
+    refs = np.array(refs, dtype=np.int64).reshape(-1, 2)
+    # compact integer node id for each unique (image, keypoint)
+    keys = (refs[:,0] << 32) + refs[:,1]
+    uniq, first, node = np.unique(keys, return_index=True,
+                                  return_inverse=True)
+    node = node.reshape(-1).tolist()
+    node_image = refs[first,0].tolist()
+    parent = list(range(len(uniq)))
+    images = [ {img} for img in node_image ] # valid for root nodes
+
+    def find(n):
+        while parent[n] != n:
+            parent[n] = parent[parent[n]] # path halving
+            n = parent[n]
+        return n
+
+    skipped = 0
+    pos = 0
+    for match in matches_direct:
+        size = len(match[2:])
+        nodes = node[pos:pos+size]
+        pos += size
+        for n in nodes[1:]:
+            ra = find(nodes[0])
+            rb = find(n)
+            if ra == rb:
+                continue
+            if len(images[ra]) < len(images[rb]):
+                ra, rb = rb, ra
+            if not images[ra].isdisjoint(images[rb]):
+                # would put two keypoints from the same image in
+                # one chain
+                skipped += 1
+                continue
+            parent[rb] = ra
+            images[ra] |= images[rb]
+            images[rb] = None
+
+    # collect the chain members, ordered by first reference
+    groups = {}
+    for n in np.argsort(first, kind='stable').tolist():
+        groups.setdefault(find(n), []).append(n)
+    matches_group = []
+    for members in groups.values():
+        if len(members) < 2:
+            # all links to this keypoint were skipped
+            continue
+        match = [None, -1]
+        for n in members:
+            match.append( refs[first[n]].tolist() )
+        matches_group.append(match)
+    print("Skipped links (one keypoint per image):", skipped)
     print("Unique features (after grouping):", len(matches_group))
     return matches_group
             
@@ -7,6 +7,7 @@
 # reprojection, and then extract out the errors from that.
 
 import os
+import resource
 import time
 
 import cv2
@@ -14,11 +15,37 @@ import math
 # import matplotlib.pyplot as plt
 # from matplotlib import cm
 import numpy as np
-from scipy.optimize import least_squares
-from scipy.sparse import lil_matrix
+from scipy.optimize import least_squares, OptimizeResult
+from scipy.sparse import block_diag, bsr_matrix, csr_matrix, diags
+from scipy.sparse.linalg import cg, spsolve
 
 from . import transformations
 
+# batched version of cv2.Rodrigues(): convert an n x 3 array of
+# rotation vectors to an n x 3 x 3 array of rotation matrices
+def rodrigues(rvec):
+    theta = np.linalg.norm(rvec, axis=1)
+    k = np.zeros(rvec.shape)
+    nonzero = theta > 1e-12
+    k[nonzero] = rvec[nonzero] / theta[nonzero,np.newaxis]
+    kx = k[:,0]
+    ky = k[:,1]
+    kz = k[:,2]
+    c = np.cos(theta)
+    s = np.sin(theta)
+    C = 1 - c
+    R = np.empty((len(rvec), 3, 3))
+    R[:,0,0] = c + kx*kx*C
+    R[:,0,1] = kx*ky*C - kz*s
+    R[:,0,2] = kx*kz*C + ky*s
+    R[:,1,0] = ky*kx*C + kz*s
+    R[:,1,1] = c + ky*ky*C
+    R[:,1,2] = ky*kz*C - kx*s
+    R[:,2,0] = kz*kx*C - ky*s
+    R[:,2,1] = kz*ky*C + kx*s
+    R[:,2,2] = c + kz*kz*C
+    return R
+
 # This is a python class that optimizes the estimate camera and 3d
 # point fits by minimizing the mean reprojection error.
 class Optimizer():
@@ -36,8 +63,19 @@ class Optimizer():
         #self.ftol = 1e-3              # stop condition quicker
         self.ftol = 1e-4              # stop condition better
         self.min_chain_length = 2
+        self.fixed_cameras = None     # bool array of cameras held fixed
         self.with_bounds = False
         self.ncp = 6
+        self.analytic_jac = True      # False: finite difference jacobian
+        self.solver = 'trf'           # 'trf' (scipy least_squares) or 'schur'
+        self.schur_solver = 'direct'  # reduced camera system: 'direct' or 'cg'
+        self.max_iterations = 100     # schur solver iteration limit
+        self.loss = 'linear'          # 'linear', 'huber' or 'cauchy'
+        self.f_scale = 1.0            # robust loss inlier scale (pixels)
+        self.irls_passes = 5          # max reweighting passes (trf solver)
+        self.cull_std = 0.0           # cull obs > mre + cull_std*std (0 = off)
+        self.cull_passes = 3          # max number of cull and resolve passes
+        self.culled_obs = np.zeros(0, dtype=np.int64)
 
     # plot range
     def my_plot_range(self, data, stats=False):
@@ -76,39 +114,31 @@ class Optimizer():
         n = n_cameras * self.ncp + n_points * 3
         if self.optimize_calib == 'global':
             n += 8  # three K params (fx == fy) + five distortion params
-        A = lil_matrix((m, n), dtype=int)
         print('sparsity matrix is %d x %d' % (m, n))
 
-        i = np.arange(camera_indices.size)
-        for s in range(self.ncp):
-            A[2 * i, camera_indices * self.ncp + s] = 1
-            A[2 * i + 1, camera_indices * self.ncp + s] = 1
-
-        for s in range(3):
-            A[2 * i, n_cameras * self.ncp + point_indices * 3 + s] = 1
-            A[2 * i + 1, n_cameras * self.ncp + point_indices * 3 + s] = 1
-
+        # every observation (pair of rows) depends on the same pattern
+        # of camera, point and (optionally) calibration columns
+        cols = [ camera_indices[:,np.newaxis] * self.ncp + np.arange(self.ncp),
+                 n_cameras * self.ncp + point_indices[:,np.newaxis] * 3
+                 + np.arange(3) ]
         if self.optimize_calib == 'global':
-            for s in range(0,3): # K
-                A[2 * i, n_cameras * self.ncp + n_points * 3 + s] = 1
-                A[2 * i + 1, n_cameras * self.ncp + n_points * 3 + s] = 1
-            for s in range(3,8): # dist coeffs
-                A[2 * i, n_cameras * self.ncp + n_points * 3 + s] = 1
-                A[2 * i + 1, n_cameras * self.ncp + n_points * 3 + s] = 1
+            calib = n_cameras * self.ncp + n_points * 3 + np.arange(8)
+            cols.append( np.broadcast_to(calib, (camera_indices.size, 8)) )
+        cols = np.hstack(cols)
+        per_row = cols.shape[1]
+        A = csr_matrix( (np.ones(m * per_row, dtype=int),
+                         np.repeat(cols, 2, axis=0).ravel(),
+                         np.arange(m + 1, dtype=np.int64) * per_row),
+                        shape=(m, n) )
 
         print('A-matrix non-zero elements:', A.nnz)
         return A
 
-    # compute an array of residuals (one for each observation)
-    # params contains camera parameters, 3-D coordinates, and
-    # camera calibration parameters.
-    def fun(self, params, n_cameras, n_points, by_camera_point_indices, by_camera_points_2d):
-        error = None
-        # extract the parameters
+    # split the optimizer parameter vector into the camera poses, 3d
+    # points, K and distortion coefficients
+    def unpack_params(self, params, n_cameras, n_points):
         camera_params = params[:n_cameras * self.ncp].reshape((n_cameras, self.ncp))
-        
         points_3d = params[n_cameras * self.ncp:n_cameras * self.ncp + n_points * 3].reshape((n_points, 3))
-        
         if self.optimize_calib == 'global':
             # assemble K and distCoeffs from the optimizer param list
             camera_calib = params[n_cameras * self.ncp + n_points * 3:]
@@ -122,86 +152,243 @@ class Optimizer():
             # use a fixed K and distCoeffs
             K = self.K
             distCoeffs = self.distCoeffs
+        return camera_params, points_3d, K, distCoeffs
+
+    # project the 3d points into their observing cameras for all the
+    # observations at once.  This is the numpy equivalent of calling
+    # cv2.projectPoints() for each camera: rodrigues rotation, pinhole
+    # projection, then the opencv radial/tangential distortion model
+    # (k1, k2, p1, p2[, k3[, k4, k5, k6]]).  Returns an n x 2 array of
+    # uv coordinates.
+    def project(self, camera_params, points_3d, K, distCoeffs,
+                camera_indices, point_indices):
+        # rotate the points into their camera frames
+        R = rodrigues(camera_params[:,0:3])
+        pc = np.einsum('nij,nj->ni', R[camera_indices], points_3d[point_indices])
+        pc += camera_params[camera_indices, 3:6]
+
+        # pinhole projection and distortion
+        x = pc[:,0] / pc[:,2]
+        y = pc[:,1] / pc[:,2]
+        d = np.zeros(8)
+        d[:min(len(distCoeffs), 8)] = distCoeffs[:8]
+        k1, k2, p1, p2, k3, k4, k5, k6 = d
+        x2 = x * x
+        y2 = y * y
+        xy = x * y
+        r2 = x2 + y2
+        radial = (1 + r2 * (k1 + r2 * (k2 + r2 * k3))) \
+            / (1 + r2 * (k4 + r2 * (k5 + r2 * k6)))
+        xd = x * radial + 2 * p1 * xy + p2 * (r2 + 2 * x2)
+        yd = y * radial + p1 * (r2 + 2 * y2) + 2 * p2 * xy
+        uv = np.empty((len(x), 2))
+        uv[:,0] = K[0,0] * xd + K[0,2]
+        uv[:,1] = K[1,1] * yd + K[1,2]
+        return uv
+
+    # analytic jacobian of fun(): the derivatives of the (u, v)
+    # residuals of each observation with respect to its camera rvec
+    # and tvec, its 3d point, and (if optimize_calib == 'global') the
+    # shared f, cu, cv and distortion coefficients.  Returned as a
+    # sparse (csr) matrix with the same layout as
+    # bundle_adjustment_sparsity().
+    def jac(self, params, n_cameras, n_points, camera_indices, point_indices,
+            points_2d):
+        data, cols = self.jac_blocks(params, n_cameras, n_points,
+                                     camera_indices, point_indices)
+        n_obs, rows, per_row = data.shape
+        indices = np.repeat(cols, 2, axis=0).ravel()
+        indptr = np.arange(2 * n_obs + 1, dtype=np.int64) * per_row
+        n = n_cameras * self.ncp + n_points * 3 + (per_row - self.ncp - 3)
+        return csr_matrix((data.ravel(), indices, indptr), shape=(2 * n_obs, n))
+
+    # the dense per observation jacobian blocks: data[i] is the 2 x
+    # (6 + 3 [+ 8]) block of observation i (camera, point, calib
+    # columns) and cols[i] the matching parameter indices.
+    def jac_blocks(self, params, n_cameras, n_points, camera_indices,
+                   point_indices):
+        camera_params, points_3d, K, distCoeffs = \
+            self.unpack_params(params, n_cameras, n_points)
+        n_obs = len(camera_indices)
+
+        # rotated points (q) and camera frame points (pc)
+        rvec = camera_params[:,0:3]
+        R = rodrigues(rvec)
+        Rc = R[camera_indices]
+        q = np.einsum('nij,nj->ni', Rc, points_3d[point_indices])
+        pc = q + camera_params[camera_indices, 3:6]
+
+        # derivative of the rotated point with respect to rvec:
+        #   d(R X)/dr = -[R X]x R (r r^T + (R^T - I)[r]x) / |r|^2
+        # (Gallego & Yezzi), which is -[R X]x near r = 0.
+        theta2 = np.sum(rvec * rvec, axis=1)
+        skew_r = np.zeros((n_cameras, 3, 3))
+        skew_r[:,0,1] = -rvec[:,2]
+        skew_r[:,0,2] = rvec[:,1]
+        skew_r[:,1,0] = rvec[:,2]
+        skew_r[:,1,2] = -rvec[:,0]
+        skew_r[:,2,0] = -rvec[:,1]
+        skew_r[:,2,1] = rvec[:,0]
+        M = np.einsum('ni,nj->nij', rvec, rvec) \
+            + np.matmul(np.transpose(R, (0,2,1)) - np.identity(3), skew_r)
+        small = theta2 < 1e-12
+        M[~small] /= theta2[~small,np.newaxis,np.newaxis]
+        M[small] = np.identity(3)
+        A = np.matmul(R, M)[camera_indices]
+        # -[q]x A (cross q with each column of A)
+        dpc_dr = -np.cross(q[:,np.newaxis,:], np.transpose(A, (0,2,1)))
+        dpc_dr = np.transpose(dpc_dr, (0,2,1))
+
+        # pinhole projection
+        iz = 1.0 / pc[:,2]
+        x = pc[:,0] * iz
+        y = pc[:,1] * iz
+        dxy_dpc = np.zeros((n_obs, 2, 3))
+        dxy_dpc[:,0,0] = iz
+        dxy_dpc[:,0,2] = -x * iz
+        dxy_dpc[:,1,1] = iz
+        dxy_dpc[:,1,2] = -y * iz
+
+        # distortion
+        d = np.zeros(8)
+        d[:min(len(distCoeffs), 8)] = distCoeffs[:8]
+        k1, k2, p1, p2, k3, k4, k5, k6 = d
+        x2 = x * x
+        y2 = y * y
+        xy = x * y
+        r2 = x2 + y2
+        num = 1 + r2 * (k1 + r2 * (k2 + r2 * k3))
+        den = 1 + r2 * (k4 + r2 * (k5 + r2 * k6))
+        radial = num / den
+        dnum = k1 + r2 * (2 * k2 + r2 * 3 * k3)
+        dden = k4 + r2 * (2 * k5 + r2 * 3 * k6)
+        dradial = (dnum * den - num * dden) / (den * den) # d/d(r2)
+        fx = K[0,0]
+        fy = K[1,1]
+        duv_dxy = np.empty((n_obs, 2, 2))
+        duv_dxy[:,0,0] = fx * (radial + 2 * x2 * dradial + 2 * p1 * y + 6 * p2 * x)
+        duv_dxy[:,0,1] = fx * (2 * xy * dradial + 2 * p1 * x + 2 * p2 * y)
+        duv_dxy[:,1,0] = fy * (2 * xy * dradial + 2 * p1 * x + 2 * p2 * y)
+        duv_dxy[:,1,1] = fy * (radial + 2 * y2 * dradial + 6 * p1 * y + 2 * p2 * x)
+        duv_dpc = np.matmul(duv_dxy, dxy_dpc)
+
+        # assemble the per observation blocks (residual = obs - proj,
+        # so everything is negated)
+        n_calib = 8 if self.optimize_calib == 'global' else 0
+        per_row = self.ncp + 3 + n_calib
+        data = np.zeros((n_obs, 2, per_row))
+        data[:,:,0:3] = -np.matmul(duv_dpc, dpc_dr)
+        data[:,:,3:6] = -duv_dpc
+        data[:,:,6:9] = -np.matmul(duv_dpc, Rc)
+        if self.fixed_cameras is not None:
+            # held cameras don't move
+            data[self.fixed_cameras[camera_indices],:,0:6] = 0.0
+        cols = np.empty((n_obs, per_row), dtype=np.int64)
+        cols[:,0:6] = camera_indices[:,np.newaxis] * self.ncp + np.arange(6)
+        cols[:,6:9] = n_cameras * self.ncp + point_indices[:,np.newaxis] * 3 \
+            + np.arange(3)
+        if n_calib:
+            xd = x * radial + 2 * p1 * xy + p2 * (r2 + 2 * x2)
+            yd = y * radial + p1 * (r2 + 2 * y2) + 2 * p2 * xy
+            # f (fx == fy), cu, cv
+            data[:,0,9] = -xd
+            data[:,1,9] = -yd
+            data[:,0,10] = -1.0
+            data[:,1,11] = -1.0
+            # k1, k2, p1, p2, k3
+            r4 = r2 * r2
+            for j, rn in zip((12, 13, 16), (r2, r4, r4 * r2)):
+                data[:,0,j] = -fx * x * rn / den
+                data[:,1,j] = -fy * y * rn / den
+            data[:,0,14] = -fx * 2 * xy
+            data[:,1,14] = -fy * (r2 + 2 * y2)
+            data[:,0,15] = -fx * (r2 + 2 * x2)
+            data[:,1,15] = -fy * 2 * xy
+            cols[:,9:] = n_cameras * self.ncp + n_points * 3 + np.arange(8)
+        return data, cols
+
+    # compute an array of residuals (u and v error for each
+    # observation) params contains camera parameters, 3-D
+    # coordinates, and camera calibration parameters.
+    def fun(self, params, n_cameras, n_points, camera_indices, point_indices,
+            points_2d):
+        camera_params, points_3d, K, distCoeffs = \
+            self.unpack_params(params, n_cameras, n_points)
 
         #fixme: global calibration optimization, but force distortion
         #paramters to stay fixed to those originally given
         #distCoeffs = self.distCoeffs
 
-        sum = 0
-        # cams_3d = np.zeros((n_cameras, 3)) # for plotting
-        by_cam = []             # for debugging data set problems
-        for i, cam in enumerate(camera_params):
-            rvec = cam[:3]
-            tvec = cam[3:6]
-            # ypr, ned = self.rvectvec2yprned(rvec, tvec)
-            # cams_3d[i] = ned # for plotting
-            if len(by_camera_point_indices[i]) == 0:
-                continue
-            proj_points, jac = cv2.projectPoints(points_3d[by_camera_point_indices[i]], rvec, tvec, K, distCoeffs)
-            sum += len(proj_points.ravel())
-            cam_error = (by_camera_points_2d[i] - proj_points).ravel()
-            by_cam.append( [np.mean(np.abs(cam_error)),
-                            np.amax(np.abs(cam_error)),
-                            self.camera_map_fwd[i] ] )
-            if error is None:
-                error = cam_error
-            else:
-                error = np.append(error, cam_error)
-
+        proj_points = self.project(camera_params, points_3d, K, distCoeffs,
+                                   camera_indices, point_indices)
+        error = (points_2d - proj_points).ravel()
         mre = np.mean(np.abs(error))
-        std = np.std(error)
 
-        # debug
-        count_std = 0
-        count_bad = 0
-        for e in error.tolist():
-            if e > mre + 3 * std:
-                count_std += 1
-            if e > 10000:
-                count_bad += 1
-        print( 'std: %.2f %d/%d > 3*std (max: %.2f)' % (std, count_std, error.shape[0], np.amax(error)) )
-        by_cam = sorted(by_cam, key=lambda fields: fields[0], reverse=True)
-        for line in by_cam:
-            if line[0] > mre + 2*std:
-                print("  %s -- mean: %.3f max: %.3f" % (line[2], line[0], line[1]))
-        
-        # provide some runtime feedback for the operator
+        # provide some runtime feedback for the operator (the least
+        # squares solver evaluates fun() many times per iteration, so
+        # only report when the fit has actually improved.)
         if self.last_mre is None or 1.0 - mre/self.last_mre > 0.001:
             # mre has improved by more than 0.1%
             self.last_mre = mre
-            print('mre: %.3f std: %.3f max: %.2f' % (mre, np.std(error), np.amax(np.abs(error))) )
+            self.report(error, camera_indices, n_cameras)
             if self.optimize_calib == 'global':
                 print("K:\n", K)
                 print("distCoeffs: %.3f %.3f %.3f %.3f %.3f" %
                       (distCoeffs[0], distCoeffs[1], distCoeffs[2],
                        distCoeffs[3], distCoeffs[4]))
-            # if not self.graph is None:
-            #     points = points_3d
-            #     #points = cams_3d
-            #     self.graph.set_offsets(points[:,[1,0]])
-            #     self.graph.set_array(-points[:,2])
-            #     xmin, xmax = self.my_plot_range(points[:,1])
-            #     ymin, ymax = self.my_plot_range(points[:,0])
-            #     plt.xlim(xmin, xmax)
-            #     plt.ylim(ymin, ymax)
-            #     cmin, cmax = self.my_plot_range(-points[:,2], stats=True)
-            #     plt.clim(cmin, cmax)
-            #     plt.gcf().set_size_inches(16,9,forward=True)
-            #     plt.draw()
-            #     if False:
-            #         # animate the optimizer progress as a movie
-            #         # ex: ffmpeg -f image2 -r 2 -s 1280x720 -i optimizer-%03d.png -vcodec libx264 -crf 25  -pix_fmt yuv420p optimizer.mp4
-            #         plt_name = 'optimizer-%03d.png' % self.graph_counter
-            #         out_file = os.path.join(self.root, plt_name)
-            #         plt.savefig(out_file, dpi=80)
-            #         self.graph_counter += 1
-            #     plt.pause(0.01)
         return error
 
+    # error statistics and the cameras that aren't fitting well (for
+    # debugging data set problems)
+    def report(self, error, camera_indices, n_cameras):
+        abs_error = np.abs(error)
+        mre = np.mean(abs_error)
+        std = np.std(error)
+        count_std = np.count_nonzero(error > mre + 3 * std)
+        print( 'std: %.2f %d/%d > 3*std (max: %.2f)' % (std, count_std, error.shape[0], np.amax(error)) )
+        cam = np.repeat(camera_indices, 2)
+        count = np.bincount(cam, minlength=n_cameras)
+        cam_mean = np.bincount(cam, weights=abs_error, minlength=n_cameras) \
+            / np.maximum(count, 1)
+        cam_max = np.zeros(n_cameras)
+        np.maximum.at(cam_max, cam, abs_error)
+        for i in np.argsort(-cam_mean, kind='stable'):
+            if count[i] and cam_mean[i] > mre + 2*std:
+                print("  %s -- mean: %.3f max: %.3f" % (self.camera_map_fwd[i], cam_mean[i], cam_max[i]))
+        print('mre: %.3f std: %.3f max: %.2f' % (mre, std, np.amax(abs_error)) )
+
+    # robust loss cost of a residual vector (the same definition as
+    # least_squares(): 0.5 * f_scale^2 * sum(rho((r/f_scale)^2)))
+    def robust_cost(self, r):
+        z = (r / self.f_scale)**2
+        if self.loss == 'huber':
+            rho = np.where(z <= 1, z, 2 * np.sqrt(z) - 1)
+        elif self.loss == 'cauchy':
+            rho = np.log1p(z)
+        else:
+            rho = z
+        return 0.5 * self.f_scale**2 * np.sum(rho)
+
+    # iteratively reweighted least squares weights (rho'(z)) of each
+    # residual for the robust loss
+    def robust_weights(self, r):
+        z = (r / self.f_scale)**2
+        if self.loss == 'huber':
+            return np.where(z <= 1, 1.0, 1.0 / np.sqrt(np.maximum(z, 1.0)))
+        elif self.loss == 'cauchy':
+            return 1.0 / (1.0 + z)
+        else:
+            return np.ones(len(r))
+
     # assemble the structures and remapping indices required for
-    # optimizing a group of images/features
-    def setup(self, proj, groups, group_index, matches_list, optimized=False):
+    # optimizing a group of images/features.  If active (a set of
+    # image indices) is given, only those cameras are free: the
+    # problem is limited to the features seen by an active camera, and
+    # any other group cameras that see those features are held fixed.
+    def setup(self, proj, groups, group_index, tracks, optimized=False,
+              active=None):
         print('Setting up optimizer data structures...')
+        t_start = time.time()
         # if placed_images == None:
         #     placed_images = []
         #     # if no placed images specified, mark them all as placed
@@ -212,7 +399,32 @@ class Optimizer():
             i = proj.findIndexByName(name)
             placed_images.add(i)            
         print('Number of placed images:', len(placed_images))
-        
+
+        # select the observations of this group that land in placed
+        # images (one pass over the flat track arrays.)  A track is
+        # used if it keeps at least min_chain_length observations.
+        in_placed = np.zeros(len(proj.image_list), dtype=bool)
+        in_placed[list(placed_images)] = True
+        obs_track = tracks.obs_track()
+        sel = (tracks.group[obs_track] == group_index) \
+            & in_placed[tracks.obs_image]
+        count = np.bincount(obs_track[sel], minlength=len(tracks))
+        used = (tracks.group == group_index) & (count >= self.min_chain_length)
+        if active is not None:
+            # only the features seen by an active camera, and only the
+            # cameras that see those features
+            in_active = np.zeros(len(proj.image_list), dtype=bool)
+            in_active[list(active)] = True
+            seen = np.bincount(obs_track[sel & in_active[tracks.obs_image]],
+                               minlength=len(tracks))
+            used &= seen > 0
+        sel &= used[obs_track]
+        if active is not None:
+            placed_images = set(np.unique(tracks.obs_image[sel]).tolist())
+            print('Active images:', len(placed_images & set(active)),
+                  'fixed images:', len(placed_images - set(active)))
+        n_observations = np.count_nonzero(sel)
+
         # construct the camera index remapping
         self.camera_map_fwd = {}
         self.camera_map_rev = {}
@@ -222,97 +434,288 @@ class Optimizer():
         #print(self.camera_map_fwd)
         #print(self.camera_map_rev)
         
-        # initialize the feature index remapping
-        self.feat_map_fwd = {}
-        self.feat_map_rev = {}
-
         self.K = proj.cam.get_K(optimized)
         self.distCoeffs = np.array(proj.cam.get_dist_coeffs(optimized))
         
-        # assemble the initial camera estimates
+        # assemble the initial camera estimates (images without a
+        # valid optimized pose start from their original pose)
         self.n_cameras = len(placed_images)
         self.camera_params = np.empty(self.n_cameras * self.ncp)
         for cam_idx, global_index in enumerate(placed_images):
             image = proj.image_list[global_index]
-            rvec, tvec = image.get_proj(optimized)
+            opt_node = image.node.getChild('camera_pose_opt', True)
+            rvec, tvec = image.get_proj(optimized and opt_node.getBool('valid'))
             self.camera_params[cam_idx*self.ncp:cam_idx*self.ncp+self.ncp] = np.append(rvec, tvec)
+        if active is None:
+            self.fixed_cameras = None
+        else:
+            self.fixed_cameras = np.array( [ index not in active
+                                             for index in placed_images ],
+                                           dtype=bool )
+        cam_rev = np.full(len(proj.image_list), -1, dtype=np.int64)
+        cam_rev[list(self.camera_map_fwd.values())] = np.arange(self.n_cameras)
+        obs_cam = cam_rev[tracks.obs_image]
 
-        # count number of 3d points and observations
-        self.n_points = 0
-        n_observations = 0
-        for i, match in enumerate(matches_list):
-            # count the number of referenced observations
-            if match[1] == group_index: # used by the current group
-                count = 0
-                for m in match[2:]:
-                    if m[0] in placed_images:
-                        count += 1
-                if count >= self.min_chain_length:
-                    n_observations += count
-                    self.n_points += 1
-
-        # assemble 3d point estimates and build indexing maps
-        self.points_3d = np.empty(self.n_points * 3)
-        point_idx = 0
-        feat_used = 0
-        for i, match in enumerate(matches_list):
-            if match[1] == group_index: # used by the current group
-                count = 0
-                for m in match[2:]:
-                    if m[0] in placed_images:
-                        count += 1
-                if count >= self.min_chain_length:
-                    self.feat_map_fwd[i] = feat_used
-                    self.feat_map_rev[feat_used] = i
-                    feat_used += 1
-                    ned = np.array(match[0])
-                    if np.any(np.isnan(ned)):
-                        print(i, ned)
-                    self.points_3d[point_idx] = ned[0]
-                    self.points_3d[point_idx+1] = ned[1]
-                    self.points_3d[point_idx+2] = ned[2]
-                    point_idx += 3
-                
-        # assemble observations (image index, feature index, u, v)
-        self.by_camera_point_indices = [ [] for i in range(self.n_cameras) ]
-        self.by_camera_points_2d = [ [] for i in range(self.n_cameras) ]
-        #print('by_camera:', by_camera)
-        #points_2d = np.empty((n_observations, 2))
-        #obs_idx = 0
-        for i, match in enumerate(matches_list):
-            if match[1] == group_index: # used by the current group
-                count = 0
-                for m in match[2:]:
-                    if m[0] in placed_images:
-                        count += 1
-                if count >= self.min_chain_length:
-                    for m in match[2:]:
-                        if m[0] in placed_images:
-                            cam_index = self.camera_map_rev[m[0]]
-                            feat_index = self.feat_map_fwd[i]
-                            kp = m[1] # orig/distorted
-                            #kp = proj.image_list[m[0]].uv_list[m[1]] # undistorted
-                            self.by_camera_point_indices[cam_index].append(feat_index)
-                            self.by_camera_points_2d[cam_index].append(kp)
-
-        # convert to numpy native structures
-        for i in range(self.n_cameras):
-            size = len(self.by_camera_point_indices[i])
-            self.by_camera_point_indices[i] = np.array(self.by_camera_point_indices[i])
-            self.by_camera_points_2d[i] = np.asarray([self.by_camera_points_2d[i]]).reshape(size, 1, 2)
+        # feature index remapping and 3d point estimates
+        self.feat_map_rev = np.nonzero(used)[0]
+        self.n_points = len(self.feat_map_rev)
+        feat_index = np.cumsum(used) - 1
+        self.feat_map_fwd = dict(zip(self.feat_map_rev.tolist(),
+                                     range(self.n_points)))
+        points_ned = tracks.ned[self.feat_map_rev]
+        for i in np.nonzero(np.any(np.isnan(points_ned), axis=1))[0]:
+            print(self.feat_map_rev[i], points_ned[i])
+        self.points_3d = points_ned.ravel().copy()
 
         # generate the camera and point indices (for mapping the
         # sparse jacobian entries which define which observations
-        # depend on which parameters.)
-        self.camera_indices = np.empty(n_observations, dtype=int)
-        self.point_indices = np.empty(n_observations, dtype=int)
-        obs_idx = 0
+        # depend on which parameters.)  Observations are ordered by
+        # camera, and by track within each camera.
+        obs_idx = np.nonzero(sel)[0]
+        order = np.argsort(obs_cam[obs_idx], kind='stable')
+        obs_idx = obs_idx[order]
+        self.camera_indices = obs_cam[obs_idx]
+        self.point_indices = feat_index[obs_track[obs_idx]]
+        # observed (orig/distorted) uv of each observation
+        self.points_2d = tracks.obs_uv[obs_idx]
+        # track store observation index of each observation
+        self.obs_index = obs_idx
+        self.culled_obs = np.zeros(0, dtype=np.int64)
+        print("num observations:", n_observations)
+        self.split_by_camera()
+
+        mem = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        print('Setup took %.1f seconds (peak memory: %.0f MB)'
+              % (time.time() - t_start, mem))
+
+    # per camera views of the observations
+    def split_by_camera(self):
+        bounds = np.searchsorted(self.camera_indices,
+                                 np.arange(self.n_cameras + 1))
+        self.by_camera_point_indices = []
+        self.by_camera_points_2d = []
         for i in range(self.n_cameras):
-            for j in range(len(self.by_camera_point_indices[i])):
-                self.camera_indices[obs_idx] = i
-                self.point_indices[obs_idx] = self.by_camera_point_indices[i][j]
-                obs_idx += 1
-        print("num observations:", obs_idx)
+            self.by_camera_point_indices.append(self.point_indices[bounds[i]:bounds[i+1]])
+            self.by_camera_points_2d.append(self.points_2d[bounds[i]:bounds[i+1]])
+
+    # remove the observations with a reprojection error greater than
+    # mre + cull_std * std, and any points that are left with fewer
+    # than min_chain_length observations.  The removed track store
+    # observations are added to culled_obs.  Returns the parameter
+    # vector for the reduced problem and the number of observations
+    # removed.
+    def cull_outliers(self, params):
+        error = self.fun(params, self.n_cameras, self.n_points,
+                         self.camera_indices, self.point_indices,
+                         self.points_2d).reshape(-1, 2)
+        dist = np.linalg.norm(error, axis=1)
+        mre = np.mean(dist)
+        std = np.std(dist)
+        keep = dist <= mre + self.cull_std * std
+        count = np.bincount(self.point_indices[keep], minlength=self.n_points)
+        keep_point = count >= self.min_chain_length
+        keep &= keep_point[self.point_indices]
+        num_culled = np.count_nonzero(~keep)
+        print('cull: mre: %.3f std: %.3f removing %d observations and %d points'
+              % (mre, std, num_culled, np.count_nonzero(~keep_point)))
+        if not num_culled:
+            return params, 0
+        self.culled_obs = np.concatenate( (self.culled_obs,
+                                           self.obs_index[~keep]) )
+        new_index = np.cumsum(keep_point) - 1
+        self.camera_indices = self.camera_indices[keep]
+        self.point_indices = new_index[self.point_indices[keep]]
+        self.points_2d = self.points_2d[keep]
+        self.obs_index = self.obs_index[keep]
+        self.feat_map_rev = self.feat_map_rev[keep_point]
+        self.feat_map_fwd = dict(zip(self.feat_map_rev.tolist(),
+                                     range(len(self.feat_map_rev))))
+        camera_params, points_3d, K, distCoeffs = \
+            self.unpack_params(params, self.n_cameras, self.n_points)
+        calib = params[self.n_cameras * self.ncp + self.n_points * 3:]
+        self.n_points = len(self.feat_map_rev)
+        self.split_by_camera()
+        self.last_mre = None
+        return np.hstack((camera_params.ravel(),
+                          points_3d[keep_point].ravel(), calib)), num_culled
+
+    # Levenberg-Marquardt bundle adjustment that exploits the
+    # camera/point block structure: the 3x3 point blocks of the normal
+    # equations are inverted directly and the points are eliminated
+    # (Schur complement), leaving a small reduced system in just the
+    # camera (and global calibration) parameters.  That is solved with
+    # a sparse direct solve or block jacobi preconditioned conjugate
+    # gradients (schur_solver), then the point updates are recovered
+    # by back substitution.  Returns an OptimizeResult like
+    # least_squares().  Note: bounds are not supported.
+    def solve_schur(self, x0, n_cameras, n_points, camera_indices,
+                    point_indices, points_2d):
+        args = (n_cameras, n_points, camera_indices, point_indices, points_2d)
+        nc = n_cameras * self.ncp # first point parameter
+        npt = n_points * 3
+        x = x0.copy()
+        r = self.fun(x, *args)
+        cost = self.robust_cost(r)
+        nfev = 1
+        njev = 0
+        lam = 1e-3
+        status = 0
+        message = 'maximum number of iterations reached'
+        for iteration in range(self.max_iterations):
+            # jacobian split into camera side (cameras + calib) and
+            # point blocks
+            data, cols = self.jac_blocks(x, n_cameras, n_points,
+                                         camera_indices, point_indices)
+            njev += 1
+            # robust loss: scale the residuals and jacobian rows by the
+            # square root of the irls weights
+            sw = np.sqrt(self.robust_weights(r))
+            data *= sw.reshape(-1, 2, 1)
+            rw = r * sw
+            n_obs = len(camera_indices)
+            cam_data = np.concatenate( (data[:,:,0:6], data[:,:,9:]), axis=2 )
+            cam_cols = np.concatenate( (cols[:,0:6], cols[:,9:] - npt), axis=1 )
+            nk = cam_data.shape[2]
+            n_cam_side = nc + (nk - self.ncp)
+            Jc = csr_matrix( (cam_data.ravel(),
+                              np.repeat(cam_cols, 2, axis=0).ravel(),
+                              np.arange(2 * n_obs + 1) * nk),
+                             shape=(2 * n_obs, n_cam_side) )
+            Jp = csr_matrix( (data[:,:,6:9].ravel(),
+                              np.repeat(cols[:,6:9] - nc, 2, axis=0).ravel(),
+                              np.arange(2 * n_obs + 1) * 3),
+                             shape=(2 * n_obs, npt) )
+            U = (Jc.T @ Jc).tocsr()
+            W = (Jc.T @ Jp).tocsr()
+            Vo = np.einsum('nki,nkj->nij', data[:,:,6:9], data[:,:,6:9])
+            V = np.empty((n_points, 3, 3))
+            for i in range(3):
+                for j in range(3):
+                    V[:,i,j] = np.bincount(point_indices, weights=Vo[:,i,j],
+                                           minlength=n_points)
+            gc = Jc.T @ rw
+            gp = Jp.T @ rw
+            gnorm = max(np.amax(np.abs(gc)), np.amax(np.abs(gp)))
+            if gnorm < 1e-10:
+                status = 1
+                message = 'gradient below tolerance'
+                break
+            U_diag = U.diagonal()
+            V_diag = np.diagonal(V, axis1=1, axis2=2)
+
+            # try damped steps until the cost goes down
+            while True:
+                # augmented point blocks and their inverses
+                Va = V + lam * V_diag[:,:,np.newaxis] * np.identity(3) \
+                    + 1e-12 * np.identity(3)
+                Vinv = np.linalg.inv(Va)
+                Vinv_m = bsr_matrix( (Vinv, np.arange(n_points),
+                                      np.arange(n_points + 1)),
+                                     shape=(npt, npt) )
+                WVinv = (W @ Vinv_m).tocsr()
+                S = (U + diags(lam * U_diag + 1e-12) - WVinv @ W.T).tocsr()
+                rhs = -gc + WVinv @ gp
+                if self.schur_solver == 'cg':
+                    # block jacobi preconditioner (6x6 camera blocks)
+                    S_cam = S[:nc,:nc]
+                    blocks = np.empty((n_cameras, self.ncp, self.ncp))
+                    for i in range(self.ncp):
+                        for j in range(self.ncp):
+                            blocks[:,i,j] = S_cam[np.arange(i, nc, self.ncp),
+                                                  np.arange(j, nc, self.ncp)]
+                    M = block_diag( (bsr_matrix( (np.linalg.inv(blocks),
+                                                  np.arange(n_cameras),
+                                                  np.arange(n_cameras + 1)),
+                                                 shape=(nc, nc) ),
+                                     diags(1.0 / S.diagonal()[nc:])) )
+                    dc, info = cg(S, rhs, M=M, maxiter=500)
+                else:
+                    dc = spsolve(S.tocsc(), rhs)
+                dp = -(Vinv_m @ (gp + W.T @ dc))
+                dx = np.concatenate( (dc[:nc], dp, dc[nc:]) )
+                x_new = x + dx
+                r_new = self.fun(x_new, *args)
+                nfev += 1
+                cost_new = self.robust_cost(r_new)
+                if cost_new < cost:
+                    break
+                lam *= 10.0
+                if lam > 1e16:
+                    break
+            if cost_new >= cost:
+                status = 2
+                message = 'no further improvement possible'
+                break
+            dcost = cost - cost_new
+            x = x_new
+            r = r_new
+            print('iteration %d: cost %.6e reduction %.6e lambda %.1e'
+                  % (iteration, cost_new, dcost, lam))
+            lam = max(lam / 3.0, 1e-12)
+            if dcost < self.ftol * cost:
+                cost = cost_new
+                status = 2
+                message = '`ftol` termination condition is satisfied.'
+                break
+            cost = cost_new
+        return OptimizeResult(x=x, fun=r, cost=cost, nfev=nfev, njev=njev,
+                              status=status, message=message,
+                              success=status > 0)
+
+    # run the selected solver from x0 on the current observations
+    def solve(self, x0, A):
+        args = (self.n_cameras, self.n_points, self.camera_indices,
+                self.point_indices, self.points_2d)
+        if self.solver == 'schur':
+            return self.solve_schur(x0, *args)
+        if self.loss == 'linear':
+            return self.solve_trf(x0, A, args, None)
+        # robust loss: iteratively reweighted least squares.  (The
+        # least_squares() built in robust losses converge very slowly
+        # here when many residuals start out beyond f_scale.)
+        x = x0
+        cost = self.robust_cost(self.fun(x, *args))
+        nfev = 0
+        njev = 0
+        for i in range(self.irls_passes):
+            sw = np.sqrt(self.robust_weights(self.fun(x, *args)))
+            res = self.solve_trf(x, A, args, sw)
+            nfev += res.nfev
+            njev += res.njev
+            x = res.x
+            res.fun = self.fun(x, *args)
+            cost_new = self.robust_cost(res.fun)
+            print('reweight pass %d: robust cost %.6e' % (i, cost_new))
+            if cost - cost_new < self.ftol * cost:
+                break
+            cost = cost_new
+        res.cost = cost_new
+        res.nfev = nfev
+        res.njev = njev
+        return res
+
+    # scipy least_squares (trust region reflective) solve, with the
+    # residuals optionally scaled by fixed weights (sw)
+    def solve_trf(self, x0, A, args, sw):
+        if self.analytic_jac or self.fixed_cameras is not None:
+            # (fixed cameras need the analytic jacobian)
+            jac = self.jac
+        else:
+            jac = '2-point'
+        fun = self.fun
+        if sw is not None:
+            fun = lambda x, *args: sw * self.fun(x, *args)
+            if callable(jac):
+                jac = lambda x, *args: diags(sw) @ self.jac(x, *args)
+        return least_squares(fun, x0,
+                             jac=jac,
+                             jac_sparsity=A,
+                             verbose=2,
+                             method='trf',
+                             loss='linear',
+                             ftol=self.ftol,
+                             x_scale='jac',
+                             args=args)
 
     # assemble the structures and remapping indices required for
     # optimizing a group of images/features, call the optimizer, and
@@ -325,12 +728,17 @@ class Optimizer():
         else:
             x0 = np.hstack((self.camera_params.ravel(), self.points_3d.ravel()))
         f0 = self.fun(x0, self.n_cameras, self.n_points,
-                      self.by_camera_point_indices, self.by_camera_points_2d)
+                      self.camera_indices, self.point_indices, self.points_2d)
         mre_start = np.mean(np.abs(f0))
 
-        A = self.bundle_adjustment_sparsity(self.n_cameras, self.n_points,
-                                            self.camera_indices,
-                                            self.point_indices)
+        if self.analytic_jac or self.fixed_cameras is not None \
+           or self.solver == 'schur':
+            # the jacobian sparsity comes with the analytic jacobian
+            A = None
+        else:
+            A = self.bundle_adjustment_sparsity(self.n_cameras, self.n_points,
+                                                self.camera_indices,
+                                                self.point_indices)
 
         if self.with_bounds:
             # quick test of bounds ... allow camera parameters to go free,
@@ -382,16 +790,22 @@ class Optimizer():
         
         t0 = time.time()
         # bounds=bounds,
-        res = least_squares(self.fun, x0,
-                            jac_sparsity=A,
-                            verbose=2,
-                            method='trf',
-                            loss='linear',
-                            ftol=self.ftol,
-                            x_scale='jac',
-                            args=(self.n_cameras, self.n_points,
-                                  self.by_camera_point_indices,
-                                  self.by_camera_points_2d))
+        res = self.solve(x0, A)
+        # reweight and cull: drop the worst outliers and solve again
+        # (starting from the previous solution) until nothing more is
+        # culled.
+        if self.cull_std > 0:
+            for i in range(self.cull_passes):
+                x, num_culled = self.cull_outliers(res.x)
+                if not num_culled:
+                    break
+                if A is not None:
+                    A = self.bundle_adjustment_sparsity(self.n_cameras,
+                                                        self.n_points,
+                                                        self.camera_indices,
+                                                        self.point_indices)
+                res = self.solve(x, A)
+            print('Culled observations:', len(self.culled_obs))
         t1 = time.time()
         print("Optimization took {0:.0f} seconds".format(t1 - t0))
         # print(res['x'])
@@ -7,12 +7,12 @@ import fractions
 import json
 import math
 from matplotlib import pyplot as plt
+import multiprocessing
 import numpy as np
 import os.path
 import pickle
 from progress.bar import Bar
 import pyexiv2                  # dnf install python3-exiv2 (py3exiv2)
-import scipy.interpolate
 import subprocess
 import sys
 import time
@@ -29,6 +29,9 @@ from . import ImageList
 from . import Render
 from . import transformations
 
+# the feature detection stages timed by detect_image_features()
+detect_stages = ('decode', 'equalize', 'detect', 'undistort', 'filter',
+                 'save')
 
 class ProjectMgr():
     def __init__(self, project_dir, create=False):
@@ -236,53 +239,118 @@ class ProjectMgr():
     def set_matcher_params(self, mparams):
         self.matcher_params = mparams
         
-    def detect_features(self, scale, show=False):
+    # detect, undistort, filter and save the features of one image.
+    # Returns the image size (read while decoding) so a worker process
+    # can hand it back to the parent's property tree, and the time
+    # spent in each stage (see detect_stages.)
+    def detect_image_features(self, image, scale):
+        #print "detecting features and computing descriptors: " + image.name
+        t0 = time.time()
+        rgb = image.load_rgb(scale=scale)
+        t1 = time.time()
+        rgb = Image.equalize_rgb(rgb)
+        t2 = time.time()
+        image.detect_features(rgb, scale)
+        t3 = time.time()
+        self.undistort_image_keypoints(image)
+        t4 = time.time()
+
+        # Filter out of bound undistorted feature points
+        width, height = image.get_size()
+        margin = 0
+        uv = image.uv_list
+        keep = (uv[:,0] >= margin) & (uv[:,0] <= width - margin) \
+            & (uv[:,1] >= margin) & (uv[:,1] <= height - margin)
+        image.filter_features(keep)
+        t5 = time.time()
+
+        #print("save features")
+        image.save_features()
+        #print("save descriptors")
+        image.save_descriptors()
+        #print("finished image")
+        # clear descriptor memory(?)
+        image.des_list = None
+        image.save_matches()
+        t6 = time.time()
+        times = np.diff( [t0, t1, t2, t3, t4, t5, t6] )
+        return width, height, times
+
+    # With jobs > 1 the images are spread across a pool of worker
+    # processes.  Each worker decodes, detects, undistorts, filters
+    # and saves its images; the parent only records the image size
+    # and keypoints it hands back.  Images that already have features
+    # are skipped (in the parent) so an interrupted run can be
+    # restarted.
+    def detect_features(self, scale, show=False, jobs=1):
         if not show:
             bar = Bar('Detecting features:', max = len(self.image_list))
-        for image in self.image_list:
+        todo = []
+        for i, image in enumerate(self.image_list):
             image.load_features()
-            if len(image.kp_list) > 0:
+            if image.num_features() > 0:
                 print("skipping:", image.name)
                 if not show:
                     bar.next()
                 continue
-            #print "detecting features and computing descriptors: " + image.name
-            rgb = image.load_rgb(equalize=True)
-            image.detect_features(rgb, scale)
-
-            # Filter out of bound undistorted feature points.
-            # Traverse the list in reverse so we can safely remove
-            # features if needed
-            self.undistort_image_keypoints(image)
-            width, height = image.get_size()
-            margin = 0
-            for i in reversed(range(len(image.uv_list))):
-                uv = image.uv_list[i]
-                if uv[0] < margin or uv[0] > width - margin \
-                   or uv[1] < margin or uv[1] > height - margin:
-                    #print ' ', i, uv
-                    image.kp_list.pop(i)                             # python list
-                    image.des_list = np.delete(image.des_list, i, 0) # np array
-
-            #print("save features")
-            image.save_features()
-            #print("save descriptors")
-            image.save_descriptors()
-            #print("finished image")
-            # clear descriptor memory(?)
-            image.des_list = None
-            image.save_matches()
-            if show:
-                result = image.show_features()
-                if result == 27 or result == ord('q'):
-                    break
-            if not show:
-                bar.next()
+            todo.append(i)
+        times = np.zeros(len(detect_stages))
+        if jobs > 1 and not show and len(todo) > 1:
+            # fork so the workers inherit the property tree and camera
+            # config without pickling them
+            ctx = multiprocessing.get_context('fork')
+            pool = ctx.Pool(jobs, initializer=_init_detect_worker,
+                            initargs=(self, scale))
+            try:
+                for i, width, height, kp_array, image_times \
+                    in pool.imap_unordered(_detect_worker, todo):
+                    times += image_times
+                    image = self.image_list[i]
+                    image.node.setInt('width', width)
+                    image.node.setInt('height', height)
+                    image.kp_array = kp_array
+                    image.match_list = {}
+                    bar.next()
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        else:
+            for i in todo:
+                image = self.image_list[i]
+                width, height, image_times \
+                    = self.detect_image_features(image, scale)
+                times += image_times
+                if show:
+                    result = image.show_features()
+                    if result == 27 or result == ord('q'):
+                        break
+                if not show:
+                    bar.next()
         if not show:
             bar.finish()
+        if len(todo):
+            self.detect_profile_report(times, len(todo), jobs)
 
         self.save_images_info()
 
+    # print the time spent in each detection stage (summed over all
+    # the images and workers)
+    def detect_profile_report(self, times, num_images, jobs=1):
+        total = np.sum(times)
+        if jobs > 1:
+            print('Detection profile (%d images, summed over %d workers):'
+                  % (num_images, jobs))
+        else:
+            print('Detection profile (%d images):' % num_images)
+        for name, t in zip(detect_stages, times):
+            print('  %-10s %8.1f sec %6.3f sec/image %5.1f%%'
+                  % (name + ':', t, t / num_images, 100 * t / max(total, 1e-9)))
+        print('  %-10s %8.1f sec %6.3f sec/image'
+              % ('total:', total, total / num_images))
+
     def show_features_image(self, image):
         result = image.show_features()
         return result
@@ -328,37 +396,15 @@ class ProjectMgr():
     def undistort_uvlist(self, image, uv_orig):
         if len(uv_orig) == 0:
             return []
-        # camera parameters
-        dist_coeffs = np.array(self.cam.get_dist_coeffs())
-        K = self.cam.get_K()
-        # assemble the points in the proper format
-        uv_raw = np.zeros((len(uv_orig),1,2), dtype=np.float32)
-        for i, kp in enumerate(uv_orig):
-            uv_raw[i][0] = (kp[0], kp[1])
-        # do the actual undistort
-        uv_new = cv2.undistortPoints(uv_raw, K, dist_coeffs, P=K)
-        # return the results in an easier format
-        result = []
-        for i, uv in enumerate(uv_new):
-            result.append(uv_new[i][0])
-            #print "  orig = %s  undistort = %s" % (uv_raw[i][0], uv_new[i][0]
-        return result
+        return self.cam.undistort(uv_orig)
         
     # for each feature in each image, compute the undistorted pixel
     # location (from the calibrated distortion parameters)
     def undistort_image_keypoints(self, image, optimized=False):
-        if len(image.kp_list) == 0:
+        if image.num_features() == 0:
             return
-        K = self.cam.get_K(optimized)
-        uv_raw = np.zeros((len(image.kp_list),1,2), dtype=np.float32)
-        for i, kp in enumerate(image.kp_list):
-            uv_raw[i][0] = (kp.pt[0], kp.pt[1])
-        dist_coeffs = self.cam.get_dist_coeffs(optimized)
-        uv_new = cv2.undistortPoints(uv_raw, K, np.array(dist_coeffs), P=K)
-        image.uv_list = []
-        for i, uv in enumerate(uv_new):
-            image.uv_list.append(uv_new[i][0])
-            # print("  orig = %s  undistort = %s" % (uv_raw[i][0], uv_new[i]        
+        image.uv_list = self.cam.undistort(image.kp_pts(), optimized)
+
     # for each feature in each image, compute the undistorted pixel
     # location (from the calibrated distortion parameters)
     def undistort_keypoints(self, optimized=False):
@@ -371,35 +417,7 @@ class ProjectMgr():
     # for each uv in the provided uv list, apply the distortion
     # formula to compute the original distorted value.
     def redistort(self, uv_list, optimized=False):
-        K = self.cam.get_K(optimized)
-        dist_coeffs = self.cam.get_dist_coeffs(optimized)
-        fx = K[0,0]
-        fy = K[1,1]
-        cx = K[0,2]
-        cy = K[1,2]
-        k1, k2, p1, p2, k3 = dist_coeffs
-        
-        uv_distorted = []
-        for pt in uv_list:
-            x = (pt[0] - cx) / fx
-            y = (pt[1] - cy) / fy
-
-            # Compute radius^2
-            r2 = x**2 + y**2
-            r4, r6 = r2**2, r2**3
-
-            # Compute tangential distortion
-            dx = 2*p1*x*y + p2*(r2 + 2*x*x)
-            dy = p1*(r2 + 2*y*y) + 2*p2*x*y
-
-            # Compute radial factor
-            Lr = 1.0 + k1*r2 + k2*r4 + k3*r6
-
-            ud = Lr*x + dx
-            vd = Lr*y + dy
-            uv_distorted.append( [ud * fx + cx, vd * fy + cy] )
-            
-        return uv_distorted
+        return self.cam.distort(uv_list, optimized).tolist()
     
     def compute_kp_usage(self, all=False):
         print("Determining feature usage in matching pairs...")
@@ -407,25 +425,25 @@ class ProjectMgr():
         # during feature matching
         if all:
             for image in self.image_list:
-                image.kp_used = np.ones(len(image.kp_list), np.bool_)
+                image.kp_used = np.ones(image.num_features(), np.bool_)
         else:
             for image in self.image_list:
-                image.kp_used = np.zeros(len(image.kp_list), np.bool_)
+                image.kp_used = np.zeros(image.num_features(), np.bool_)
             for i1 in self.image_list:
                 #print(i1.name, len(i1.match_list))
                 for key in i1.match_list:
                     matches = i1.match_list[key]
                     i2 = self.findImageByName(key)
-                    if not i2 is None:
+                    if not i2 is None and len(matches):
                         # ignore match pairs not from our area set
-                        for k, pair in enumerate(matches):
-                            i1.kp_used[ pair[0] ] = True
-                            i2.kp_used[ pair[1] ] = True
+                        pairs = np.array(matches, dtype=int).reshape(-1, 2)
+                        i1.kp_used[ pairs[:,0] ] = True
+                        i2.kp_used[ pairs[:,1] ] = True
                     
     def compute_kp_usage_new(self, matches_direct):
         print("Determining feature usage in matching pairs...")
         for image in self.image_list:
-            image.kp_used = np.zeros(len(image.kp_list), np.bool_)
+            image.kp_used = np.zeros(image.num_features(), np.bool_)
         for match in matches_direct:
             for p in match[1:]:
                 image = self.image_list[ p[0] ]
@@ -479,6 +497,25 @@ class ProjectMgr():
             pt_list.append(p)
         return pt_list
 
+    # project the image corners onto a flat ground plane (using the
+    # current camera pose) and record the footprint in
+    # image.corner_list_xy (x = east, y = north)
+    def compute_image_footprints(self, ground_m):
+        K = self.cam.get_K()
+        IK = np.linalg.inv(K)
+        for image in self.image_list:
+            w, h = image.get_size()
+            corner_list = [ [0, 0], [w, 0], [w, h], [0, h] ]
+            body2ned = image.get_body2ned()
+            cam2body = image.get_cam2body()
+            vec_list = self.projectVectors(IK, body2ned, cam2body, corner_list)
+            ned, ypr, quat = image.get_camera_pose()
+            pts_ned = self.intersectVectorsWithGroundPlane(ned, ground_m,
+                                                           vec_list)
+            image.corner_list_xy = []
+            for p in pts_ned:
+                image.corner_list_xy.append( [p[1], p[0]] )
+
     def polyval2d(self, x, y, m):
         order = int(np.sqrt(len(m))) - 1
         ij = itertools.product(range(order+1), range(order+1))
@@ -512,104 +549,71 @@ class ProjectMgr():
     # 1. make a grid (i.e. 8x8) of undistored uv coordinates covering the whole image
     # 2. project these into vectors
     # 3. intersect them with the srtm terrain to get ned coordinates
-    # 4. use linearndinterpolator ... g = scipy.interpolate.LinearNDInterpolator([[0,0],[1,0],[0,1],[1,1]], [[0,4,8],[1,3,2],[2,2,-4],[4,1,0]])
-    #    with origin uv vs. 3d location to build a table
-    # 5. interpolate original uv coordinates to 3d locations
+    # 4. the grid is regular in uv, so each keypoint's 3d location is
+    #    a bilinear interpolation of the 4 corners of its grid cell
+    #    (all keypoints of an image in one vectorized lookup.)
     def fastProjectKeypointsTo3d(self, sss):
         bar = Bar('Projecting keypoints to 3d:',
                   max = len(self.image_list))
-        K = self.cam.get_K()
-        IK = np.linalg.inv(K)
         for image in self.image_list:
-            # print(image.name)
-            # build a regular grid of uv coordinates
-            w, h = image.get_size()
-            steps = 32
-            u_grid = np.linspace(0, w-1, steps+1)
-            v_grid = np.linspace(0, h-1, steps+1)
-            uv_raw = []
-            for u in u_grid:
-                for v in v_grid:
-                    uv_raw.append( [u,v] )
-
-            if False: # assuming the original grid is distorted, but lets not do that!
-                # undistort the grid of points
-                uv_grid = self.undistort_uvlist(image, uv_raw)
-
-                # filter crazy values when can happen out at the very fringes
-                half_width = w * 0.5
-                half_height = h * 0.5
-                uv_filt = []
-                for i, p in enumerate(uv_grid):
-                    if p[0] < -half_width or p[0] > w + half_width:
-                        print("rejecting width outlier:", p, '(', uv_raw[i], ')')
-                        continue
-                    if p[1] < -half_height or p[1] > h + half_height:
-                        print("rejecting height outlier:", p, '(', uv_raw[i], ')')
-                        continue
-                    uv_filt.append(p)
-                #print('raw pts:', len(uv_raw), 'undist pts:', len(uv_filt))
-            else:
-                # no filtering by default if the grid begins undistored
-                uv_filt = uv_raw
-                
-            # project the grid out into vectors
-            body2ned = image.get_body2ned() # IR
-
-            # M is a transform to map the lens coordinate system (at
-            # zero roll/pitch/yaw to the ned coordinate system at zero
-            # roll/pitch/yaw).  It is essentially a +90 pitch followed
-            # by +90 roll (or equivalently a +90 yaw followed by +90
-            # pitch.)
-            cam2body = image.get_cam2body()
-            
-            vec_list = self.projectVectors(IK, body2ned, cam2body, uv_filt)
-
-            # intersect the vectors with the surface to find the 3d points
-            ned, ypr, quat = image.get_camera_pose()
-            coord_list = sss.interpolate_vectors(ned, vec_list)
-
-            # filter the coordinate list for bad interpolation
-            coord_filt = []
-            for i in reversed(range(len(coord_list))):
-                if np.isnan(coord_list[i][0]):
-                    print("rejecting ground interpolation fault:", uv_filt[i])
-                    coord_list.pop(i)
-                    uv_filt.pop(i)
-
-            # build the multidimenstional interpolator that relates
-            # undistored uv coordinates to their 3d location.  Note we
-            # could also relate the original raw/distored points to
-            # their 3d locations and interpolate from the raw uv's,
-            # but we already have a convenient list of undistored uv
-            # points.
-            g = scipy.interpolate.LinearNDInterpolator(uv_filt, coord_list)
-
-            # interpolate all the keypoints now to approximate their
-            # 3d locations
-            image.coord_list = []
-            for i, uv in enumerate(image.uv_list):
-                if image.kp_used[i]:
-                    coord = g(uv)
-                    # coord[0] is the 3 element vector
-                    if not np.isnan(coord[0][0]):
-                        image.coord_list.append(coord[0])
-                    else:
-                        print("nan alert!")
-                        print("a feature is too close to an edge and numerically fell off the edge of the interpolator area..")
-                        print("  uv:", uv, "coord:", coord)
-                        print("  orig:", image.kp_list[i].pt)
-                        #or append zeros which would be a hack until
-                        #figuring out the root cause of the problem
-                        #... if it isn't wrong image dimensions in the
-                        #.info file...
-                        #
-                        image.coord_list.append(np.zeros(3))
-                else:
-                    image.coord_list.append(np.zeros(3)*np.nan)
+            image.coord_list = self.projectKeypointsTo3d(image, sss)
             bar.next()
         bar.finish()
-        
+
+    # the 3d location (n x 3 array) of each keypoint of an image (nan
+    # for unused keypoints)
+    def projectKeypointsTo3d(self, image, sss, steps=32):
+        K = self.cam.get_K()
+        IK = np.linalg.inv(K)
+        # build a regular grid of uv coordinates (the original grid
+        # is assumed to be undistorted)
+        w, h = image.get_size()
+        u_grid = np.linspace(0, w-1, steps+1)
+        v_grid = np.linspace(0, h-1, steps+1)
+        uu, vv = np.meshgrid(u_grid, v_grid, indexing='ij')
+        uvh = np.column_stack( (uu.ravel(), vv.ravel(),
+                                np.ones(uu.size)) )
+
+        # project the grid out into (unit) ned vectors.  M (cam2body)
+        # is a transform to map the lens coordinate system (at zero
+        # roll/pitch/yaw to the ned coordinate system at zero
+        # roll/pitch/yaw).  It is essentially a +90 pitch followed by
+        # +90 roll (or equivalently a +90 yaw followed by +90 pitch.)
+        body2ned = image.get_body2ned() # IR
+        cam2body = image.get_cam2body()
+        vecs = uvh.dot( np.asarray(body2ned.dot(cam2body).dot(IK)).T )
+        vecs /= np.linalg.norm(vecs, axis=1)[:,np.newaxis]
+
+        # intersect the vectors with the surface to find the 3d points
+        ned, ypr, quat = image.get_camera_pose()
+        grid = sss.intersect_vectors(ned, vecs).reshape(steps+1, steps+1, 3)
+        if np.any(np.isnan(grid)):
+            print("ground interpolation fault:", image.name,
+                  np.count_nonzero(np.isnan(grid[:,:,0])), "grid points")
+
+        # bilinear lookup of the used keypoints in the (regular) grid
+        coords = np.full((len(image.uv_list), 3), np.nan)
+        used = np.nonzero(image.kp_used)[0]
+        uv = np.asarray(image.uv_list, dtype=np.float64)[used]
+        x = uv[:,0] * steps / (w - 1)
+        y = uv[:,1] * steps / (h - 1)
+        i = np.clip(np.floor(x).astype(int), 0, steps - 1)
+        j = np.clip(np.floor(y).astype(int), 0, steps - 1)
+        fx = (x - i)[:,np.newaxis]
+        fy = (y - j)[:,np.newaxis]
+        result = (grid[i,j] * (1 - fx) + grid[i+1,j] * fx) * (1 - fy) \
+            + (grid[i,j+1] * (1 - fx) + grid[i+1,j+1] * fx) * fy
+        # keypoints outside the grid area (or in a cell with a bad
+        # ground interpolation)
+        bad = (x < 0) | (x > steps) | (y < 0) | (y > steps) \
+            | np.isnan(result[:,0])
+        if np.any(bad):
+            print("nan alert!", image.name, np.count_nonzero(bad),
+                  "features fell off the edge of the interpolator area")
+            result[bad] = 0.0
+        coords[used] = result
+        return coords
+
     def fastProjectKeypointsToGround(self, ground_m, cam_dict=None):
         bar = Bar('Projecting keypoints to 3d:',
                   max = len(self.image_list))
@@ -643,3 +647,18 @@ class ProjectMgr():
             
             bar.next()
         bar.finish()
+
+# worker process state for detect_features()
+_worker_detect_proj = None
+_worker_detect_scale = None
+
+def _init_detect_worker(proj, scale):
+    global _worker_detect_proj, _worker_detect_scale
+    _worker_detect_proj = proj
+    _worker_detect_scale = scale
+
+def _detect_worker(i):
+    image = _worker_detect_proj.image_list[i]
+    width, height, times \
+        = _worker_detect_proj.detect_image_features(image, _worker_detect_scale)
+    return i, width, height, image.kp_array, times
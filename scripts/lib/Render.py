@@ -2,7 +2,9 @@ import cv2
 import math
 import numpy as np
 
+from . import Camera
 from . import ImageList
+from . import SpatialIndex
 
 class Render():
     def __init__(self):
@@ -64,7 +66,7 @@ class Render():
         else:
             src = cv2.drawKeypoints(equalized, [],
                                     color=(0,255,0), flags=0)
-        undist = cv2.undistort(src, K, np.array(dist_coeffs))
+        undist = Camera.undistort_image(src, K, dist_coeffs)
         #print "corners:\n", corners
         #print "target:\n", target
         M = cv2.getPerspectiveTransform(corners, target)
@@ -231,14 +233,18 @@ class Render():
         cv2.imwrite(file, base_image)
 
     def drawSquare(self, placed_list, source_dir=None,
-                   cm_per_pixel=15.0, blend_cm=200, bounds=None, file=None):
+                   cm_per_pixel=15.0, blend_cm=200, bounds=None, file=None,
+                   index=None):
         (xmin, ymin, xmax, ymax) = bounds
         xcenter = (xmin + xmax) * 0.5
         ycenter = (ymin + ymax) * 0.5
         pad = (xmax - xmin) * 0.5
+        if index is None:
+            index = SpatialIndex.SpatialIndex(placed_list)
         draw_list = ImageList.getImagesCoveringPoint(placed_list, 
                                                      xcenter, ycenter, pad,
-                                                     only_placed=True)
+                                                     only_placed=True,
+                                                     index=index)
         if len(draw_list):
             self.drawImages( draw_list, source_dir=source_dir,
                              cm_per_pixel=cm_per_pixel, blend_cm=blend_cm,
@@ -273,6 +279,9 @@ class Render():
         #xpixel = (xmax - xmin) * 100.0 / cm_per_pixel
         #ypixel = (ymax - ymin) * 100.0 / cm_per_pixel
 
+        # index the placed image footprints once for all grid squares
+        index = SpatialIndex.SpatialIndex(placed_list)
+
         f = open('gdalscript.sh', 'w')
         f.write('#!/bin/sh\n\n')
         f.write('rm -f tile*.tif\n')
@@ -289,7 +298,8 @@ class Render():
                                           cm_per_pixel=cm_per_pixel,
                                           blend_cm=blend_cm,
                                           bounds=(x, y, x+grid_m, y+grid_m),
-                                          file=jpgfile)
+                                          file=jpgfile,
+                                          index=index)
                 if len(images):
                     (ul_lon, ul_lat) = ImageList.cart2wgs84(x, y+grid_m,
                                                             self.ref_lon,
@@ -1,17 +1,38 @@
 # a class to manage SRTM surfaces
 
+from collections import OrderedDict
 import json
 import numpy as np
 import os
 from pylab import *
 import random
 import scipy.interpolate
-import struct
 import urllib.request
 import zipfile
 
 import navpy
 
+# parsed tiles (SRTM objects with their lla interpolator) by tile name,
+# shared by all the NEDGround instances in this process.
+tile_cache = {}
+missing_tiles = set()
+
+# return the parsed srtm tile containing lat, lon (or None if it isn't
+# available), loading it on first use.
+def get_tile(lat, lon):
+    tile_name = make_tile_name(lat, lon)
+    if tile_name in tile_cache:
+        return tile_cache[tile_name]
+    if tile_name in missing_tiles:
+        return None
+    srtm = SRTM(lat, lon, '../srtm')
+    if not srtm.parse():
+        missing_tiles.add(tile_name)
+        return None
+    srtm.make_lla_interpolator()
+    tile_cache[tile_name] = srtm
+    return srtm
+
 # return the lower left corner of the 1x1 degree tile containing
 # the specified lla coordinate
 def lla_ll_corner(lat_deg, lon_deg):
@@ -71,8 +92,14 @@ class SRTM():
             print("Notice: requested srtm that is outside catalog")
             return False
         
+    # the decoded (and void filled) tile is saved next to the .hgt.zip
+    # file as a .npy file that can simply be memory mapped next time.
     def parse(self):
         tilename = make_tile_name(self.lat, self.lon)
+        npy_file = self.srtm_cache_dir + '/' + tilename + '.npy'
+        if os.path.exists(npy_file):
+            self.srtm_z = np.load(npy_file, mmap_mode='r')
+            return True
         cache_file = self.srtm_cache_dir + '/' + tilename + '.hgt.zip'
         if not os.path.exists(cache_file):
             if not self.download_srtm(tilename):
@@ -83,23 +110,22 @@ class SRTM():
         f = zip.open(tilename + '.hgt', 'r')
         contents = f.read()
         f.close()
-        # read 1,442,401 (1201x1201) high-endian
-        # signed 16-bit words into self.z
-        self.srtm_z = struct.unpack(">1442401H", contents)
+        # read 1,442,401 (1201x1201) high-endian signed 16-bit words
+        # into self.srtm_z (rows from north to south), voids (-32768)
+        # and out of range values are set to zero.
+        z = np.frombuffer(contents, dtype='>i2').reshape(1201, 1201)
+        self.srtm_z = np.where((z < 0) | (z > 10000), 0, z).astype(np.int16)
+        try:
+            np.save(npy_file, self.srtm_z)
+        except OSError:
+            print("Notice: unable to save:", npy_file)
         return True
     
     def make_lla_interpolator(self):
         print("Notice: constructing LLA interpolator")
         
-        srtm_pts = np.zeros((1201, 1201))
-        for r in range(0,1201):
-            for c in range(0,1201):
-                idx = (1201*r)+c
-                va = self.srtm_z[idx]
-                if va == 65535 or va < 0 or va > 10000:
-                    va = 0.0
-                z = va
-                srtm_pts[c,1200-r] = z
+        # indexed by [lon, lat] (south to north)
+        srtm_pts = self.srtm_z[::-1,:].T.astype(np.float64)
         x = np.linspace(self.lon, self.lon+1, 1201)
         y = np.linspace(self.lat, self.lat+1, 1201)
         #print x
@@ -119,25 +145,102 @@ class SRTM():
         return self.ned_interp(point_list)
 
     def plot_raw(self):
-        zzz = np.zeros((1201,1201))
-        for r in range(0,1201):
-            for c in range(0,1201):
-                va=self.srtm_z[(1201*r)+c]
-                if (va==65535 or va<0 or va>10000):
-                    va=0.0
-                zzz[r][c]=float(va)
+        zzz = self.srtm_z.astype(np.float64)
  
         #zz=np.log1p(zzz)
         imshow(zzz, interpolation='bilinear',cmap=cm.gray,alpha=1.0)
         grid(False)
         show()
 
+# Ray / terrain intersection shared by the elevation surfaces below.
+# Subclasses provide interp(pts), the elevation of an array of [n, e]
+# points (-32768 or nan where unknown.)
+class GroundSurface():
+    # while error > eps: find altitude at current point, new pt = proj
+    # vector to current alt.
+    def interpolate_vector(self, ned, v):
+        #print ned
+        p = ned[:] # copy hopefully
+
+        # sanity check (always assume camera pose is above ground!)
+        if v[2] <= 0.0:
+            return p
+        
+        eps = 0.01
+        count = 0
+        #print "start:", p
+        #print "vec:", v
+        #print "ned:", ned
+        tmp = self.interp([p[0], p[1]])
+        if not np.isnan(tmp[0]) and tmp[0] > -32768:
+            ground = tmp[0]
+        else:
+            ground = 0.0
+        error = abs(p[2] + ground)
+        #print "  p=%s ground=%s error=%s" % (p, ground, error)
+        while error > eps and count < 25:
+            d_proj = -(ned[2] + ground)
+            factor = d_proj / v[2]
+            n_proj = v[0] * factor
+            e_proj = v[1] * factor
+            #print "proj = %s %s" % (n_proj, e_proj)
+            p = [ ned[0] + n_proj, ned[1] + e_proj, ned[2] + d_proj ]
+            #print "new p:", p
+            tmp = self.interp([p[0], p[1]])
+            if not np.isnan(tmp[0]) and tmp[0] > -32768:
+                ground = tmp[0]
+            error = abs(p[2] + ground)
+            #print "  p=%s ground=%.2f error = %.3f" % (p, ground, error)
+            count += 1
+        #print "ground:", ground[0]
+        if np.any(np.isnan(p)):
+            print('SRTM interpolation made a nan:' ,p)
+        return p
+
+    # batch version of interpolate_vector(): the same fixed point
+    # iteration for all the vectors at once, each vector stops when it
+    # converges.  ned is the camera pose (or an n x 3 array with a
+    # separate origin for each vector, so the rays of many images can
+    # be intersected together.)  Returns an n x 3 array of points.
+    def intersect_vectors(self, ned, v_list):
+        v = np.asarray(v_list, dtype=np.float64).reshape(-1, 3)
+        ned = np.broadcast_to(np.asarray(ned, dtype=np.float64), v.shape)
+        p = ned.copy()
+        eps = 0.01
+
+        # (always assume camera pose is above ground!)
+        tmp = self.interp(ned[:,0:2])
+        ground = np.where(np.isnan(tmp) | (tmp <= -32768), 0.0, tmp)
+        active = (v[:,2] > 0.0) & (np.abs(ned[:,2] + ground) > eps)
+        for count in range(25):
+            idx = np.nonzero(active)[0]
+            if not len(idx):
+                break
+            d_proj = -(ned[idx,2] + ground[idx])
+            factor = d_proj / v[idx,2]
+            p[idx,0] = ned[idx,0] + v[idx,0] * factor
+            p[idx,1] = ned[idx,1] + v[idx,1] * factor
+            p[idx,2] = ned[idx,2] + d_proj
+            tmp = self.interp(p[idx,0:2])
+            good = ~np.isnan(tmp) & (tmp > -32768)
+            ground[idx[good]] = tmp[good]
+            active[idx] = np.abs(p[idx,2] + ground[idx]) > eps
+        if np.any(np.isnan(p)):
+            print('SRTM interpolation made a nan:', np.count_nonzero(np.isnan(p[:,0])))
+        return p
+
+    # return a list of (3d) ground intersection points for the give
+    # vector list and camera pose.  Vectors are already transformed
+    # into ned orientation.
+    def interpolate_vectors(self, ned, v_list):
+        return self.intersect_vectors(ned, v_list).tolist()
+
 # Build a gridded elevation interpolation table centered at lla_ref
 # with width and height.  This is a little bit of quick feet dancing,
 # but allows areas to span corners or edges of srtm tiles and attempts
 # to stay on a fast path of regular grids, even though a regularly lla
 # grid != a regular ned grid.
-class NEDGround():
+class NEDGround(GroundSurface):
     def __init__(self, lla_ref, width_m, height_m, step_m):
         self.tile_dict = {}
         self.load_tiles(lla_ref, width_m, height_m)
@@ -155,12 +258,10 @@ class NEDGround():
         lat2, lon2 = lla_ll_corner( ur_lla[0], ur_lla[1] )
         for lat in range(lat1, lat2+1):
             for lon in range(lon1, lon2+1):
-                srtm = SRTM(lat, lon, '../srtm')
-                if srtm.parse():
-                    srtm.make_lla_interpolator()
+                srtm = get_tile(lat, lon)
+                if srtm is not None:
                     #srtm.plot_raw()
-                    tile_name = make_tile_name(lat, lon)
-                    self.tile_dict[tile_name] = srtm
+                    self.tile_dict[make_tile_name(lat, lon)] = srtm
                 
     def make_interpolator(self, lla_ref, width_m, height_m, step_m):
         print("Notice: constructing NED area interpolator")
@@ -177,14 +278,14 @@ class NEDGround():
         #        ned_pts[c,r] = 0.0
         
         # build regularly gridded x,y coordinate list and ned_pts array
+        # (ordered by e, then n: point idx = rows*c + r)
         n_list = np.linspace(-height_m*0.5, height_m*0.5, rows)
         e_list = np.linspace(-width_m*0.5, width_m*0.5, cols)
         #print "e's:", e_list
         #print "n's:", n_list
-        ned_pts = []
-        for e in e_list:
-            for n in n_list:
-                ned_pts.append( [n, e, 0] )
+        ned_pts = np.zeros((rows*cols, 3))
+        ned_pts[:,0] = np.tile(n_list, cols)
+        ned_pts[:,1] = np.repeat(e_list, rows)
 
         # convert ned_pts list to lla coordinates (so it's not
         # necessarily an exact grid anymore, but we can now
@@ -195,11 +296,7 @@ class NEDGround():
         
         # build list of (lat, lon) points for doing actual lla
         # elevation lookup
-        ll_pts = []
-        for i in range( len(navpy_pts[0]) ):
-            lat = navpy_pts[0][i]
-            lon = navpy_pts[1][i]
-            ll_pts.append( [ lon, lat ] )
+        ll_pts = np.column_stack( (navpy_pts[1], navpy_pts[0]) )
         #print "ll_pts:", ll_pts
 
         # set all the elevations in the ned_ds list to the extreme
@@ -215,22 +312,17 @@ class NEDGround():
         # finish all the loaded tiles, we should have elevations for
         # the entire range of points.
         for tile in self.tile_dict:
-            zs = self.tile_dict[tile].lla_interpolate(np.array(ll_pts))
+            zs = self.tile_dict[tile].lla_interpolate(ll_pts)
             #print zs
             # copy the good altitudes back to the corresponding ned points
-            for r in range(0,rows):
-                for c in range(0,cols):
-                    idx = (rows*c)+r
-                    if zs[idx] > -10000:
-                        ned_ds[r,c] = zs[idx]
+            zs = zs.reshape(cols, rows).T
+            good = zs > -10000
+            ned_ds[good] = zs[good]
 
         # quick sanity check
-        for r in range(0,rows):
-            for c in range(0,cols):
-                idx = (rows*c)+r
-                if ned_ds[r,c] < -10000:
-                    print("Problem interpolating elevation for:", ll_pts[idx])
-                    ned_ds[r,c] = 0.0
+        for r, c in zip(*np.nonzero(ned_ds < -10000)):
+            print("Problem interpolating elevation for:", ll_pts[rows*c+r])
+        ned_ds[ned_ds < -10000] = 0.0
         #print "ned_ds:", ned_ds
 
         # now finally build the actual grid interpolator with evenly
@@ -257,53 +349,122 @@ class NEDGround():
                 llaz = self.tile_dict[tile].lla_interpolate(np.array([lla[1], lla[0]]))
                 print("nedz=%.2f llaz=%.2f" % (nedz, llaz))
 
-    # while error > eps: find altitude at current point, new pt = proj
-    # vector to current alt.
-    def interpolate_vector(self, ned, v):
-        #print ned
-        p = ned[:] # copy hopefully
+# A tiled, multi-resolution NED elevation service that can be used in
+# place of NEDGround for any project extent.  The NED plane is cut into
+# square tiles of tile_cells x tile_cells grid cells.  Pyramid level 0
+# has step_m grid spacing, each level above doubles the spacing (and
+# the tile size.)  Tiles are generated from the srtm data the first
+# time they are queried and the most recently used max_tiles tiles are
+# kept in memory.
+#
+# interp() picks the level from the extent of each query: the coarsest
+# level where the query still spans at least tile_cells grid cells.
+# Local queries (a camera footprint, anything under tile_cells * step_m
+# across) get full resolution, and project wide queries touch a
+# handful of coarse tiles instead of thrashing the cache with fine
+# ones.  Pass level=N to always use one level.
+class DEMTiles(GroundSurface):
+    def __init__(self, lla_ref, step_m=30, tile_cells=256, max_tiles=64,
+                 max_level=6, level=None):
+        self.lla_ref = lla_ref
+        self.step_m = step_m
+        self.tile_cells = tile_cells
+        self.max_tiles = max_tiles
+        self.max_level = max_level
+        self.level = level
+        self.cache = OrderedDict()
 
-        # sanity check (always assume camera pose is above ground!)
-        if v[2] <= 0.0:
-            return p
-        
-        eps = 0.01
-        count = 0
-        #print "start:", p
-        #print "vec:", v
-        #print "ned:", ned
-        tmp = self.interp([p[0], p[1]])
-        if not np.isnan(tmp[0]) and tmp[0] > -32768:
-            ground = tmp[0]
-        else:
-            ground = 0.0
-        error = abs(p[2] + ground)
-        #print "  p=%s ground=%s error=%s" % (p, ground, error)
-        while error > eps and count < 25:
-            d_proj = -(ned[2] + ground)
-            factor = d_proj / v[2]
-            n_proj = v[0] * factor
-            e_proj = v[1] * factor
-            #print "proj = %s %s" % (n_proj, e_proj)
-            p = [ ned[0] + n_proj, ned[1] + e_proj, ned[2] + d_proj ]
-            #print "new p:", p
-            tmp = self.interp([p[0], p[1]])
-            if not np.isnan(tmp[0]) and tmp[0] > -32768:
-                ground = tmp[0]
-            error = abs(p[2] + ground)
-            #print "  p=%s ground=%.2f error = %.3f" % (p, ground, error)
-            count += 1
-        #print "ground:", ground[0]
-        if np.any(np.isnan(p)):
-            print('SRTM interpolation made a nan:' ,p)
-        return p
+    # grid spacing and tile size of a pyramid level
+    def level_size(self, level):
+        step = self.step_m * 2**level
+        return step, step * self.tile_cells
 
-    # return a list of (3d) ground intersection points for the give
-    # vector list and camera pose.  Vectors are already transformed
-    # into ned orientation.
-    def interpolate_vectors(self, ned, v_list):
-        pt_list = []
-        for v in v_list:
-            p = self.interpolate_vector(ned, v.flatten())
-            pt_list.append(p)
-        return pt_list
+    # the coarsest level at which extent_m still spans at least cells
+    # grid cells
+    def level_for_extent(self, extent_m, cells=None):
+        if cells is None:
+            cells = self.tile_cells
+        if not extent_m > cells * self.step_m:
+            return 0
+        level = int(np.floor(np.log2(extent_m / (cells * self.step_m))))
+        return min(level, self.max_level)
+
+    # elevation grid of tile (tn, te) of a pyramid level, the grid
+    # includes the shared last row and column of its neighbors.
+    def make_tile(self, level, tn, te):
+        step, size = self.level_size(level)
+        n_list = tn * size + np.arange(self.tile_cells + 1) * step
+        e_list = te * size + np.arange(self.tile_cells + 1) * step
+        ned_pts = np.zeros((len(n_list) * len(e_list), 3))
+        ned_pts[:,0] = np.repeat(n_list, len(e_list))
+        ned_pts[:,1] = np.tile(e_list, len(n_list))
+        lla = navpy.ned2lla(ned_pts, self.lla_ref[0], self.lla_ref[1],
+                            self.lla_ref[2])
+        ll_pts = np.column_stack( (lla[1], lla[0]) )
+        z = np.full(len(ned_pts), -32768.0)
+        lat1, lon1 = lla_ll_corner( np.amin(lla[0]), np.amin(lla[1]) )
+        lat2, lon2 = lla_ll_corner( np.amax(lla[0]), np.amax(lla[1]) )
+        for lat in range(lat1, lat2+1):
+            for lon in range(lon1, lon2+1):
+                srtm = get_tile(lat, lon)
+                if srtm is None:
+                    continue
+                zs = srtm.lla_interpolate(ll_pts)
+                good = zs > -10000
+                z[good] = zs[good]
+        if np.any(z < -10000):
+            print("Notice: no elevation data for part of DEM tile:",
+                  (level, tn, te))
+            z[z < -10000] = 0.0
+        return z.reshape(len(n_list), len(e_list)).astype(np.float32)
+
+    # fetch a tile from the cache (generating it if needed)
+    def get_dem_tile(self, key):
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        tile = self.make_tile(*key)
+        self.cache[key] = tile
+        if len(self.cache) > self.max_tiles:
+            self.cache.popitem(last=False)
+        return tile
+
+    # bilinear elevation lookup for an array of [n, e] points (nan
+    # for non-finite input points.)
+    def elevation(self, pts, level=0):
+        pts = np.asarray(pts, dtype=np.float64).reshape(-1, 2)
+        result = np.full(len(pts), np.nan)
+        step, size = self.level_size(level)
+        valid = np.nonzero(np.all(np.isfinite(pts), axis=1))[0]
+        if not len(valid):
+            return result
+        tiles = np.floor(pts[valid] / size).astype(np.int64)
+        keys, inverse = np.unique(tiles, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        for k, (tn, te) in enumerate(keys.tolist()):
+            idx = valid[inverse == k]
+            z = self.get_dem_tile( (level, tn, te) )
+            x = (pts[idx,0] - tn * size) / step
+            y = (pts[idx,1] - te * size) / step
+            i = np.clip(np.floor(x).astype(np.int64), 0, self.tile_cells - 1)
+            j = np.clip(np.floor(y).astype(np.int64), 0, self.tile_cells - 1)
+            fx = x - i
+            fy = y - j
+            result[idx] = (z[i,j] * (1 - fx) + z[i+1,j] * fx) * (1 - fy) \
+                + (z[i,j+1] * (1 - fx) + z[i+1,j+1] * fx) * fy
+        return result
+
+    # the pyramid level for a query (see above)
+    def query_level(self, pts):
+        if self.level is not None:
+            return self.level
+        pts = np.asarray(pts, dtype=np.float64).reshape(-1, 2)
+        pts = pts[np.all(np.isfinite(pts), axis=1)]
+        if len(pts) < 2:
+            return 0
+        return self.level_for_extent(np.amax(np.ptp(pts, axis=0)))
+
+    # same call as the NEDGround RegularGridInterpolator (so the
+    # GroundSurface vector intersection functions work unchanged)
+    def interp(self, pts):
+        return self.elevation(pts, self.query_level(pts))
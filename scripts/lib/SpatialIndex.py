@@ -0,0 +1,95 @@
+# SpatialIndex.py - a kd-tree index of the image camera locations
+# (and optionally image ground footprints) so we can find neighboring
+# images without an O(n^2) scan of the camera poses.
+
+import numpy as np
+import scipy.spatial
+
+class SpatialIndex():
+    def __init__(self, image_list, opt=False):
+        self.image_list = image_list
+        # read each camera pose out of the property tree just once
+        self.ned = np.zeros((len(image_list), 3))
+        for i, image in enumerate(image_list):
+            ned, ypr, quat = image.get_camera_pose(opt)
+            self.ned[i] = ned
+        self.tree = scipy.spatial.cKDTree(self.ned)
+        self.update_footprints()
+
+    # (re)build the footprint index from the image corner_list_xy
+    # ground projections.  Images without projected corners are
+    # assigned an empty footprint and never overlap anything.
+    def update_footprints(self):
+        self.rects = np.full((len(self.image_list), 4), np.nan)
+        for i, image in enumerate(self.image_list):
+            corners = getattr(image, 'corner_list_xy', [])
+            if len(corners):
+                self.rects[i] = image.coverage_xy()
+        self.has_rects = ~np.isnan(self.rects[:,0])
+        if np.any(self.has_rects):
+            idx = np.nonzero(self.has_rects)[0]
+            rects = self.rects[idx]
+            centers = np.vstack( ((rects[:,0] + rects[:,2]) * 0.5,
+                                  (rects[:,1] + rects[:,3]) * 0.5) ).T
+            half_diag = 0.5 * np.hypot(rects[:,2] - rects[:,0],
+                                       rects[:,3] - rects[:,1])
+            self.rect_index = idx
+            self.rect_tree = scipy.spatial.cKDTree(centers)
+            self.rect_radius = np.amax(half_diag)
+        else:
+            self.rect_index = None
+            self.rect_tree = None
+            self.rect_radius = 0.0
+
+    # return True/False for each of the (i, j) index pairs if the
+    # image footprints overlap.
+    def footprints_overlap(self, i, j):
+        a = self.rects[i]
+        b = self.rects[j]
+        result = (a[:,0] <= b[:,2]) & (a[:,2] >= b[:,0]) \
+            & (a[:,1] <= b[:,3]) & (a[:,3] >= b[:,1])
+        # nan comparisons are already False, so images without
+        # footprints never overlap
+        return result
+
+    # return a list of [dist, i, j] (i < j) for all the image pairs
+    # with a camera separation in the range [min_dist, max_dist].  If
+    # overlap is requested, also require the pair footprints to
+    # overlap.
+    def pairs_in_range(self, min_dist, max_dist, overlap=False):
+        pairs = self.tree.query_pairs(max_dist, output_type='ndarray')
+        if not len(pairs):
+            return []
+        pairs = pairs[np.lexsort((pairs[:,1], pairs[:,0]))]
+        i = pairs[:,0]
+        j = pairs[:,1]
+        dist = np.linalg.norm(self.ned[j] - self.ned[i], axis=1)
+        keep = (dist >= min_dist) & (dist <= max_dist)
+        if overlap:
+            if np.any(self.has_rects):
+                keep &= self.footprints_overlap(i, j)
+            else:
+                print("Notice: no image footprints (corner_list_xy) available, skipping footprint overlap pruning")
+        work_list = []
+        for k in np.nonzero(keep)[0]:
+            work_list.append( [dist[k], int(i[k]), int(j[k])] )
+        return work_list
+
+    # return a list of images whose footprint intersects the given
+    # rectangle (x0, y0, x1, y1)
+    def images_covering_rectangle(self, r2, only_placed=False):
+        if self.rect_tree is None:
+            return []
+        (bx0, by0, bx1, by1) = r2
+        center = [ (bx0 + bx1) * 0.5, (by0 + by1) * 0.5 ]
+        radius = 0.5 * np.hypot(bx1 - bx0, by1 - by0) + self.rect_radius
+        candidates = self.rect_index[self.rect_tree.query_ball_point(center, radius)]
+        coverage_list = []
+        for i in sorted(candidates):
+            image = self.image_list[i]
+            if only_placed and not image.placed:
+                continue
+            (ax0, ay0, ax1, ay1) = self.rects[i]
+            if ax0 <= bx1 and ax1 >= bx0 and ay0 <= by1 and ay1 >= by0:
+                coverage_list.append(image)
+        return coverage_list
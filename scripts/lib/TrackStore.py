@@ -0,0 +1,156 @@
+# TrackStore.py - compact array storage for the grouped feature match
+# chains (tracks.)  This replaces the pickled matches_grouped list of
+# lists:
+#
+#   [ ned, group, [image_idx, [u, v]], [image_idx, [u, v]], ... ]
+#
+# with CSR (compressed sparse row) style arrays:
+#
+#   ned[n,3]      3d point estimate of each track (nan if not set yet)
+#   group[n]      group index of each track (-1 if not in a group)
+#   offsets[n+1]  the observations of track i are [offsets[i]:offsets[i+1]]
+#   obs_image[m]  image index of each observation
+#   obs_uv[m,2]   original (distorted) uv coordinate of each observation
+#
+# The arrays are saved together in a single uncompressed .npz file.
+
+import numpy as np
+import os
+import pickle
+
+class TrackStore():
+    def __init__(self, ned=None, group=None, offsets=None, obs_image=None,
+                 obs_uv=None):
+        if offsets is None:
+            offsets = np.zeros(1, dtype=np.int64)
+        n = len(offsets) - 1
+        if ned is None:
+            ned = np.full((n, 3), np.nan)
+        if group is None:
+            group = np.full(n, -1, dtype=np.int32)
+        if obs_image is None:
+            obs_image = np.zeros(0, dtype=np.int32)
+        if obs_uv is None:
+            obs_uv = np.zeros((0, 2))
+        self.ned = np.asarray(ned, dtype=np.float64).reshape(-1, 3)
+        self.group = np.asarray(group, dtype=np.int32)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.obs_image = np.asarray(obs_image, dtype=np.int32)
+        self.obs_uv = np.asarray(obs_uv, dtype=np.float64).reshape(-1, 2)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    # legacy style (read only) access: tracks[i] returns track i as
+    # [ned, group, [image_idx, [u, v]], ...]
+    def __getitem__(self, i):
+        if i < 0 or i >= len(self):
+            raise IndexError('track index out of range')
+        return self.track(i)
+
+    # total number of observations
+    def num_obs(self):
+        return len(self.obs_image)
+
+    # number of observations (chain length) of each track
+    def track_len(self):
+        return np.diff(self.offsets)
+
+    # track index of each observation
+    def obs_track(self):
+        return np.repeat(np.arange(len(self)), self.track_len())
+
+    # return the (image index, uv) arrays for the observations of
+    # track i (views, not copies)
+    def obs(self, i):
+        a = self.offsets[i]
+        b = self.offsets[i+1]
+        return self.obs_image[a:b], self.obs_uv[a:b]
+
+    # return track i in the legacy list layout
+    def track(self, i):
+        if np.any(np.isnan(self.ned[i])):
+            ned = None
+        else:
+            ned = self.ned[i].tolist()
+        match = [ ned, int(self.group[i]) ]
+        images, uvs = self.obs(i)
+        for image, uv in zip(images.tolist(), uvs.tolist()):
+            match.append( [image, uv] )
+        return match
+
+    # return the full legacy matches_grouped list of lists (for older
+    # scripts that still edit the match structure directly)
+    def to_list(self):
+        return [ self.track(i) for i in range(len(self)) ]
+
+    # return a new store with just the selected tracks (bool mask or
+    # index array), in selection order
+    def select(self, keep):
+        keep = np.asarray(keep)
+        if keep.dtype == bool:
+            keep = np.nonzero(keep)[0]
+        lens = self.track_len()[keep]
+        offsets = np.zeros(len(keep) + 1, dtype=np.int64)
+        np.cumsum(lens, out=offsets[1:])
+        # observation index of every selected observation
+        obs_idx = np.repeat(self.offsets[keep] - offsets[:-1], lens) \
+            + np.arange(offsets[-1])
+        return TrackStore(self.ned[keep], self.group[keep], offsets,
+                          self.obs_image[obs_idx], self.obs_uv[obs_idx])
+
+    # return a new store with only the selected observations (bool
+    # mask over all observations.)  Tracks are kept even if they end
+    # up with fewer than two observations.
+    def select_obs(self, keep):
+        keep = np.asarray(keep, dtype=bool)
+        counts = np.bincount(self.obs_track()[keep], minlength=len(self))
+        offsets = np.zeros(len(self) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return TrackStore(self.ned, self.group, offsets,
+                          self.obs_image[keep], self.obs_uv[keep])
+
+    def save(self, path):
+        np.savez(path, ned=self.ned, group=self.group, offsets=self.offsets,
+                 obs_image=self.obs_image, obs_uv=self.obs_uv)
+
+# build a track store from a legacy matches_grouped list of lists
+def from_list(matches):
+    n = len(matches)
+    ned = np.full((n, 3), np.nan)
+    group = np.full(n, -1, dtype=np.int32)
+    lens = np.zeros(n, dtype=np.int64)
+    for i, match in enumerate(matches):
+        if match[0] is not None:
+            ned[i] = match[0]
+        group[i] = match[1]
+        lens[i] = len(match) - 2
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(lens, out=offsets[1:])
+    obs_image = np.fromiter( (m[0] for match in matches for m in match[2:]),
+                             dtype=np.int32, count=offsets[-1] )
+    obs_uv = np.array( [ m[1] for match in matches for m in match[2:] ],
+                       dtype=np.float64 ).reshape(-1, 2)
+    return TrackStore(ned, group, offsets, obs_image, obs_uv)
+
+def filename(analysis_dir, name='matches_grouped'):
+    return os.path.join(analysis_dir, name + '.npz')
+
+# load a track store, falling back to (and converting) a legacy
+# pickled match file if no .npz file exists yet.
+def load(analysis_dir, name='matches_grouped'):
+    file = filename(analysis_dir, name)
+    if os.path.exists(file):
+        data = np.load(file)
+        return TrackStore(data['ned'], data['group'], data['offsets'],
+                          data['obs_image'], data['obs_uv'])
+    legacy_file = os.path.join(analysis_dir, name)
+    if os.path.exists(legacy_file):
+        print('Converting legacy pickled matches:', legacy_file)
+        matches = pickle.load( open(legacy_file, 'rb') )
+        return from_list(matches)
+    print('No match file found:', file)
+    return TrackStore()
+
+def save(analysis_dir, tracks, name='matches_grouped'):
+    tracks.save(filename(analysis_dir, name))
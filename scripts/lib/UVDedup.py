@@ -0,0 +1,114 @@
+# UVDedup.py - find duplicate keypoints and matches by uv coordinate.
+#
+# Coordinates are quantized to integer centi-pixels (the same
+# resolution as the old "%.2f-%.2f" string keys) and packed into int64
+# keys so the duplicate search can be done in bulk with np.unique() /
+# np.lexsort() instead of python dictionaries.
+
+import numpy as np
+
+# quantize an n x 2 array of uv coordinates to integer 1/scale pixel
+# units (scale is a power of 10) and pack each (u, v) into a single
+# int64 key.
+#
+# uv * scale is not exact, so values that land within a hair of a
+# half way point could round differently than the "%.2f" formatting
+# (which rounds the exact binary value.)  Those few are quantized with
+# the string formatting itself so the keys match the old ones exactly.
+# (Keypoint coordinates are never negative, so "-0.00" vs "0.00" isn't
+# a concern.)
+def uv_keys(uv, scale=100):
+    uv = np.asarray(uv, dtype=np.float64).reshape(-1, 2)
+    s = uv * scale
+    q = np.round(s)
+    near = np.abs(s - np.floor(s) - 0.5) < 1e-6
+    if np.any(near):
+        digits = int(round(np.log10(scale)))
+        q[near] = [ round(float('%.*f' % (digits, x)) * scale)
+                    for x in uv[near].tolist() ]
+    q = q.astype(np.int64)
+    return (q[:,0] << 32) + (q[:,1] + (1 << 31))
+
+# return a remap table where remap[i] is the index of the first
+# keypoint with the same (quantized) uv coordinate as keypoint i.  If
+# a mask is given, only the masked keypoints are considered and all
+# other keypoints map to themselves.
+def kp_remap(uv, mask=None):
+    keys = uv_keys(uv)
+    remap = np.arange(len(keys), dtype=np.int64)
+    if mask is None:
+        idx = remap.copy()
+    else:
+        idx = np.nonzero(mask)[0]
+    if len(idx):
+        uniq, first, inverse = np.unique(keys[idx], return_index=True,
+                                         return_inverse=True)
+        remap[idx] = idx[first][inverse.reshape(-1)]
+    return remap
+
+# rewrite an n x 2 array of [idx1, idx2] match pairs through the
+# remap tables of the two images.
+def remap_pairs(pairs, remap1, remap2):
+    pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+    return np.vstack( (remap1[pairs[:,0]], remap2[pairs[:,1]]) ).T
+
+# return the (sorted) indices of the first instance of each distinct
+# [idx1, idx2] pair.
+def unique_pairs(pairs):
+    pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+    if not len(pairs):
+        return np.zeros(0, dtype=np.int64)
+    order = np.lexsort( (pairs[:,1], pairs[:,0]) )
+    sorted_pairs = pairs[order]
+    first = np.ones(len(pairs), dtype=bool)
+    first[1:] = np.any(sorted_pairs[1:] != sorted_pairs[:-1], axis=1)
+    return np.sort(order[first])
+
+# mark the first instance of each id (in array order.)
+def first_instance(ids):
+    result = np.zeros(len(ids), dtype=bool)
+    uniq, first = np.unique(ids, return_index=True)
+    result[first] = True
+    return result
+
+# first come, first served: walk the match pairs in order and keep a
+# pair only if neither its image1 uv nor its image2 uv was used by an
+# earlier kept pair.  Returns the (sorted) indices of the kept pairs.
+#
+# The first few steps are done in vectorized rounds: a remaining pair
+# that is the first remaining instance of both its uv keys can't be
+# blocked by any earlier pair, so it is kept.  Pairs whose keys are
+# then used are dropped, and we repeat.  This normally settles every
+# pair in a round or two, but chains of duplicates (uv1 shared with
+# the next pair, uv2 with the one after that, ...) only settle one
+# link per round, so after max_rounds the rest are finished with a
+# single ordered pass over the integer ids.
+def filter_pairs(uv1, uv2, max_rounds=4):
+    ids1 = np.unique(uv_keys(uv1), return_inverse=True)[1].reshape(-1)
+    ids2 = np.unique(uv_keys(uv2), return_inverse=True)[1].reshape(-1)
+    used1 = np.zeros(len(ids1), dtype=bool)
+    used2 = np.zeros(len(ids2), dtype=bool)
+    remain = np.arange(len(ids1))
+    keep = []
+    rounds = 0
+    while len(remain) and rounds < max_rounds:
+        a = ids1[remain]
+        b = ids2[remain]
+        winners = remain[first_instance(a) & first_instance(b)]
+        keep.append(winners)
+        used1[ids1[winners]] = True
+        used2[ids2[winners]] = True
+        remain = remain[~used1[a] & ~used2[b]]
+        rounds += 1
+    if len(remain):
+        rest = []
+        for k, a, b in zip(remain.tolist(), ids1[remain].tolist(),
+                           ids2[remain].tolist()):
+            if not used1[a] and not used2[b]:
+                used1[a] = True
+                used2[b] = True
+                rest.append(k)
+        keep.append(np.array(rest, dtype=np.int64))
+    if not keep:
+        return np.zeros(0, dtype=np.int64)
+    return np.sort(np.concatenate(keep))
@@ -1,5 +1,6 @@
 import cv2
 import math
+import numpy as np
 
 from lib import ProjectMgr
 
@@ -132,3 +133,31 @@ def delete_marked_features(matches, min_chain_len, strong=False):
             matches.pop(i)
     print("final matches size:", len(matches))
 
+
+# track store versions of the above.  Marks are kept in a separate
+# bool array (one entry per observation) instead of being written
+# into the match structure.
+def mark_obs(tracks, mark, match_index, feat_index, error):
+    print('  outlier - match index:', match_index, 'feature index:', feat_index, 'error:', error)
+    mark[tracks.offsets[match_index] + feat_index] = True
+
+def mark_obs_using_list(mark_list, tracks, mark):
+    for m in mark_list:
+        mark_obs( tracks, mark, m[0], m[1], "-" )
+
+# delete marked observations, returns the new track store
+def delete_marked_obs(tracks, mark, min_chain_len, strong=False):
+    print(" deleting marked items...")
+    keep = np.ones(len(tracks), dtype=bool)
+    if strong:
+        has_bad_elem = np.bincount(tracks.obs_track()[mark],
+                                   minlength=len(tracks)) > 0
+        print("deleting %d entire matches that contain a bad element" % np.count_nonzero(has_bad_elem))
+        keep &= ~has_bad_elem
+    tracks = tracks.select_obs(~mark)
+    short = tracks.track_len() < min_chain_len
+    print("deleting %d matches that are now in less than %d images" % (np.count_nonzero(short & keep), min_chain_len))
+    keep &= ~short
+    tracks = tracks.select(keep)
+    print("final matches size:", len(tracks))
+    return tracks